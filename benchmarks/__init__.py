@@ -0,0 +1,8 @@
+'''
+(For dev only) Offline benchmarks and harnesses for dojo itself.
+
+These stand up local replacements for GitHub and repo.anaconda.com (a bare git
+repository as the feedstock remote, and an HTTP server serving fixture conda
+packages), so they can run without network access. They aren't part of the
+installed package; run them from a checkout with `python -m benchmarks <name>`.
+'''
@@ -0,0 +1,131 @@
+import argparse
+import sys
+
+
+def main():
+    p = argparse.ArgumentParser(
+            description='(For dev only) Run offline benchmarks of dojo itself.',
+            usage='python -m benchmarks'
+            )
+    subparsers = p.add_subparsers(dest='benchmark')
+    help_msg_concurrent_starts = '''Simulate many learners starting the same lesson at once on one host.'''
+    subcmd_concurrent_starts = subparsers.add_parser('concurrent-starts', help=help_msg_concurrent_starts)
+    subcmd_concurrent_starts.add_argument(
+        '--learners',
+        help='Number of simultaneous "dojo start" processes.',
+        type=int,
+        default=30,
+        )
+    help_msg_clone = '''Compare a full feedstock clone with the lesson.yaml "feedstock_clone" modes.'''
+    subcmd_clone = subparsers.add_parser('clone', help=help_msg_clone)
+    subcmd_clone.add_argument(
+        '--commits',
+        help='Number of commits in the feedstock\'s history.',
+        type=int,
+        default=50,
+        )
+    subcmd_clone.add_argument(
+        '--vendored-kb',
+        help='Size of a vendored source file (outside of recipe/) rewritten in every commit (KB).',
+        type=int,
+        default=1024,
+        )
+    help_msg_setup = '''Time start, stop, resume and start-over cycles of a lesson, phase by phase.'''
+    subcmd_setup = subparsers.add_parser('setup', help=help_msg_setup)
+    subcmd_setup.add_argument(
+        '--cycles',
+        help='Number of cycles to run (each in a fresh workspace).',
+        type=int,
+        default=3,
+        )
+    subcmd_setup.add_argument(
+        '--lesson',
+        help='Use this lesson (with its package URLs and feedstock rewritten to the local stand-ins) '
+             'instead of a synthetic one.',
+        )
+    help_msg_notes = '''Time building, updating and searching the notes index.'''
+    subcmd_notes = subparsers.add_parser('notes', help=help_msg_notes)
+    subcmd_notes.add_argument(
+        '--notes',
+        help='Number of notes.',
+        type=int,
+        default=50000,
+        )
+    subcmd_notes.add_argument(
+        '--lessons',
+        help='Number of lessons the notes are spread across.',
+        type=int,
+        default=100,
+        )
+    help_msg_merge = '''Time `dojo state merge` (and its peak memory) over many learners' exports.'''
+    subcmd_merge = subparsers.add_parser('merge', help=help_msg_merge)
+    subcmd_merge.add_argument(
+        '--learners',
+        help='Number of learners.',
+        type=int,
+        default=200,
+        )
+    subcmd_merge.add_argument(
+        '--events',
+        help='Number of unique events, across all learners.',
+        type=int,
+        default=1000000,
+        )
+    subcmd_merge.add_argument(
+        '--exports',
+        help='Number of overlapping exports of each learner\'s state.',
+        type=int,
+        default=3,
+        )
+    help_msg_transcode = '''Compare indexing and extracting .tar.bz2 packages with the same packages transcoded to .conda.'''
+    subcmd_transcode = subparsers.add_parser('transcode', help=help_msg_transcode)
+    for subcmd in [subcmd_concurrent_starts, subcmd_setup]:
+        subcmd.add_argument(
+            '--latency-ms',
+            help='Simulated latency of each HTTP request (ms).',
+            type=float,
+            default=0,
+            )
+    for subcmd in [subcmd_concurrent_starts, subcmd_setup, subcmd_transcode]:
+        subcmd.add_argument(
+            '--packages',
+            help='Number of fixture packages in the lesson\'s dojo_channels.',
+            type=int,
+            default=32,
+            )
+        subcmd.add_argument(
+            '--size-kb',
+            help='Size of each fixture package\'s payload (KB).',
+            type=int,
+            default=64,
+            )
+
+    args = p.parse_args()
+
+    from benchmarks import bench
+    if args.benchmark == 'concurrent-starts':
+        bench.bench_concurrent_starts(num_learners=args.learners,
+                                      num_packages=args.packages,
+                                      package_size=args.size_kb * 1024,
+                                      latency=args.latency_ms / 1000)
+    elif args.benchmark == 'setup':
+        bench.bench_setup(num_packages=args.packages,
+                          package_size=args.size_kb * 1024,
+                          latency=args.latency_ms / 1000,
+                          cycles=args.cycles,
+                          lesson_name=args.lesson)
+    elif args.benchmark == 'notes':
+        bench.bench_notes(num_notes=args.notes, num_lessons=args.lessons)
+    elif args.benchmark == 'merge':
+        bench.bench_merge(num_learners=args.learners, num_events=args.events, num_exports=args.exports)
+    elif args.benchmark == 'transcode':
+        bench.bench_transcode(num_packages=args.packages, package_size=args.size_kb * 1024)
+    elif args.benchmark == 'clone':
+        bench.bench_clone(num_commits=args.commits, vendored_size=args.vendored_kb * 1024)
+    else:
+        p.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,437 @@
+'''
+The benchmarks themselves. Each bench_* function prints its own results.
+'''
+import csv
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from git import Repo
+from tabulate import tabulate
+
+from benchmarks.fixtures import (BENCHMARK_LESSON_NAME, FixtureServer, get_dir_size, make_feedstock_remote,
+                                 make_fixture_channel, make_workspace, mirror_lesson_packages)
+
+
+def bench_concurrent_starts(num_learners=30, num_packages=32, package_size=64 * 1024, latency=0.0):
+    '''
+    Simulates a classroom: num_learners run `dojo start` for the same lesson
+    at the same moment, sharing one DOJO_SHARED_DIR. Reports how many package
+    requests reached the server (tests/test_coordinator.py checks that each
+    package is fetched exactly once).
+    '''
+    with tempfile.TemporaryDirectory(prefix='dojo_bench_') as tmp_dir:
+        remote_path = os.path.join(tmp_dir, 'remote')
+        feedstock_url, commit = make_feedstock_remote(remote_path)
+        relpaths = make_fixture_channel(os.path.join(tmp_dir, 'server', 'main'), num_packages, package_size)
+
+        with FixtureServer(os.path.join(tmp_dir, 'server'), latency=latency) as server:
+            pkg_urls = [f'{server.url}/{relpath}' for relpath in relpaths]
+            processes = []
+            start_time = time.monotonic()
+            for i in range(num_learners):
+                workspace_path = os.path.join(tmp_dir, 'learners', f'learner_{i:03d}')
+                env = make_workspace(workspace_path, feedstock_url, commit, pkg_urls)
+                env['DOJO_SHARED_DIR'] = os.path.join(tmp_dir, 'shared')
+                processes.append(subprocess.Popen([sys.executable, '-m', 'dojo', 'start', BENCHMARK_LESSON_NAME],
+                                                  cwd=workspace_path, env=env, stdin=subprocess.DEVNULL,
+                                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True))
+            failures = []
+            for i, process in enumerate(processes):
+                _, stderr = process.communicate()
+                if process.returncode != 0:
+                    failures.append((i, stderr.strip().splitlines()[-1:] or ['']))
+            elapsed = time.monotonic() - start_time
+            request_counts = {path: server.request_counts[f'/{path}'] for path in relpaths}
+
+    print(f'{num_learners} concurrent starts, {num_packages} packages of {package_size // 1024} KB, '
+          f'{latency * 1000:.0f} ms latency: {elapsed:.2f} s')
+    print(f'  Package requests served: {sum(request_counts.values())} (unique packages: {num_packages})')
+    if failures:
+        print(f'  {len(failures)} start(s) failed, e.g. learner {failures[0][0]}: {failures[0][1][0]}')
+        sys.exit(1)
+
+
+def bench_clone(num_commits=50, vendored_size=1024 * 1024):
+    '''
+    Clones a feedstock with a long history and vendored sources (from a local
+    bare repository) with the default full clone, then with each of the
+    lesson.yaml "feedstock_clone" modes, and compares their times and sizes.
+    '''
+    from dojo import lesson
+
+    modes = [
+        ('full clone', {}),
+        ('shallow', {'shallow': True, 'partial': False, 'sparse_paths': []}),
+        ('partial', {'shallow': False, 'partial': True, 'sparse_paths': []}),
+        ('shallow + partial + sparse', {'shallow': True, 'partial': True, 'sparse_paths': ['recipe']}),
+    ]
+    print(f'Feedstock with {num_commits} commits, {vendored_size // 1024} KB vendored source rewritten in each:')
+    with tempfile.TemporaryDirectory(prefix='dojo_bench_') as tmp_dir:
+        feedstock_url, commit = make_feedstock_remote(os.path.join(tmp_dir, 'remote'), num_commits=num_commits,
+                                                      vendored_size=vendored_size)
+        for i, (mode, clone_options) in enumerate(modes):
+            target_path = os.path.join(tmp_dir, f'clone_{i}')
+            start_time = time.monotonic()
+            if clone_options:
+                repo = lesson.fetch_feedstock_commit(feedstock_url, commit, target_path, clone_options)
+            else:
+                repo = Repo.clone_from(feedstock_url, target_path)
+            repo.git.checkout(commit)
+            elapsed = time.monotonic() - start_time
+
+            git_size = get_dir_size(os.path.join(target_path, '.git'))
+            tree_size = get_dir_size(target_path) - git_size
+            print(f'  {mode:<28} {elapsed:6.2f} s   .git: {git_size / (1024 * 1024):7.2f} MB   '
+                  f'checkout: {tree_size / (1024 * 1024):7.2f} MB')
+
+
+def time_conda_index(channel_path):
+    '''
+    Returns how long `conda index` takes on the channel (None if it isn't available).
+    '''
+    start_time = time.monotonic()
+    result = subprocess.run(['conda', 'index', channel_path], capture_output=True)
+    if result.returncode != 0:
+        return None
+    return time.monotonic() - start_time
+
+
+def time_extract(subdir_path, extract_path):
+    '''
+    Returns how long it takes to extract every package in the subdir
+    (as conda does when creating an environment).
+    '''
+    from conda_package_handling import api as cph_api
+    from dojo.cache import ARCHIVE_EXTENSIONS, strip_archive_extension
+
+    start_time = time.monotonic()
+    for fn in sorted(os.listdir(subdir_path)):
+        if fn.endswith(ARCHIVE_EXTENSIONS):
+            cph_api.extract(os.path.join(subdir_path, fn), dest_dir=os.path.join(extract_path, strip_archive_extension(fn)))
+    return time.monotonic() - start_time
+
+
+def bench_transcode(num_packages=32, package_size=1024 * 1024):
+    '''
+    Compares indexing and extracting a channel of .tar.bz2 packages with
+    the same channel after transcoding them to .conda on ingest.
+    '''
+    from dojo.cache import has_package_handling, transcode_packages
+
+    if not has_package_handling():
+        print('ERROR: This benchmark needs conda-package-handling.')
+        sys.exit(1)
+
+    def format_seconds(seconds):
+        return 'n/a (conda index not available)' if seconds is None else f'{seconds:6.2f} s'
+
+    with tempfile.TemporaryDirectory(prefix='dojo_bench_') as tmp_dir:
+        bz2_channel = os.path.join(tmp_dir, 'tar_bz2', 'main')
+        conda_channel = os.path.join(tmp_dir, 'conda', 'main')
+        make_fixture_channel(bz2_channel, num_packages, package_size)
+        shutil.copytree(bz2_channel, conda_channel)
+
+        subdir_path = os.path.join(conda_channel, 'noarch')
+        start_time = time.monotonic()
+        transcode_packages([os.path.join(subdir_path, fn) for fn in os.listdir(subdir_path)])
+        transcode_time = time.monotonic() - start_time
+
+        bz2_size = get_dir_size(bz2_channel)
+        conda_size = get_dir_size(conda_channel)
+        print(f'{num_packages} packages of {package_size // 1024} KB:')
+        print(f'  transcode (on ingest, parallel): {transcode_time:6.2f} s')
+        print(f'  {"":<10} {"index":>34}   {"extract":>8}   {"size":>9}')
+        for label, channel_path, size in [('.tar.bz2', bz2_channel, bz2_size), ('.conda', conda_channel, conda_size)]:
+            index_time = time_conda_index(channel_path)
+            extract_time = time_extract(os.path.join(channel_path, 'noarch'),
+                                        os.path.join(tmp_dir, 'extracted', label.lstrip('.')))
+            print(f'  {label:<10} {format_seconds(index_time):>34}   {extract_time:6.2f} s   '
+                  f'{size / (1024 * 1024):6.1f} MB')
+
+
+# One cycle of `dojo start`, `dojo stop`, etc., as (label, arguments,
+# answer to the "(r)esume, (s)tart over, or (c)ancel?" prompt).
+SETUP_CYCLE = [
+    ('start', ['start'], None),
+    ('stop', ['stop'], None),
+    ('resume', ['start'], 'r'),
+    ('start over', ['start'], 's'),
+    ('stop', ['stop'], None),
+]
+SETUP_PHASES = ['plan', 'feedstock', 'packages', 'index', 'cache', 'condarc', 'clean']
+
+
+def run_timed_command(args, workspace_path, env, answer=None):
+    '''
+    Runs `dojo <args>` in the workspace. Returns (seconds, {phase: seconds}),
+    or exits if the command failed.
+    '''
+    timings_path = os.path.join(workspace_path, 'phase_timings.jsonl')
+    if os.path.exists(timings_path):
+        os.remove(timings_path)
+    env = dict(env, DOJO_PHASE_TIMINGS=timings_path)
+
+    start_time = time.monotonic()
+    result = subprocess.run([sys.executable, '-m', 'dojo'] + args, cwd=workspace_path, env=env,
+                            input=f'{answer}\n' if answer else '', capture_output=True, text=True)
+    elapsed = time.monotonic() - start_time
+    if result.returncode != 0:
+        print(f'ERROR: `dojo {" ".join(args)}` failed in {workspace_path}:')
+        print(result.stdout[-2000:] + result.stderr[-2000:])
+        sys.exit(1)
+
+    phases = Counter()
+    if os.path.exists(timings_path):
+        with open(timings_path) as f:
+            for line in f:
+                record = json.loads(line)
+                phases[record['phase']] += record['seconds']
+    return elapsed, phases
+
+
+def bench_setup(num_packages=32, package_size=64 * 1024, latency=0.0, cycles=3, lesson_name=None):
+    '''
+    Times full start, stop, resume and start-over cycles of a lesson against
+    the stand-ins, with per-phase timings (the setup steps, plus planning
+    and cleaning up). Each cycle runs in a fresh workspace; the table shows
+    the median of each over all cycles.
+    If lesson_name is given, that lesson is used (with its packages mirrored
+    by fixture packages of the same names) instead of a synthetic one.
+    '''
+    from dojo.lesson import get_repo_name
+    from dojo.utils import load_lesson_specs
+
+    lesson_specs = None
+    repo_name = 'dojo-bench-feedstock'
+    if lesson_name:
+        lesson_specs = load_lesson_specs(lesson_name)
+        repo_name = get_repo_name(lesson_specs['feedstock_url'])
+
+    with tempfile.TemporaryDirectory(prefix='dojo_bench_') as tmp_dir:
+        feedstock_url, commit = make_feedstock_remote(os.path.join(tmp_dir, 'remote'), repo_name=repo_name)
+        server_path = os.path.join(tmp_dir, 'server')
+        if lesson_name:
+            relpaths = mirror_lesson_packages(lesson_name, server_path, package_size)
+        else:
+            relpaths = make_fixture_channel(os.path.join(server_path, 'main'), num_packages, package_size)
+
+        # [(seconds, phases, package requests)] of each command in the cycle, over all cycles.
+        results = [[] for _ in SETUP_CYCLE]
+        with FixtureServer(server_path, latency=latency) as server:
+            pkg_urls = [f'{server.url}/{relpath}' for relpath in relpaths]
+            for i in range(cycles):
+                workspace_path = os.path.join(tmp_dir, 'workspaces', f'cycle_{i:03d}')
+                env = make_workspace(workspace_path, feedstock_url, commit, pkg_urls,
+                                     lesson_name=lesson_name or BENCHMARK_LESSON_NAME, lesson_specs=lesson_specs)
+                for j, (_, args, answer) in enumerate(SETUP_CYCLE):
+                    if args == ['start']:
+                        args = args + [lesson_name or BENCHMARK_LESSON_NAME]
+                    num_requests = sum(server.request_counts.values())
+                    elapsed, phases = run_timed_command(args, workspace_path, env, answer=answer)
+                    results[j].append((elapsed, phases, sum(server.request_counts.values()) - num_requests))
+
+    def get_median(values):
+        values = [value for value in values if value is not None]
+        return statistics.median(values) if values else None
+
+    rows = []
+    for (label, _, _), runs in zip(SETUP_CYCLE, results):
+        row = [label, get_median([elapsed for elapsed, _, _ in runs])]
+        row += [get_median([phases.get(phase) for _, phases, _ in runs]) for phase in SETUP_PHASES]
+        row.append(round(get_median([num_requests for _, _, num_requests in runs])))
+        rows.append(row)
+
+    print(f'Lesson: {lesson_name or BENCHMARK_LESSON_NAME}, {len(relpaths)} packages of {package_size // 1024} KB, '
+          f'{latency * 1000:.0f} ms latency, median of {cycles} cycle(s) (seconds):')
+    print(tabulate(rows, headers=['command', 'total'] + SETUP_PHASES + ['HTTP requests'],
+                   tablefmt='simple', floatfmt='.2f'))
+
+
+NOTE_WORDS = ('pip wheel libstdcxx-ng python openssl ncurses conda build recipe meta.yaml patch '
+              'unsatisfiable pruned error missing dependency version bump license host run test').split()
+NOTE_VOCABULARY_SIZE = 5000
+
+
+def make_fixture_notes(lessons_path, num_notes, num_lessons):
+    '''
+    Writes a progress.csv full of (random) notes for each of num_lessons lessons.
+    Like natural language, word frequencies follow Zipf's law.
+    '''
+    rng = random.Random(0)
+    vocabulary = [f'word{i}' for i in range(NOTE_VOCABULARY_SIZE)]
+    # Spread the words used in queries over common and rare ranks.
+    for i, word in enumerate(NOTE_WORDS):
+        vocabulary[(i * 7) ** 2 % NOTE_VOCABULARY_SIZE] = word
+    weights = [1 / rank for rank in range(1, NOTE_VOCABULARY_SIZE + 1)]
+    for i in range(num_lessons):
+        lesson_name = f'{i:03d}_bench_notes'
+        Path(os.path.join(lessons_path, lesson_name)).mkdir(parents=True)
+        with open(os.path.join(lessons_path, lesson_name, 'progress.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['lesson_name', 'start_timestamp', 'lesson_index', 'note'])
+            for j in range(num_notes // num_lessons):
+                note = ' '.join(rng.choices(vocabulary, weights, k=rng.randint(4, 30)))
+                writer.writerow([lesson_name, '2021-04-01 12:00:00', j % 12, note])
+
+
+def bench_notes(num_notes=50000, num_lessons=100, num_queries=50):
+    '''
+    Times building the notes search index, keeping it up to date, and
+    searching it, over num_notes notes spread across num_lessons lessons.
+    '''
+    from dojo import notes
+
+    queries = ['libstdcxx', 'pip wheel', '"conda build"', 'unsatisfiable OR missing', 'licen*']
+    with tempfile.TemporaryDirectory(prefix='dojo_bench_') as tmp_dir:
+        lessons_path = os.path.join(tmp_dir, 'lessons')
+        make_fixture_notes(lessons_path, num_notes, num_lessons)
+        conn = notes.open_index(os.path.join(tmp_dir, 'notes_index.sqlite'))
+
+        start_time = time.monotonic()
+        notes.sync_index(conn, lessons_path)
+        build_time = time.monotonic() - start_time
+
+        start_time = time.monotonic()
+        notes.sync_index(conn, lessons_path)
+        noop_time = time.monotonic() - start_time
+
+        # Add a note to one lesson, as `dojo a` does.
+        with open(os.path.join(lessons_path, '000_bench_notes', 'progress.csv'), 'a', newline='') as f:
+            csv.writer(f).writerow(['000_bench_notes', '2021-04-02 12:00:00', 0, 'a brand new note about zstd'])
+        start_time = time.monotonic()
+        notes.index_lesson(conn, '000_bench_notes', lessons_path)
+        add_time = time.monotonic() - start_time
+        found = list(notes.iter_search_results(conn, 'zstd'))
+
+        query_times = []
+        for i in range(num_queries):
+            start_time = time.monotonic()
+            list(notes.iter_search_results(conn, queries[i % len(queries)], limit=20))
+            query_times.append(time.monotonic() - start_time)
+        num_matches = [conn.execute('SELECT count(*) FROM notes WHERE notes MATCH ?', (query,)).fetchone()[0]
+                       for query in queries]
+        conn.close()
+
+    print(f'{num_notes} notes across {num_lessons} lessons:')
+    print(f'  build index:              {build_time * 1000:8.1f} ms')
+    print(f'  sync (nothing changed):   {noop_time * 1000:8.1f} ms')
+    print(f'  re-index after a new note:{add_time * 1000:8.1f} ms')
+    print(f'  search (top 20), median:  {statistics.median(query_times) * 1000:8.1f} ms   '
+          f'max: {max(query_times) * 1000:.1f} ms')
+    print('  matching notes per query: ' + ', '.join(f'{query} ({n})' for query, n in zip(queries, num_matches)))
+    if len(found) != 1:
+        print('  FAIL: the new note was not found.')
+        sys.exit(1)
+
+
+MERGE_LESSONS = [f'{i:03d}_bench_merge' for i in range(20)]
+MERGE_ACTIONS = ['start', 'resume', 'stop', 'start over', 'completed']
+
+
+def iter_fixture_learner_events(rng, num_events):
+    '''
+    Yields one learner's (kind, row) events, as `dojo` would have recorded
+    them over a few weeks, in order. A history event and a progress event
+    may share a timestamp (as when `dojo start` writes both).
+    '''
+    timestamp = 1617278400 + rng.randrange(86400)
+    kinds_at_timestamp = set()
+    for i in range(num_events):
+        kind = 'history' if rng.random() < 0.2 else 'progress'
+        gap = rng.choice((0, 1, 2, 30, 600)) or int(kind in kinds_at_timestamp)
+        if gap:
+            timestamp += gap
+            kinds_at_timestamp.clear()
+        kinds_at_timestamp.add(kind)
+        ts = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(timestamp))
+        lesson_name = MERGE_LESSONS[i // 200 % len(MERGE_LESSONS)]
+        if kind == 'history':
+            yield kind, [ts, lesson_name, rng.choice(MERGE_ACTIONS), True, False]
+        else:
+            note = f'note {i} about pip and wheel' if rng.random() < 0.1 else ''
+            yield kind, [lesson_name, ts, i % 12, note]
+
+
+def make_fixture_exports(collected_path, num_learners, num_events, num_exports):
+    '''
+    Writes num_exports overlapping exports of each learner's state (each
+    export holds all of the previous one, plus more), as collected from
+    their containers over time. Returns the number of unique events.
+    '''
+    rng = random.Random(0)
+    num_unique = 0
+    for i in range(num_learners):
+        events = list(iter_fixture_learner_events(rng, num_events // num_learners))
+        num_unique += len(events)
+        for j in range(1, num_exports + 1):
+            export_path = os.path.join(collected_path, f'learner{i:05d}', f'export{j}')
+            Path(export_path).mkdir(parents=True)
+            files = {}
+            try:
+                for kind, row in events[:len(events) * j // num_exports]:
+                    lesson_name = row[1] if kind == 'history' else row[0]
+                    key = 'history' if kind == 'history' else lesson_name
+                    if key not in files:
+                        if kind == 'history':
+                            path = os.path.join(export_path, 'history.csv')
+                            columns = ['timestamp', 'lesson_name', 'action', 'active', 'completed']
+                        else:
+                            Path(os.path.join(export_path, 'lessons', lesson_name)).mkdir(parents=True)
+                            path = os.path.join(export_path, 'lessons', lesson_name, 'progress.csv')
+                            columns = ['lesson_name', 'start_timestamp', 'lesson_index', 'note']
+                        f = open(path, 'w', newline='')
+                        files[key] = (f, csv.writer(f))
+                        files[key][1].writerow(columns)
+                    files[key][1].writerow(row)
+            finally:
+                for f, _ in files.values():
+                    f.close()
+    return num_unique
+
+
+MERGE_CHILD = '''
+import json, resource, sys, time
+from dojo.state import merge_state
+start_time = time.monotonic()
+num_read, num_learners, num_written = merge_state(sys.argv[1:-2], sys.argv[-2], int(sys.argv[-1]), quiet=True)
+print(json.dumps({'seconds': time.monotonic() - start_time, 'read': num_read, 'written': num_written,
+                  'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+'''
+
+
+def bench_merge(num_learners=200, num_events=1000000, num_exports=3, max_events_in_memory=(100000, 500000)):
+    '''
+    Times `dojo state merge` over num_exports overlapping exports of each
+    of num_learners learners (num_events unique events in all), and records
+    its peak memory, for each max_events_in_memory.
+    '''
+    with tempfile.TemporaryDirectory(prefix='dojo_bench_') as tmp_dir:
+        collected_path = os.path.join(tmp_dir, 'collected')
+        print(f'Writing {num_exports} export(s) of {num_learners} learners ({num_events} unique events)...')
+        num_unique = make_fixture_exports(collected_path, num_learners, num_events, num_exports)
+
+        rows = []
+        for max_events in max_events_in_memory:
+            output_path = os.path.join(tmp_dir, f'merged_{max_events}')
+            # Each merge runs in its own process, so its peak memory can be measured on its own.
+            package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            output = subprocess.run([sys.executable, '-c', MERGE_CHILD, collected_path, output_path, str(max_events)],
+                                    cwd=tmp_dir, env=dict(os.environ, PYTHONPATH=package_root),
+                                    check=True, stdout=subprocess.PIPE, text=True).stdout
+            result = json.loads(output.splitlines()[-1])
+            if result['written'] != num_unique:
+                print(f'FAIL: wrote {result["written"]} events, expected {num_unique} unique events.')
+                sys.exit(1)
+            rows.append([max_events, result['read'], result['read'] - result['written'], result['seconds'],
+                         result['read'] / result['seconds'], result['max_rss_kb'] / 1024])
+
+    print(tabulate(rows, headers=['max events in memory', 'events read', 'duplicates dropped', 'seconds',
+                                  'events/s', 'peak RSS (MB)'],
+                   tablefmt='simple', floatfmt=('', '', '', '.1f', ',.0f', '.1f'), intfmt=','))
@@ -0,0 +1,242 @@
+'''
+Local stand-ins for GitHub and repo.anaconda.com, shared by the benchmarks
+and the tests.
+'''
+import bz2
+import io
+import json
+import os
+import sys
+import tarfile
+import threading
+import time
+from collections import Counter
+from functools import partial
+from git import Actor, Repo
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+BENCHMARK_LESSON_NAME = '900_benchmark'
+BENCHMARK_ACTOR = Actor('dojo benchmark', 'dojo@example.com')
+# Maps random bytes onto 16 letters, so payloads compress about 2x.
+PAYLOAD_TRANSLATION = bytes(ord('a') + i % 16 for i in range(256))
+
+
+def make_fixture_package(subdir_path, name, version='1.0', build='0', size=64 * 1024, depends=()):
+    '''
+    Writes a minimal (but valid) .tar.bz2 conda package: info/index.json plus
+    a payload file of `size` random letters. Returns its filename.
+    '''
+    fn = f'{name}-{version}-{build}.tar.bz2'
+    subdir = os.path.basename(subdir_path)
+    index = {
+        'name': name,
+        'version': version,
+        'build': build,
+        'build_number': 0,
+        'depends': list(depends),
+        'subdir': subdir,
+        'arch': None,
+        'platform': None,
+        'license': 'BSD-3-Clause',
+        'timestamp': 1618000000000,
+    }
+    files = {
+        'info/index.json': json.dumps(index, indent=2).encode(),
+        'info/files': f'share/{name}/payload.bin\n'.encode(),
+        # Random, but (like real packages) compressible.
+        f'share/{name}/payload.bin': os.urandom(size).translate(PAYLOAD_TRANSLATION),
+    }
+
+    Path(subdir_path).mkdir(parents=True, exist_ok=True)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for path, data in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mtime = 1618000000
+            tar.addfile(info, io.BytesIO(data))
+    with open(os.path.join(subdir_path, fn), 'wb') as f:
+        f.write(bz2.compress(buffer.getvalue()))
+    return fn
+
+
+def make_fixture_package_like(subdir_path, fn, size=64 * 1024):
+    '''
+    Writes a fixture package with the same filename (name, version, build and
+    format) as a real one, e.g. one listed in a lesson's dojo_channels_pkgs.txt.
+    '''
+    from dojo.cache import has_package_handling, strip_archive_extension, transcode_to_conda
+
+    if fn.endswith('.conda') and not has_package_handling():
+        print(f'ERROR: Making a fixture for {fn} needs conda-package-handling (to write a .conda package).')
+        sys.exit(1)
+    name, version, build = strip_archive_extension(fn).rsplit('-', 2)
+    bz2_fn = make_fixture_package(subdir_path, name, version, build, size=size)
+    if fn.endswith('.conda'):
+        transcode_to_conda(os.path.join(subdir_path, bz2_fn))
+    return fn
+
+
+def mirror_lesson_packages(lesson_name, server_path, package_size):
+    '''
+    Writes a fixture package for each package in the lesson's
+    dojo_channels_pkgs.txt, at the same "<channel>/<subdir>/<fn>" path
+    under server_path. Returns those paths.
+    '''
+    from dojo.lesson import get_desired_packages
+
+    relpaths = list(get_desired_packages(lesson_name))
+    for relpath in relpaths:
+        make_fixture_package_like(os.path.join(server_path, os.path.dirname(relpath)),
+                                  os.path.basename(relpath), size=package_size)
+    return relpaths
+
+
+def make_fixture_channel(channel_path, num_packages, package_size, subdir='noarch'):
+    '''
+    Writes num_packages fixture packages into a channel.
+    Returns their paths relative to the channel's parent directory
+    (i.e. "<channel>/<subdir>/<fn>").
+    '''
+    channel = os.path.basename(channel_path)
+    subdir_path = os.path.join(channel_path, subdir)
+    return [f'{channel}/{subdir}/' + make_fixture_package(subdir_path, f'dojo-bench-{i:03d}', size=package_size)
+            for i in range(num_packages)]
+
+
+class CountingRequestHandler(SimpleHTTPRequestHandler):
+    '''
+    Serves files like `python -m http.server`, but counts the requests for
+    each path and can simulate network latency.
+    '''
+    def do_GET(self):
+        with self.server.lock:
+            self.server.request_counts[self.path] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        super().do_GET()
+
+    def do_HEAD(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        super().do_HEAD()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer:
+    '''
+    A local HTTP server (in a background thread) standing in for repo.anaconda.com.
+    '''
+    def __init__(self, directory, latency=0.0):
+        handler = partial(CountingRequestHandler, directory=directory)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.request_counts = Counter()
+        self.httpd.lock = threading.Lock()
+        self.httpd.latency = latency
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def request_counts(self):
+        return self.httpd.request_counts
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def make_feedstock_remote(remote_path, repo_name='dojo-bench-feedstock', num_commits=1, vendored_size=0):
+    '''
+    Creates a bare git repository (standing in for GitHub) holding a small
+    feedstock, with num_commits of history and, if vendored_size is given,
+    a vendored source file of that size (outside of recipe/) rewritten in
+    every commit. Returns (feedstock_url, commit).
+    '''
+    bare_path = os.path.join(remote_path, f'{repo_name}.git')
+    work_path = os.path.join(remote_path, f'{repo_name}-work')
+    bare_repo = Repo.init(bare_path, bare=True)
+    # Like GitHub: allow fetching commits by SHA, and partial clones.
+    with bare_repo.config_writer() as config:
+        config.set_value('uploadpack', 'allowAnySHA1InWant', 'true')
+        config.set_value('uploadpack', 'allowFilter', 'true')
+    repo = Repo.init(work_path)
+
+    recipe_path = os.path.join(work_path, 'recipe')
+    Path(recipe_path).mkdir(parents=True, exist_ok=True)
+    Path(os.path.join(work_path, 'vendor')).mkdir(exist_ok=True)
+    for i in range(num_commits):
+        with open(os.path.join(recipe_path, 'meta.yaml'), 'w') as f:
+            f.write(f'package:\n  name: dojo-bench\n  version: 1.{i}\n\nbuild:\n  number: 0\n  noarch: generic\n')
+        with open(os.path.join(work_path, 'README.md'), 'w') as f:
+            f.write('Feedstock for dojo benchmarks.\n')
+        paths = ['recipe/meta.yaml', 'README.md']
+        if vendored_size:
+            with open(os.path.join(work_path, 'vendor', 'source.bin'), 'wb') as f:
+                f.write(os.urandom(vendored_size))
+            paths.append('vendor/source.bin')
+        repo.index.add(paths)
+        commit = repo.index.commit(f'Version 1.{i}', author=BENCHMARK_ACTOR, committer=BENCHMARK_ACTOR)
+
+    repo.create_remote('origin', bare_path)
+    repo.git.push('origin', 'HEAD:refs/heads/main')
+    return Path(bare_path).as_uri(), commit.hexsha
+
+
+def get_dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, fn))
+               for root, _, fns in os.walk(path) for fn in fns
+               if not os.path.islink(os.path.join(root, fn)))
+
+
+def make_workspace(workspace_path, feedstock_url, commit, pkg_urls, lesson_name=BENCHMARK_LESSON_NAME,
+                   lesson_specs=None):
+    '''
+    Lays out a dojo root directory (lessons, training_feedstocks, curriculum)
+    with one lesson pointing at the stand-ins, plus its own HOME.
+    If lesson_specs (e.g. a real lesson's) are given, they're used for the
+    lesson, with its feedstock URL and commit rewritten to the stand-in's.
+    Returns the workspace's environment variables.
+    '''
+    lesson_path = os.path.join(workspace_path, 'lessons', lesson_name)
+    Path(lesson_path).mkdir(parents=True, exist_ok=True)
+    Path(os.path.join(workspace_path, 'training_feedstocks')).mkdir(exist_ok=True)
+    Path(os.path.join(workspace_path, 'home')).mkdir(exist_ok=True)
+
+    if lesson_specs is None:
+        lesson_specs = {
+            'title': 'Benchmark lesson',
+            'authors': ['dojo benchmark'],
+            'objectives': ['Time dojo itself.'],
+            'tags': ['benchmark'],
+            'target_package': 'dojo-bench-1.0',
+            'target_platform': 'noarch',
+            'prompts': ['Step one.', 'Step two.', 'Step three.'],
+        }
+    lesson_specs = dict(lesson_specs, feedstock_url=feedstock_url, commit=commit)
+    import yaml
+    with open(os.path.join(lesson_path, 'lesson.yaml'), 'w') as f:
+        yaml.safe_dump(lesson_specs, f)
+    with open(os.path.join(lesson_path, 'dojo_channels_pkgs.txt'), 'w') as f:
+        f.write(''.join(f'{url}\n' for url in pkg_urls))
+    with open(os.path.join(workspace_path, 'curriculum.yaml'), 'w') as f:
+        yaml.safe_dump({'topics': {'benchmark': [lesson_name]}}, f)
+
+    env = dict(os.environ)
+    env['HOME'] = os.path.join(workspace_path, 'home')
+    env['DOJO_PKGS_DIR'] = os.path.join(workspace_path, 'pkgs')
+    # Make `python -m dojo` work from the workspace, even if dojo isn't installed.
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+    return env
@@ -2,4 +2,25 @@ import os
 
 ROOT_DIR = os.getcwd()
 LESSONS_DIR = os.path.join(ROOT_DIR, 'lessons')
-TRAINING_FEEDSTOCKS_DIR = os.path.join(ROOT_DIR, 'training_feedstocks')
\ No newline at end of file
+TRAINING_FEEDSTOCKS_DIR = os.path.join(ROOT_DIR, 'training_feedstocks')
+
+# Extracted package cache (conda "pkgs_dirs") shared by all lesson builds.
+# Kept outside of the repo so that conda can hardlink from it into build envs.
+PKGS_CACHE_DIR = os.environ.get('DOJO_PKGS_DIR', os.path.join(os.path.expanduser('~'), '.dojo', 'pkgs'))
+PKGS_CACHE_MAX_BYTES = int(os.environ.get('DOJO_PKGS_CACHE_MAX_MB', 2048)) * 1024 * 1024
+
+# Host-level coordination of downloads and clones between learners (see dojo/coordinator.py).
+# Disabled unless DOJO_SHARED_DIR is set.
+SHARED_DIR = os.environ.get('DOJO_SHARED_DIR')
+SHARED_MAX_DOWNLOADS = max(int(os.environ.get('DOJO_SHARED_MAX_DOWNLOADS', 4)), 1)
+SHARED_MAX_BYTES_PER_SEC = float(os.environ.get('DOJO_SHARED_MAX_MBPS', 0)) * 1024 * 1024
+
+# Opt-in: transcode .tar.bz2 lesson packages into the (faster) .conda format on ingest.
+TRANSCODE_TO_CONDA = os.environ.get('DOJO_TRANSCODE_TO_CONDA', '').lower() in ('1', 'true', 'yes')
+
+# (For dev only) Append per-phase timings of dojo commands (one JSON object per line)
+# to this file. Used by `python -m benchmarks setup`.
+PHASE_TIMINGS_PATH = os.environ.get('DOJO_PHASE_TIMINGS')
+
+# Cumulative metrics (Prometheus text format) are written to this file, if set (see dojo/metrics.py).
+METRICS_PATH = os.environ.get('DOJO_METRICS_FILE')
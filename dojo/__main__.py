@@ -1,10 +1,28 @@
 import argparse
 import sys
-from dojo.utils import search_tag, show_lessons
+from dojo.utils import ChecksumMismatchError, CommitNotFoundError, search_tag, show_lessons, TABLE_FORMATS
+from dojo.verify import verify_packages
 from dojo.lesson import start, stop, step_previous, step_current, \
     step_next, step_jump, step_add_note, create_lesson, clean_history_and_progress
 
 
+def non_negative_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'not an integer: {value}')
+    if number < 0:
+        raise argparse.ArgumentTypeError(f'must not be negative: {value}')
+    return number
+
+
+def positive_int(value):
+    number = non_negative_int(value)
+    if number == 0:
+        raise argparse.ArgumentTypeError(f'must be at least 1: {value}')
+    return number
+
+
 def main():
     p = argparse.ArgumentParser(
             description='Conda-Build Dojo guides you through debugging scenarios encountered during package building.',
@@ -50,6 +68,43 @@ def main():
         help='Search lessons for this tag.',
         )
 
+    # Subcommand: notes
+    help_msg_notes = '''Search the notes you added (across all lessons).'''
+    subcmd_notes = subparsers.add_parser('notes', help=help_msg_notes)
+    notes_subparsers = subcmd_notes.add_subparsers(dest='notes')
+    help_msg_notes_search = '''Full-text search of your notes, best matches first.'''
+    subcmd_notes_search = notes_subparsers.add_parser('search', help=help_msg_notes_search)
+    subcmd_notes_search.add_argument(
+        'query',
+        help='Words to search for. Also supports e.g. "pip OR wheel" and "libstd*".',
+        nargs='+',
+        )
+
+    # Output options shared by: lessons, search, notes search
+    for subcmd in [subcmd_lessons, subcmd_search, subcmd_notes_search]:
+        subcmd.add_argument(
+            '--limit',
+            help='Show at most this many rows.',
+            type=positive_int,
+            )
+        subcmd.add_argument(
+            '--offset',
+            help='Skip this many rows before showing any (use with --limit to page through results).',
+            type=non_negative_int,
+            default=0,
+            )
+        subcmd.add_argument(
+            '--format',
+            help='Output format. "tsv" and "json" (one object per line) are meant for scripts.',
+            choices=TABLE_FORMATS,
+            default='grid',
+            )
+        subcmd.add_argument(
+            '--columns',
+            help='Comma-separated list of columns to show. For example: "title,lesson_name".',
+            type=lambda value: [col.strip() for col in value.split(',') if col.strip()],
+            )
+
     # Subcommand: start
     help_msg_start = '''Start a lesson.'''
     subcmd_start = subparsers.add_parser('start', help=help_msg_start)
@@ -57,6 +112,32 @@ def main():
         'lesson_name',
         help='Name of lesson to start.',
         )
+    subcmd_start.add_argument(
+        '--plan',
+        help='Show the setup steps that would run (and their estimated cost) without running them.',
+        action='store_true',
+        )
+    subcmd_start.add_argument(
+        '--background',
+        help='Show the first step right away, and set up the lesson in the background. '
+             'Steps that need the setup wait for it when you reach them.',
+        action='store_true',
+        )
+
+    # Subcommand: status
+    help_msg_status = '''Show the progress of a lesson's background setup.'''
+    subcmd_status = subparsers.add_parser('status', help=help_msg_status)
+    subcmd_status.add_argument(
+        'lesson_name',
+        help='Name of the lesson (default: the current lesson).',
+        nargs='?',
+        )
+    subcmd_status.add_argument(
+        '-f',
+        '--follow',
+        help='Keep showing the progress until the setup is done.',
+        action='store_true',
+        )
 
     # Subcommand: stop
     help_msg_stop = '''Stop the current lesson.'''
@@ -118,6 +199,101 @@ def main():
         help='Short name of the lesson (use underscores instead of spaces). For example: "creating_a_patch".',
         )
 
+    # Subcommand: author
+    help_msg_author = '''(For lesson authors) Validate a lesson and preview its prompts.'''
+    subcmd_author = subparsers.add_parser('author', help=help_msg_author)
+    subcmd_author.add_argument(
+        'lesson_name',
+        help='Name of lesson to validate and preview.',
+        )
+    subcmd_author.add_argument(
+        '--watch',
+        help='Keep watching the lesson (and curriculum.yaml) and update the preview on every change.',
+        action='store_true',
+        )
+    subcmd_author.add_argument(
+        '--pin-checksums',
+        help='Download the lesson\'s dojo_channels packages and add their sha256 to dojo_channels_pkgs.txt.',
+        action='store_true',
+        )
+
+    # Subcommand: verify
+    help_msg_verify = '''Re-hash all cached package archives and report any that are corrupt.'''
+    subcmd_verify = subparsers.add_parser('verify', help=help_msg_verify)
+    subcmd_verify.add_argument(
+        '-j',
+        '--jobs',
+        help='Number of archives to hash in parallel (default: number of CPUs).',
+        type=positive_int,
+        )
+
+    # Subcommand: run-lessons
+    help_msg_run_lessons = '''(For dev only) Check that lessons still reproduce, by running the "checks" in their lesson.yaml.'''
+    subcmd_run_lessons = subparsers.add_parser('run-lessons', help=help_msg_run_lessons)
+    subcmd_run_lessons.add_argument(
+        'lesson_names',
+        help='Names of lessons to run (default: every lesson that has checks).',
+        nargs='*',
+        )
+    subcmd_run_lessons.add_argument(
+        '-j',
+        '--jobs',
+        help='Number of lessons to run in parallel (default: number of CPUs).',
+        type=positive_int,
+        )
+    subcmd_run_lessons.add_argument(
+        '--timeout',
+        help='Maximum time for each lesson (setup and checks), in seconds.',
+        type=float,
+        default=1800,
+        )
+    subcmd_run_lessons.add_argument(
+        '--junit',
+        help='Write a JUnit XML report to this path.',
+        )
+    subcmd_run_lessons.add_argument(
+        '--json',
+        help='Write a JSON report to this path.',
+        )
+    subcmd_run_lessons.add_argument(
+        '--workdir',
+        help='Create the lessons\' workspaces in this directory (default: the system\'s temp directory).',
+        )
+    subcmd_run_lessons.add_argument(
+        '--keep',
+        help='Keep the lessons\' workspaces (e.g. to debug a failing check).',
+        action='store_true',
+        )
+
+    # Subcommand: state
+    help_msg_state = '''(For training coordinators) Work with learner state collected from many containers.'''
+    subcmd_state = subparsers.add_parser('state', help=help_msg_state)
+    state_subparsers = subcmd_state.add_subparsers(dest='state')
+    help_msg_state_merge = '''Merge collected history.csv and progress.csv files into one deduplicated record per learner.'''
+    subcmd_state_merge = state_subparsers.add_parser('merge', help=help_msg_state_merge)
+    subcmd_state_merge.add_argument(
+        'input_dirs',
+        help='Directories of collected state, with one subdirectory per learner '
+             '(e.g. collected/<learner>/<export>/history.csv).',
+        nargs='+',
+        )
+    subcmd_state_merge.add_argument(
+        '-o',
+        '--output',
+        help='Directory to write each learner\'s merged history.csv and progress.csv files to.',
+        required=True,
+        )
+    subcmd_state_merge.add_argument(
+        '--max-events-in-memory',
+        help='Number of events to sort in memory at a time (the rest is merged from disk).',
+        type=int,
+        default=500000,
+        )
+    subcmd_state_merge.add_argument(
+        '--tmpdir',
+        help='Directory for the temporary sorted runs (default: the system\'s temp directory).',
+        )
+
     # Subcommand: clean
     help_msg_clean = '''(For dev only) Delete all progress.csv files and history.csv.'''
     subcmd_history = subparsers.add_parser('clean', help=help_msg_clean)
@@ -135,13 +311,30 @@ def main():
             status = 'authors'
         else:
             status = 'all'
-        show_lessons(status=status)
+        show_lessons(status=status, fmt=args.format, limit=args.limit, offset=args.offset, columns=args.columns)
 
     elif args.subcommand == 'search':
-        search_tag(args.tag)
+        search_tag(args.tag, fmt=args.format, limit=args.limit, offset=args.offset, columns=args.columns)
+
+    elif args.subcommand == 'notes':
+        if args.notes == 'search':
+            from dojo.notes import search_notes
+            search_notes(' '.join(args.query), fmt=args.format, limit=args.limit, offset=args.offset,
+                         columns=args.columns)
+        else:
+            subcmd_notes.print_help()
+            sys.exit(1)
 
     elif args.subcommand == 'start':
-        start(args.lesson_name)
+        try:
+            start(args.lesson_name, plan_only=args.plan, background=args.background)
+        except (ChecksumMismatchError, CommitNotFoundError) as e:
+            print(f'ERROR: {e}')
+            sys.exit(1)
+
+    elif args.subcommand == 'status':
+        from dojo.background import show_status
+        show_status(args.lesson_name, follow=args.follow)
 
     elif args.subcommand == 'p':
         step_previous(verbose=args.verbose)
@@ -168,6 +361,31 @@ def main():
             sys.exit(1)
         create_lesson(args.name, args.target_platform)
 
+    elif args.subcommand == 'author':
+        from dojo.author import author_lesson
+        try:
+            author_lesson(args.lesson_name, watch=args.watch, pin=args.pin_checksums)
+        except ChecksumMismatchError as e:
+            print(f'ERROR: {e}')
+            sys.exit(1)
+
+    elif args.subcommand == 'verify':
+        verify_packages(jobs=args.jobs)
+
+    elif args.subcommand == 'run-lessons':
+        from dojo.runner import run_lessons
+        run_lessons(args.lesson_names, jobs=args.jobs, timeout=args.timeout, junit_path=args.junit,
+                    json_path=args.json, workdir=args.workdir, keep=args.keep)
+
+    elif args.subcommand == 'state':
+        if args.state == 'merge':
+            from dojo.state import merge_state
+            merge_state(args.input_dirs, args.output, max_events_in_memory=args.max_events_in_memory,
+                        tmp_dir=args.tmpdir)
+        else:
+            subcmd_state.print_help()
+            sys.exit(1)
+
     elif args.subcommand == 'clean':
         clean_history_and_progress()
 
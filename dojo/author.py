@@ -0,0 +1,372 @@
+'''
+Tools for lesson authors (`dojo author`).
+
+Validates a lesson and previews its prompts without starting it. In watch
+mode, it re-validates on every change to the lesson directory or
+curriculum.yaml, re-renders only the prompts that changed, and re-syncs
+dojo_channels only when dojo_channels_pkgs.txt changed.
+'''
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import select
+import struct
+import sys
+import time
+import yaml
+from colorama import Fore, Style
+from dojo import ROOT_DIR, LESSONS_DIR
+
+
+REQUIRED_LESSON_KEYS = {
+    'title': str,
+    'authors': list,
+    'objectives': list,
+    'tags': list,
+    'target_package': str,
+    'target_platform': str,
+    'feedstock_url': str,
+    'commit': str,
+    'prompts': list,
+}
+
+# inotify(7) event masks.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+# How long to wait for more events after a change (e.g. editors that write, then rename).
+DEBOUNCE_SECONDS = 0.05
+POLL_INTERVAL = 0.2
+
+
+##################
+#    WATCHING    #
+##################
+
+class InotifyWatcher:
+    '''
+    Watches directories with inotify (via libc, so there's no extra dependency).
+    '''
+    def __init__(self, dirs):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wd_to_dir = {}
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        for path in dirs:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+            self.wd_to_dir[wd] = path
+
+    def read_events(self):
+        changed = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, _, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b'\0').decode()
+            offset += name_len
+            if wd in self.wd_to_dir and name:
+                changed.add(os.path.join(self.wd_to_dir[wd], name))
+        return changed
+
+    def wait(self):
+        '''
+        Blocks until something changes. Returns the set of changed paths.
+        '''
+        select.select([self.fd], [], [])
+        changed = self.read_events()
+        while select.select([self.fd], [], [], DEBOUNCE_SECONDS)[0]:
+            changed |= self.read_events()
+        return changed
+
+
+class PollingWatcher:
+    '''
+    Fallback for platforms without inotify: compares file mtimes.
+    '''
+    def __init__(self, paths):
+        self.paths = paths
+        self.mtimes = self.get_mtimes()
+
+    def get_mtimes(self):
+        mtimes = {}
+        for path in self.paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtimes[path] = None
+        return mtimes
+
+    def wait(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            mtimes = self.get_mtimes()
+            changed = {path for path in self.paths if mtimes[path] != self.mtimes[path]}
+            self.mtimes = mtimes
+            if changed:
+                return changed
+
+
+def make_watcher(lesson_path, watched_paths):
+    try:
+        return InotifyWatcher(sorted({lesson_path, ROOT_DIR}))
+    except (OSError, AttributeError, TypeError):
+        print('(inotify is not available; watching for changes by polling instead.)')
+        return PollingWatcher(watched_paths)
+
+
+####################
+#    VALIDATION    #
+####################
+
+def validate_lesson(lesson_name):
+    '''
+    Checks the lesson.yaml (and the lesson's place in curriculum.yaml).
+    Returns (lesson_specs, errors, warnings). lesson_specs is None if
+    the lesson.yaml can't be loaded.
+    '''
+    errors = []
+    warnings = []
+    lesson_yaml_path = os.path.join(LESSONS_DIR, lesson_name, 'lesson.yaml')
+    try:
+        with open(lesson_yaml_path) as f:
+            lesson_specs = yaml.safe_load(f)
+    except FileNotFoundError:
+        return None, [f'lesson.yaml not found: {lesson_yaml_path}'], warnings
+    except yaml.YAMLError as e:
+        return None, [f'lesson.yaml is not valid YAML:\n{e}'], warnings
+
+    if not isinstance(lesson_specs, dict):
+        return None, ['lesson.yaml should be a mapping of keys to values.'], warnings
+
+    for key, expected_type in REQUIRED_LESSON_KEYS.items():
+        value = lesson_specs.get(key)
+        if value in (None, '', []):
+            errors.append(f'"{key}" is missing or empty.')
+        elif not isinstance(value, expected_type):
+            errors.append(f'"{key}" should be a {expected_type.__name__}, not a {type(value).__name__}.')
+
+    prompts = lesson_specs.get('prompts')
+    if isinstance(prompts, list):
+        for i, prompt in enumerate(prompts):
+            if not isinstance(prompt, str) or not prompt.strip():
+                errors.append(f'Prompt {i + 1} should be non-empty text.')
+            elif 'EXAMPLE' in prompt:
+                warnings.append(f'Prompt {i + 1} still contains template text ("EXAMPLE").')
+
+    checks = lesson_specs.get('checks')
+    if checks is not None and not isinstance(checks, list):
+        errors.append('"checks" should be a list.')
+    elif checks:
+        from dojo.runner import get_check_problems
+        for i, check in enumerate(checks):
+            for problem in get_check_problems(check):
+                errors.append(f'Check {i + 1}: {problem}.')
+
+    for key in ('feedstock_needed_from_step', 'channels_needed_from_step'):
+        value = lesson_specs.get(key)
+        if value is None:
+            continue
+        if not isinstance(value, int) or isinstance(value, bool):
+            errors.append(f'"{key}" should be a step number.')
+        elif isinstance(prompts, list) and not 1 <= value <= len(prompts):
+            errors.append(f'"{key}" should be between 1 and {len(prompts)} (the number of prompts).')
+
+    feedstock_url = lesson_specs.get('feedstock_url')
+    if isinstance(feedstock_url, str) and feedstock_url.startswith('git@'):
+        warnings.append('"feedstock_url" should use HTTPS, not SSH (learners may not have a key).')
+
+    # The lesson should be listed in the curriculum.
+    curriculum_yaml_path = os.path.join(ROOT_DIR, 'curriculum.yaml')
+    try:
+        with open(curriculum_yaml_path) as f:
+            curriculum_specs = yaml.safe_load(f) or {}
+        topics = curriculum_specs.get('topics') or {}
+        if not any(lesson_name in (lessons or []) for lessons in topics.values()):
+            warnings.append('The lesson is not listed under any topic in curriculum.yaml yet.')
+    except FileNotFoundError:
+        errors.append('curriculum.yaml not found.')
+    except yaml.YAMLError as e:
+        errors.append(f'curriculum.yaml is not valid YAML:\n{e}')
+
+    return lesson_specs, errors, warnings
+
+
+def print_validation(errors, warnings):
+    for error in errors:
+        print(Fore.RED + f'ERROR: {error}' + Style.RESET_ALL)
+    for warning in warnings:
+        print(Fore.YELLOW + f'WARNING: {warning}' + Style.RESET_ALL)
+    if not errors and not warnings:
+        print(Fore.GREEN + 'lesson.yaml looks good.' + Style.RESET_ALL)
+
+
+####################
+#    PREVIEWING    #
+####################
+
+def hash_prompt_context(lesson_specs):
+    '''
+    Hashes what the prompts show besides their own text (the title, and the
+    details shown with the first step), so all prompts get re-rendered if
+    it changes.
+    '''
+    context = [lesson_specs.get(key) for key in ('title', 'objectives', 'feedstock_url')]
+    return hashlib.sha256(repr(context).encode()).hexdigest()
+
+
+def render_prompts(lesson_name, lesson_specs, previous_prompts=None):
+    '''
+    Renders the prompts that differ from previous_prompts (all of them if
+    there are none). Returns the prompts that were checked.
+    '''
+    from dojo.lesson import display_prompt
+
+    prompts = lesson_specs['prompts']
+    changed = [i for i, prompt in enumerate(prompts)
+               if previous_prompts is None or i >= len(previous_prompts) or previous_prompts[i] != prompt]
+    for i in changed:
+        display_prompt(lesson_name, lesson_specs, i, verbose=(i == 0), show_notes=False)
+    if previous_prompts is not None:
+        if len(previous_prompts) > len(prompts):
+            print(f'Removed step(s) {len(prompts) + 1}-{len(previous_prompts)}.')
+        if not changed:
+            print('No prompts changed.')
+    return prompts
+
+
+def sync_dojo_channels(lesson_name):
+    '''
+    Brings the lesson's dojo_channels in line with its dojo_channels_pkgs.txt
+    (only downloading or removing what changed). `conda index` takes seconds,
+    so it's left to the next `dojo start`, whose setup plan sees the stale
+    repodata and indexes just the changed channels.
+    '''
+    from dojo.lesson import plan_setup
+    from dojo.manifest import load_manifest, save_manifest
+
+    manifest = load_manifest(lesson_name)
+    steps = plan_setup(lesson_name, manifest)
+    packages_steps = [step for step in steps if step.name == 'packages']
+    if not packages_steps:
+        print('dojo_channels packages are up to date.')
+    for step in packages_steps:
+        step.run()
+        save_manifest(lesson_name, manifest)
+    if any(step.name == 'index' for step in plan_setup(lesson_name, manifest)):
+        print(f'dojo_channels will be re-indexed on the next `dojo start {lesson_name}`.')
+
+
+def pin_checksums(lesson_name):
+    '''
+    Appends the sha256 of each package to its URL in dojo_channels_pkgs.txt
+    (unless the line already has a checksum), so learners' setups verify
+    their downloads without looking them up in the upstream repodata.
+    The checksums are those of the packages synced to dojo_channels.
+    '''
+    from dojo.lesson import get_desired_packages
+    from dojo.manifest import load_manifest
+    from dojo.utils import parse_package_url
+
+    if not get_desired_packages(lesson_name):
+        print('The lesson has no dojo_channels_pkgs.txt (or it is empty); nothing to pin.')
+        return
+    sync_dojo_channels(lesson_name)
+    manifest = load_manifest(lesson_name)
+
+    pkgs_path = os.path.join(LESSONS_DIR, lesson_name, 'dojo_channels_pkgs.txt')
+    with open(pkgs_path) as f:
+        lines = f.read().splitlines()
+    num_pinned = 0
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        url, sha256, md5 = parse_package_url(line)
+        recorded = manifest['packages'].get('/'.join(url.strip().split('/')[-3:]))
+        if not (sha256 or md5) and recorded:
+            lines[i] = f'{url.strip()}#{recorded["sha256"]}'
+            num_pinned += 1
+    if num_pinned:
+        with open(pkgs_path, 'w') as f:
+            f.writelines(f'{line}\n' for line in lines)
+    print(f'Pinned the sha256 of {num_pinned} package(s) in dojo_channels_pkgs.txt.')
+
+
+def author_lesson(lesson_name, watch=False, pin=False):
+    '''
+    Validates the lesson and previews its prompts. With watch, keeps doing
+    so (incrementally) whenever the lesson or curriculum.yaml changes.
+    With pin, first pins the checksums in dojo_channels_pkgs.txt.
+    '''
+    lesson_path = os.path.join(LESSONS_DIR, lesson_name)
+    if not os.path.isdir(lesson_path):
+        print(f'ERROR: Lesson not found: {lesson_path}')
+        sys.exit(1)
+
+    lesson_yaml_path = os.path.join(lesson_path, 'lesson.yaml')
+    pkgs_path = os.path.join(lesson_path, 'dojo_channels_pkgs.txt')
+    curriculum_yaml_path = os.path.join(ROOT_DIR, 'curriculum.yaml')
+
+    lesson_specs, errors, warnings = validate_lesson(lesson_name)
+    print_validation(errors, warnings)
+    previous_prompts = None
+    previous_context = None
+    if lesson_specs is not None and not errors:
+        previous_prompts = render_prompts(lesson_name, lesson_specs)
+        previous_context = hash_prompt_context(lesson_specs)
+
+    if pin:
+        pin_checksums(lesson_name)
+
+    if not watch:
+        if errors:
+            sys.exit(1)
+        return
+
+    watched_paths = [lesson_yaml_path, pkgs_path, curriculum_yaml_path]
+    watcher = make_watcher(lesson_path, watched_paths)
+    print(f'\nWatching {lesson_path} and curriculum.yaml for changes (Ctrl-C to stop)...')
+    try:
+        while True:
+            changed = watcher.wait() & set(watched_paths)
+            if not changed:
+                continue
+            start_time = time.monotonic()
+            names = ', '.join(sorted(os.path.basename(path) for path in changed))
+            print(Fore.MAGENTA + f'\n--- Changed: {names} ---' + Style.RESET_ALL)
+
+            # A problem with this change (e.g. a half-written package list, or a
+            # failed download) is reported, and the next change tries again.
+            try:
+                if changed & {lesson_yaml_path, curriculum_yaml_path}:
+                    lesson_specs, errors, warnings = validate_lesson(lesson_name)
+                    print_validation(errors, warnings)
+                    if lesson_specs is not None and not errors:
+                        context = hash_prompt_context(lesson_specs)
+                        if context != previous_context:
+                            previous_prompts = None
+                        previous_prompts = render_prompts(lesson_name, lesson_specs, previous_prompts)
+                        previous_context = context
+
+                if pkgs_path in changed:
+                    if lesson_specs is not None and not errors:
+                        sync_dojo_channels(lesson_name)
+                    else:
+                        print('Not syncing dojo_channels until lesson.yaml is fixed.')
+            except SystemExit:
+                print_validation(['The update stopped early (see above). Still watching.'], [])
+            except Exception as e:
+                print_validation([f'{type(e).__name__}: {e}. Still watching.'], [])
+
+            print(f'(Updated in {time.monotonic() - start_time:.2f} s)')
+    except KeyboardInterrupt:
+        print('\nStopped watching.')
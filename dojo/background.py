@@ -0,0 +1,282 @@
+'''
+Background lesson setup (`dojo start --background`) and `dojo status`.
+
+The setup runs in a detached worker process (`python -m dojo.background
+<lesson_name>`), which records its progress, phase by phase, in the lesson's
+setup_status.json. Meanwhile, the learner can go through the lesson's first
+steps. A step only waits for the setup once it's reached, and only if the
+lesson says that step needs it (see `feedstock_needed_from_step` and
+`channels_needed_from_step` in the lesson.yaml template).
+'''
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from colorama import Fore, Style
+from dojo import ROOT_DIR, LESSONS_DIR
+from dojo.coordinator import file_lock
+from tabulate import tabulate
+
+
+STATUS_FILENAME = 'setup_status.json'
+LOG_FILENAME = 'setup.log'
+LOCK_FILENAME = 'setup.lock'
+POLL_INTERVAL = 0.5
+# How long a worker may take to report in, before it's considered to have failed to start.
+WORKER_START_TIMEOUT = 30
+
+
+def get_lesson_file_path(lesson_name, fn):
+    return os.path.join(LESSONS_DIR, lesson_name, fn)
+
+
+def get_setup_lock_path(lesson_name):
+    '''
+    Held by whichever process is setting up the lesson (the background
+    worker, or `dojo start` in the foreground).
+    '''
+    return get_lesson_file_path(lesson_name, LOCK_FILENAME)
+
+
+def load_status(lesson_name):
+    '''
+    Returns the lesson's background setup status, or None if it has none.
+    '''
+    try:
+        with open(get_lesson_file_path(lesson_name, STATUS_FILENAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_status(lesson_name, status):
+    status['updated'] = time.time()
+    status_path = get_lesson_file_path(lesson_name, STATUS_FILENAME)
+    tmp_path = f'{status_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_path, status_path)
+
+
+def clear_status(lesson_name):
+    for fn in (STATUS_FILENAME, LOG_FILENAME):
+        path = get_lesson_file_path(lesson_name, fn)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def is_running(status):
+    '''
+    Whether the worker is (still) working on the setup.
+    '''
+    if status['state'] == 'starting':
+        return time.time() - status['started'] < WORKER_START_TIMEOUT \
+            and (status['pid'] is None or is_alive(status['pid']))
+    return status['state'] == 'running' and is_alive(status['pid'])
+
+
+def start_background_setup(lesson_name):
+    '''
+    Launches the setup in a detached worker, and returns right away.
+    The worker's pid is recorded (so it can be stopped while it's still
+    starting) before it starts on the setup.
+    '''
+    status = {'lesson_name': lesson_name, 'state': 'starting', 'pid': None,
+              'started': time.time(), 'phases': [], 'error': None}
+    save_status(lesson_name, status)
+    with open(get_lesson_file_path(lesson_name, LOG_FILENAME), 'w') as log:
+        worker = subprocess.Popen([sys.executable, '-m', 'dojo.background', lesson_name], cwd=ROOT_DIR,
+                                  stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                  start_new_session=True)
+    status['pid'] = worker.pid
+    save_status(lesson_name, status)
+    print(f'Setting up "{lesson_name}" in the background. Run `dojo status` to see its progress.')
+
+
+def run_worker(lesson_name):
+    '''
+    (In the worker process.) Runs the setup, recording each phase's progress.
+    '''
+    from dojo.lesson import setup_feedstock_and_condarc
+
+    with file_lock(get_setup_lock_path(lesson_name)):
+        # Wait for `dojo start` to record this worker's pid.
+        deadline = time.time() + WORKER_START_TIMEOUT
+        status = load_status(lesson_name)
+        while status and status['state'] == 'starting' and status['pid'] is None and time.time() < deadline:
+            time.sleep(POLL_INTERVAL / 10)
+            status = load_status(lesson_name)
+        if status is None or status['state'] != 'starting' or status['pid'] != os.getpid():
+            # The setup was cancelled (or done in the foreground) before this worker got to it.
+            return
+        status.update(state='running', phases=[], error=None)
+        save_status(lesson_name, status)
+
+        def on_progress(steps, step, state):
+            if step is None:
+                status['phases'] = [{'name': s.name, 'description': s.description, 'state': 'pending',
+                                     'started': None, 'seconds': None} for s in steps]
+            else:
+                phase = next(phase for phase in status['phases'] if phase['name'] == step.name)
+                phase['state'] = state
+                if state == 'running':
+                    phase['started'] = time.time()
+                else:
+                    phase['seconds'] = time.time() - phase['started']
+            save_status(lesson_name, status)
+
+        try:
+            setup_feedstock_and_condarc(lesson_name, on_progress=on_progress)
+        except BaseException as e:
+            for phase in status['phases']:
+                if phase['state'] == 'running':
+                    phase['state'] = 'failed'
+                    phase['seconds'] = time.time() - phase['started']
+            status['state'] = 'failed'
+            status['error'] = str(e) or type(e).__name__
+            if isinstance(e, SystemExit):
+                status['error'] = f'Setup exited with status {e.code}.'
+            save_status(lesson_name, status)
+            raise
+
+        status['state'] = 'done'
+        save_status(lesson_name, status)
+
+
+def cancel_background_setup(lesson_name):
+    '''
+    Stops the lesson's background setup if it's still starting or running.
+    '''
+    status = load_status(lesson_name)
+    if status and status['state'] in ('starting', 'running') and status['pid'] and is_alive(status['pid']):
+        print('Stopping the background setup...')
+        try:
+            os.killpg(status['pid'], signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        # Wait for it to let go of the lesson.
+        with file_lock(get_setup_lock_path(lesson_name)):
+            pass
+    clear_status(lesson_name)
+
+
+def get_needed_from_step(lesson_specs, key):
+    '''
+    The (1-based) step from which the lesson needs that part of its setup.
+    Defaults to the first step.
+    '''
+    return int(lesson_specs.get(key) or 1)
+
+
+def wait_for_setup(lesson_name, lesson_specs, step_index):
+    '''
+    Blocks until the background setup has finished whatever the step needs
+    (the feedstock snapshot and/or dojo_channels). Returns right away if
+    there's no background setup, or if the step doesn't need it yet.
+    '''
+    status = load_status(lesson_name)
+    if status is None or status['state'] == 'done':
+        return
+
+    step_number = step_index + 1
+    needs_feedstock = step_number >= get_needed_from_step(lesson_specs, 'feedstock_needed_from_step')
+    needs_channels = step_number >= get_needed_from_step(lesson_specs, 'channels_needed_from_step')
+    if not (needs_feedstock or needs_channels):
+        return
+
+    waiting = False
+    while True:
+        if status['state'] == 'done':
+            break
+        if status['state'] == 'running' and not needs_channels:
+            feedstock_phases = [phase for phase in status['phases'] if phase['name'] == 'feedstock']
+            if status['phases'] and all(phase['state'] == 'done' for phase in feedstock_phases):
+                break
+        if status['state'] == 'failed' or not is_running(status):
+            print(Fore.RED + f'The background setup of "{lesson_name}" did not finish: '
+                  f'{status.get("error") or "the worker stopped unexpectedly."}' + Style.RESET_ALL)
+            print(f'See {get_lesson_file_path(lesson_name, LOG_FILENAME)}, then run `dojo start {lesson_name}` '
+                  'to finish setting it up.')
+            sys.exit(1)
+
+        if not waiting:
+            needed = 'dojo_channels' if needs_channels else 'feedstock snapshot'
+            print(f'Step {step_number} needs the lesson\'s {needed}, which is still being set up. Waiting...')
+            print('(Run `dojo status` in another terminal to see the progress.)')
+            waiting = True
+        time.sleep(POLL_INTERVAL)
+        status = load_status(lesson_name)
+        if status is None:
+            # The lesson was stopped (or set up again in the foreground).
+            break
+
+    if waiting:
+        print('...setup is ready.')
+
+
+def format_seconds(seconds):
+    return '' if seconds is None else f'{seconds:.1f} s'
+
+
+def print_status(lesson_name, status):
+    elapsed = (status['updated'] if status['state'] in ('done', 'failed') else time.time()) - status['started']
+    state = status['state']
+    if state in ('starting', 'running') and not is_running(status):
+        state = 'stopped unexpectedly'
+    print(f'Setup of "{lesson_name}": {state} ({format_seconds(elapsed)})')
+
+    rows = []
+    for phase in status['phases']:
+        seconds = phase['seconds']
+        if phase['state'] == 'running':
+            seconds = time.time() - phase['started']
+        rows.append([phase['name'], phase['description'], phase['state'], format_seconds(seconds)])
+    if rows:
+        print(tabulate(rows, headers=['Phase', 'Description', 'State', 'Time'], tablefmt='simple'))
+    elif state == 'done':
+        print('Everything was already set up.')
+    if status.get('error'):
+        print(Fore.RED + f'Error: {status["error"]}' + Style.RESET_ALL)
+    if state in ('failed', 'stopped unexpectedly'):
+        print(f'Log: {get_lesson_file_path(lesson_name, LOG_FILENAME)}')
+
+
+def show_status(lesson_name=None, follow=False):
+    '''
+    Shows the progress of the lesson's background setup (by default, the
+    current lesson's). With follow, keeps showing it until the setup ends.
+    '''
+    if lesson_name is None:
+        from dojo.utils import get_latest
+        lesson_name, _ = get_latest()
+
+    status = load_status(lesson_name)
+    if status is None:
+        print(f'"{lesson_name}" has no background setup in progress.')
+        return
+
+    while True:
+        print_status(lesson_name, status)
+        if not follow or not is_running(status):
+            break
+        time.sleep(POLL_INTERVAL * 2)
+        status = load_status(lesson_name)
+        if status is None:
+            break
+        print()
+
+
+if __name__ == '__main__':
+    run_worker(sys.argv[1])
@@ -0,0 +1,383 @@
+'''
+Shared, pre-seeded conda package cache (pkgs_dirs) for lesson builds.
+
+Every lesson build creates environments out of the same handful of packages
+(python, openssl, ncurses, etc.), which dojo has already downloaded into
+dojo_channels. Seeding conda's package cache with those archives (extracted)
+means `conda build` can hardlink them instead of decompressing them again.
+'''
+import fcntl
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from dojo import PKGS_CACHE_DIR, PKGS_CACHE_MAX_BYTES, TRANSCODE_TO_CONDA
+from dojo import metrics
+from pathlib import Path
+
+
+ARCHIVE_EXTENSIONS = ('.conda', '.tar.bz2')
+LAST_USED_FILENAME = '.dojo_last_used.json'
+LOCK_FILENAME = '.dojo.lock'
+
+
+def strip_archive_extension(fn):
+    '''
+    Returns the dist name of a package archive, e.g.
+    "python-3.9.2-hdb3f193_0.conda" -> "python-3.9.2-hdb3f193_0"
+    '''
+    for ext in ARCHIVE_EXTENSIONS:
+        if fn.endswith(ext):
+            return fn[:-len(ext)]
+    return fn
+
+
+def link_or_copy(src, dst):
+    '''
+    Hardlinks src to dst, falling back to a copy if they are not
+    on the same filesystem.
+    '''
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def extract_package(archive_path, extracted_dir):
+    '''
+    Extracts a package archive into the cache.
+    Returns False if conda-package-handling isn't available, in which
+    case conda will extract the archive itself on first use.
+    '''
+    try:
+        from conda_package_handling import api as cph_api
+    except ImportError:
+        return False
+
+    # Another lesson may be extracting the same package at the same time;
+    # whichever finishes first wins.
+    tmp_dir = f'{extracted_dir}.{os.getpid()}.partial'
+    try:
+        cph_api.extract(archive_path, dest_dir=tmp_dir)
+        os.rename(tmp_dir, extracted_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isdir(extracted_dir):
+            raise
+    return True
+
+
+@lru_cache(maxsize=None)
+def has_package_handling():
+    '''
+    Whether conda-package-handling (needed to transcode packages) is installed.
+    '''
+    try:
+        import conda_package_handling.api  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+@lru_cache(maxsize=None)
+def can_transcode():
+    '''
+    Whether .tar.bz2 packages should be transcoded to .conda on ingest
+    (opt-in with DOJO_TRANSCODE_TO_CONDA=1, and needs conda-package-handling).
+    '''
+    if not TRANSCODE_TO_CONDA:
+        return False
+    if not has_package_handling():
+        print('WARNING: DOJO_TRANSCODE_TO_CONDA is set, but conda-package-handling is not installed. '
+              'Packages will not be transcoded.')
+        return False
+    return True
+
+
+def get_transcoded_fn(fn):
+    '''
+    "iniconfig-1.1.1-pyhd3eb1b0_0.tar.bz2" -> "iniconfig-1.1.1-pyhd3eb1b0_0.conda"
+    '''
+    return strip_archive_extension(fn) + '.conda'
+
+
+def transcode_to_conda(archive_path):
+    '''
+    Transcodes a .tar.bz2 package into a .conda package (same contents, zstd
+    compressed) next to it, then removes the .tar.bz2.
+    Returns the path of the .conda package.
+    '''
+    from conda_package_handling import api as cph_api
+
+    out_folder = os.path.dirname(archive_path)
+    conda_path = os.path.join(out_folder, get_transcoded_fn(os.path.basename(archive_path)))
+    if os.path.exists(conda_path):
+        os.remove(conda_path)
+    cph_api.transmute(archive_path, '.conda', out_folder=out_folder)
+    if not os.path.exists(conda_path):
+        raise RuntimeError(f'Could not transcode {archive_path}')
+    os.remove(archive_path)
+    return conda_path
+
+
+def transcode_packages(archive_paths, jobs=None):
+    '''
+    Transcodes .tar.bz2 packages to .conda in parallel across cores.
+    Returns {archive_path: conda_path} (empty if conda-package-handling
+    isn't installed, in which case the packages are left as they are).
+    '''
+    if not archive_paths:
+        return {}
+    if not has_package_handling():
+        print('WARNING: conda-package-handling is not installed. Skipping transcoding to .conda.')
+        return {}
+    print(f'Transcoding {len(archive_paths)} .tar.bz2 package(s) to .conda...')
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        return dict(zip(archive_paths, executor.map(transcode_to_conda, archive_paths)))
+
+
+def load_channel_repodata(subdir_path):
+    '''
+    Returns the package records from a dojo channel subdir's repodata.json
+    (written by `conda index`), keyed by filename.
+    '''
+    repodata_path = os.path.join(subdir_path, 'repodata.json')
+    if not os.path.exists(repodata_path):
+        return {}
+    with open(repodata_path) as f:
+        repodata = json.load(f)
+    records = {}
+    records.update(repodata.get('packages', {}))
+    records.update(repodata.get('packages.conda', {}))
+    return records
+
+
+def write_repodata_record(extracted_dir, record, channel_url, subdir, fn):
+    '''
+    Writes info/repodata_record.json so conda recognizes the extracted package
+    as coming from the lesson's dojo channel.
+    '''
+    record = dict(record)
+    record['channel'] = channel_url
+    record['subdir'] = subdir
+    record['fn'] = fn
+    record['url'] = f'{channel_url}/{subdir}/{fn}'
+    info_dir = os.path.join(extracted_dir, 'info')
+    Path(info_dir).mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(info_dir, 'repodata_record.json'), 'w') as f:
+        json.dump(record, f, indent=2, sort_keys=True)
+
+
+@contextmanager
+def cache_lock():
+    '''
+    Holds an exclusive flock on the cache, so concurrent lessons take turns
+    updating its bookkeeping (.dojo_last_used.json and urls.txt) and evicting.
+    '''
+    Path(PKGS_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(PKGS_CACHE_DIR, LOCK_FILENAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_atomically(path, text):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def load_last_used():
+    '''
+    Returns {dist: timestamp} of when each cached package was last used by a lesson.
+    '''
+    last_used_path = os.path.join(PKGS_CACHE_DIR, LAST_USED_FILENAME)
+    if not os.path.exists(last_used_path):
+        return {}
+    try:
+        with open(last_used_path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_last_used(last_used):
+    '''
+    Call with the cache_lock held (after loading, then updating, last_used).
+    '''
+    write_atomically(os.path.join(PKGS_CACHE_DIR, LAST_USED_FILENAME),
+                     json.dumps(last_used, indent=2, sort_keys=True))
+
+
+def mark_used(dists, urls):
+    '''
+    Records that a lesson just used the given packages (for eviction), and
+    adds any new URLs to the cache's urls.txt, so conda knows where the
+    archives came from.
+    '''
+    urls_txt_path = os.path.join(PKGS_CACHE_DIR, 'urls.txt')
+    with cache_lock():
+        last_used = load_last_used()
+        now = time.time()
+        for dist in dists:
+            last_used[dist] = now
+        save_last_used(last_used)
+
+        known_urls = set()
+        if os.path.exists(urls_txt_path):
+            with open(urls_txt_path) as f:
+                known_urls = set(f.read().splitlines())
+        new_urls = [url for url in urls if url not in known_urls]
+        if new_urls:
+            with open(urls_txt_path, 'a') as f:
+                f.writelines(f'{url}\n' for url in new_urls)
+
+
+def seed_pkgs_cache(dojo_channels):
+    '''
+    Seeds the shared package cache with every archive in the given dojo
+    channels, then evicts least recently used packages if the cache
+    has grown past its size cap.
+    Returns the set of dist names used by the lesson.
+    '''
+    print(f'\nSeeding package cache at: {PKGS_CACHE_DIR}')
+    Path(PKGS_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+
+    lesson_dists = set()
+    urls = []
+    num_seeded = 0
+    for dojo_channel_path in dojo_channels:
+        channel_url = Path(dojo_channel_path).as_uri()
+        for subdir_path in sorted(Path(dojo_channel_path).iterdir()):
+            if not subdir_path.is_dir():
+                continue
+            subdir = subdir_path.name
+            records = load_channel_repodata(str(subdir_path))
+            for archive in sorted(subdir_path.iterdir()):
+                fn = archive.name
+                if not fn.endswith(ARCHIVE_EXTENSIONS):
+                    continue
+                dist = strip_archive_extension(fn)
+                lesson_dists.add(dist)
+
+                cached_archive = os.path.join(PKGS_CACHE_DIR, fn)
+                extracted_dir = os.path.join(PKGS_CACHE_DIR, dist)
+                if not os.path.exists(cached_archive):
+                    link_or_copy(str(archive), cached_archive)
+                metrics.inc('dojo_pkgs_cache_lookups_total', result='hit' if os.path.isdir(extracted_dir) else 'miss')
+                if not os.path.isdir(extracted_dir):
+                    try:
+                        if extract_package(cached_archive, extracted_dir):
+                            num_seeded += 1
+                    except Exception as e:
+                        # Leave it to conda (which will report the problem, if it's a real one).
+                        print(f'  WARNING: Could not extract {fn} into the cache: {e}')
+                if os.path.isdir(extracted_dir) and fn in records:
+                    write_repodata_record(extracted_dir, records[fn], channel_url, subdir, fn)
+
+                urls.append(f'{channel_url}/{subdir}/{fn}')
+
+    # Mark as recently used (for eviction). This isn't tracked with the
+    # archives' mtimes, since they may be hardlinked to dojo_channels.
+    mark_used(lesson_dists, urls)
+    print(f'  Extracted {num_seeded} new package(s) into the cache.')
+    evict_pkgs_cache(keep=lesson_dists)
+    return lesson_dists
+
+
+def get_path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, fn))
+                   for root, _, fns in os.walk(path)
+                   for fn in fns
+                   if not os.path.islink(os.path.join(root, fn)))
+    elif os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+
+def prune_urls_txt(dists):
+    '''
+    Removes the URLs of evicted packages from the cache's urls.txt.
+    Call with the cache_lock held.
+    '''
+    urls_txt_path = os.path.join(PKGS_CACHE_DIR, 'urls.txt')
+    if not dists or not os.path.exists(urls_txt_path):
+        return
+    with open(urls_txt_path) as f:
+        urls = f.read().splitlines()
+    kept = [url for url in urls if strip_archive_extension(url.rsplit('/', 1)[-1]) not in dists]
+    write_atomically(urls_txt_path, ''.join(f'{url}\n' for url in kept))
+
+
+def evict_pkgs_cache(keep=(), max_bytes=PKGS_CACHE_MAX_BYTES):
+    '''
+    Evicts least recently used packages (archive and extracted directory)
+    until the cache fits under max_bytes. Packages in `keep` (e.g. the ones
+    the current lesson needs) are never evicted.
+    '''
+    if not os.path.isdir(PKGS_CACHE_DIR):
+        return
+
+    with cache_lock():
+        evicted, total_size = evict_lru(load_last_used(), keep, max_bytes)
+    if evicted:
+        print(f'  Evicted {len(evicted)} least recently used package(s) from the cache.')
+    if total_size > max_bytes:
+        print(f'  WARNING: The current lesson needs more than the cache size cap ({max_bytes // (1024 * 1024)} MB).')
+
+
+def evict_lru(last_used, keep, max_bytes):
+    '''
+    Does the evicting for evict_pkgs_cache (with the cache_lock held).
+    Returns (the evicted dists, the cache's size afterwards).
+    '''
+    archives = []
+    dirs = []
+    for entry in os.scandir(PKGS_CACHE_DIR):
+        if entry.is_file() and entry.name.endswith(ARCHIVE_EXTENSIONS):
+            archives.append(entry)
+        elif entry.is_dir() and not entry.name.startswith('.') and not entry.name.endswith('.partial'):
+            dirs.append(entry)
+    archive_dists = {strip_archive_extension(entry.name) for entry in archives}
+
+    # dist -> [last_used, size, paths]
+    entries = {}
+    for entry in archives + dirs:
+        dist = strip_archive_extension(entry.name) if entry.is_file() else entry.name
+        # Skip directories that aren't extracted packages (e.g. conda's own cache/).
+        if entry.is_dir() and dist not in archive_dists \
+                and not os.path.exists(os.path.join(entry.path, 'info', 'index.json')):
+            continue
+        info = entries.setdefault(dist, [last_used.get(dist, 0), 0, []])
+        info[1] += get_path_size(entry.path)
+        info[2].append(entry.path)
+
+    total_size = sum(info[1] for info in entries.values())
+    if total_size <= max_bytes:
+        return set(), total_size
+
+    evicted = set()
+    for dist, (_, size, paths) in sorted(entries.items(), key=lambda item: item[1][0]):
+        if total_size <= max_bytes:
+            break
+        if dist in keep:
+            continue
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        total_size -= size
+        last_used.pop(dist, None)
+        evicted.add(dist)
+
+    save_last_used(last_used)
+    prune_urls_txt(evicted)
+    return evicted, total_size
@@ -0,0 +1,341 @@
+'''
+Host-level coordination of downloads and feedstock clones.
+
+When many learners start a lesson on the same host at once (e.g. a classroom
+training server), every package URL and feedstock is fetched exactly once into
+a shared directory, while the other processes wait for it and then link or
+clone from there. The number of concurrent downloads and their total bandwidth
+are capped across the whole host.
+
+This is enabled by setting DOJO_SHARED_DIR to a directory that every learner
+on the host can write to.
+'''
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from dojo import SHARED_DIR, SHARED_MAX_DOWNLOADS, SHARED_MAX_BYTES_PER_SEC
+from dojo import metrics
+from dojo.cache import link_or_copy
+from dojo.utils import DOWNLOAD_CHUNK_SIZE, CommitNotFoundError, download_package, fetch_upstream_checksums, \
+    hash_file
+from git import GitCommandError, Repo
+from pathlib import Path
+
+
+SLOT_POLL_INTERVAL = 0.1
+# Serves learners' clones from a shared mirror, which may belong to another
+# learner (git otherwise refuses to use it: "dubious ownership").
+MIRROR_UPLOAD_PACK = 'git -c "safe.directory=*" upload-pack'
+# How long the host keeps an upstream channel's checksums before fetching them again.
+UPSTREAM_CHECKSUMS_MAX_AGE = 60 * 60
+
+
+def is_enabled():
+    return bool(SHARED_DIR)
+
+
+def get_shared_path(*parts):
+    '''
+    Returns a path in the shared directory, creating its parent directory
+    if needed. It's writable by every learner on the host, without the sticky
+    bit, so they can replace each other's files (e.g. a stale download).
+    '''
+    path = os.path.join(SHARED_DIR, *parts)
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        Path(parent).mkdir(parents=True, exist_ok=True)
+        try:
+            os.chmod(parent, 0o777)
+        except OSError:
+            pass
+    return path
+
+
+def get_key(value):
+    return hashlib.sha256(value.encode()).hexdigest()[:16]
+
+
+def open_lock_file(lock_path):
+    '''
+    Opens (or creates) a lock file that every learner on the host can lock.
+    '''
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        os.fchmod(fd, 0o666)
+    except OSError:
+        pass
+    return os.fdopen(fd, 'r+')
+
+
+@contextmanager
+def file_lock(lock_path):
+    '''
+    Holds an exclusive flock on lock_path. Blocks until it's acquired.
+    '''
+    with open_lock_file(lock_path) as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def throttle(num_bytes):
+    '''
+    Takes num_bytes out of the host's bandwidth budget: a token bucket, shared
+    by every download on the host, that refills at SHARED_MAX_BYTES_PER_SEC
+    (and holds at most a second's worth). Sleeps as long as the bucket is in
+    debt, so a lone download can use the whole cap, and concurrent downloads
+    split it between them.
+    '''
+    bucket_path = get_shared_path('bandwidth.json')
+    with file_lock(get_shared_path('locks', 'bandwidth.lock')):
+        now = time.time()
+        try:
+            with open(bucket_path) as f:
+                bucket = json.load(f)
+        except (FileNotFoundError, ValueError):
+            bucket = {'tokens': SHARED_MAX_BYTES_PER_SEC, 'updated': now}
+        tokens = bucket['tokens'] + max(now - bucket['updated'], 0) * SHARED_MAX_BYTES_PER_SEC
+        tokens = min(tokens, SHARED_MAX_BYTES_PER_SEC) - num_bytes
+        with open(bucket_path, 'w') as f:
+            json.dump({'tokens': tokens, 'updated': now}, f)
+        try:
+            os.chmod(bucket_path, 0o666)
+        except OSError:
+            pass
+    if tokens < 0:
+        time.sleep(-tokens / SHARED_MAX_BYTES_PER_SEC)
+
+
+@contextmanager
+def download_slot():
+    '''
+    Holds one of the host's SHARED_MAX_DOWNLOADS download slots, waiting for
+    one to free up if needed.
+    '''
+    while True:
+        for i in range(SHARED_MAX_DOWNLOADS):
+            lock_file = open_lock_file(get_shared_path('slots', f'{i}.lock'))
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        time.sleep(SLOT_POLL_INTERVAL)
+
+
+def write_shared_file(path, text):
+    '''
+    Atomically writes a file that every learner on the host can replace.
+    '''
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    try:
+        os.chmod(tmp_path, 0o666)
+    except OSError:
+        pass
+    os.replace(tmp_path, path)
+
+
+def fetch_upstream_checksums_once(subdir_url):
+    '''
+    Like fetch_upstream_checksums, but an upstream channel subdir's repodata
+    is only fetched once per host (and again once it's an hour old): the other
+    processes wait for it, then read the checksums from the shared directory.
+    '''
+    key = get_key(subdir_url)
+    checksums_path = get_shared_path('repodata', f'{key}.json')
+    with file_lock(get_shared_path('locks', f'repodata-{key}.lock')):
+        try:
+            if time.time() - os.path.getmtime(checksums_path) < UPSTREAM_CHECKSUMS_MAX_AGE:
+                with open(checksums_path) as f:
+                    return json.load(f)
+        except (OSError, ValueError):
+            pass
+        with download_slot():
+            checksums = fetch_upstream_checksums(subdir_url)
+        if checksums is not None:
+            write_shared_file(checksums_path, json.dumps(checksums))
+        return checksums
+
+
+def download_package_once(url, destination_path, expected_sha256=None, expected_md5=None, lookup_checksums=None):
+    '''
+    Like download_package, but the URL is only downloaded once per host:
+    the first process to ask for it downloads it into the shared directory,
+    and every other process waits for it, then links (or copies) it from there.
+    If there are no expected checksums, lookup_checksums() is called to get
+    them, but only if the package has to be downloaded.
+    Returns the sha256 of the package.
+    '''
+    key = get_key(url)
+    fn = url.split('/')[-1]
+    blob_path = get_shared_path('blobs', f'{key}-{fn}')
+    sha256_path = blob_path + '.sha256'
+
+    with file_lock(get_shared_path('locks', f'{key}.lock')):
+        sha256 = None
+        if os.path.exists(blob_path) and os.path.exists(sha256_path):
+            with open(sha256_path) as f:
+                sha256 = f.read().strip()
+            if expected_sha256 and sha256 != expected_sha256.lower():
+                # e.g. the package was re-uploaded upstream; fetch it again.
+                sha256 = None
+            elif expected_md5 and hash_file(blob_path, 'md5') != expected_md5.lower():
+                sha256 = None
+            else:
+                print(f'  Using shared download: {fn}')
+        metrics.inc('dojo_shared_download_lookups_total', result='miss' if sha256 is None else 'hit')
+
+        if sha256 is None:
+            if lookup_checksums and not (expected_sha256 or expected_md5):
+                expected_sha256, expected_md5 = lookup_checksums()
+            # e.g. left by another learner's interrupted download.
+            if os.path.exists(blob_path + '.partial'):
+                os.remove(blob_path + '.partial')
+            with download_slot():
+                if SHARED_MAX_BYTES_PER_SEC:
+                    # Small chunks, so the downloads sharing the budget take turns smoothly.
+                    chunk_size = max(min(DOWNLOAD_CHUNK_SIZE, int(SHARED_MAX_BYTES_PER_SEC) // 10), 1024)
+                    sha256 = download_package(url, blob_path, expected_sha256=expected_sha256,
+                                              expected_md5=expected_md5, throttle=throttle, chunk_size=chunk_size)
+                else:
+                    sha256 = download_package(url, blob_path, expected_sha256=expected_sha256,
+                                              expected_md5=expected_md5)
+            try:
+                os.chmod(blob_path, 0o666)
+            except OSError:
+                pass
+            write_shared_file(sha256_path, sha256)
+
+    Path(os.path.dirname(destination_path)).mkdir(parents=True, exist_ok=True)
+    if os.path.exists(destination_path):
+        os.remove(destination_path)
+    link_or_copy(blob_path, destination_path)
+    return sha256
+
+
+def get_git_env():
+    '''
+    Environment for git commands run in a shared mirror (see MIRROR_UPLOAD_PACK).
+    '''
+    i = int(os.environ.get('GIT_CONFIG_COUNT', 0))
+    return {'GIT_CONFIG_COUNT': str(i + 1), f'GIT_CONFIG_KEY_{i}': 'safe.directory', f'GIT_CONFIG_VALUE_{i}': '*'}
+
+
+def open_mirror(mirror_path):
+    repo = Repo(mirror_path)
+    repo.git.update_environment(**get_git_env())
+    return repo
+
+
+def has_commit(repo, commit):
+    try:
+        repo.git.cat_file('-e', f'{commit}^{{commit}}')
+        return True
+    except GitCommandError:
+        return False
+
+
+def init_mirror(mirror_path, feedstock_url, mirror_refs):
+    '''
+    Creates an empty bare repo (at mirror_path + ".partial", to be renamed
+    once it's filled), that every learner on the host can read and fetch
+    into, and that lets learners fetch single commits and partial clones.
+    With mirror_refs, fetching from origin mirrors all of its refs.
+    Returns the repo.
+    '''
+    tmp_path = mirror_path + '.partial'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    repo = Repo.init(tmp_path, bare=True, shared='0666')
+    repo.git.update_environment(**get_git_env())
+    with repo.config_writer() as config:
+        config.set_value('uploadpack', 'allowAnySHA1InWant', 'true')
+        config.set_value('uploadpack', 'allowFilter', 'true')
+    if mirror_refs:
+        repo.git.remote('add', '--mirror=fetch', 'origin', feedstock_url)
+    else:
+        repo.git.remote('add', 'origin', feedstock_url)
+    return repo
+
+
+def fetch_commit_into_shallow_mirror(repo, commit):
+    '''
+    Fetches the commit into a shallow mirror with --depth=1. If the remote
+    doesn't allow fetching a commit by its SHA, all branches are fetched
+    instead, with their full history (the commit may not be a branch tip).
+    '''
+    try:
+        repo.git.fetch('origin', commit, '--depth=1')
+        return
+    except GitCommandError:
+        print('  The remote does not allow fetching a single commit. Fetching all branches instead.')
+    if repo.git.rev_parse('--is-shallow-repository') == 'true':
+        repo.git.fetch('origin', '+refs/heads/*:refs/heads/*', '--unshallow')
+    else:
+        repo.git.fetch('origin', '+refs/heads/*:refs/heads/*')
+
+
+def get_feedstock_mirror(feedstock_url, commit, shallow=False):
+    '''
+    Returns the path to the host's shared mirror of the feedstock, making sure
+    it contains the commit. Only one process creates (or fetches into) it at a
+    time; the others wait and then use it. Mirrors are created readable and
+    writable by every learner on the host.
+    If shallow (for lessons with "feedstock_clone: {shallow: true}"), the mirror
+    is a separate bare repo that only holds the commits lessons asked for, each
+    fetched with --depth=1.
+    '''
+    repo_name = feedstock_url.split('/')[-1].split('.git')[0]
+    key = get_key(feedstock_url)
+    if shallow:
+        key += '-shallow'
+    mirror_path = get_shared_path('feedstocks', f'{key}-{repo_name}.git')
+
+    with file_lock(get_shared_path('locks', f'{key}.lock')):
+        if shallow:
+            if not os.path.isdir(mirror_path):
+                init_mirror(mirror_path, feedstock_url, mirror_refs=False)
+                os.rename(mirror_path + '.partial', mirror_path)
+            repo = open_mirror(mirror_path)
+            if not has_commit(repo, commit):
+                print(f'Fetching {commit} into shared mirror of {repo_name}')
+                with download_slot():
+                    fetch_commit_into_shallow_mirror(repo, commit)
+                if has_commit(repo, commit):
+                    # Keep the commit from being garbage collected.
+                    repo.git.update_ref(f'refs/dojo/{commit}', commit)
+            else:
+                print(f'Using shared mirror of {repo_name}')
+        elif not os.path.isdir(mirror_path):
+            print(f'Cloning shared mirror of {repo_name}')
+            repo = init_mirror(mirror_path, feedstock_url, mirror_refs=True)
+            with download_slot():
+                repo.git.fetch('origin')
+            os.rename(mirror_path + '.partial', mirror_path)
+            repo = open_mirror(mirror_path)
+        else:
+            repo = open_mirror(mirror_path)
+            if not has_commit(repo, commit):
+                print(f'Updating shared mirror of {repo_name}')
+                with download_slot():
+                    repo.git.fetch('origin', '--prune')
+            else:
+                print(f'Using shared mirror of {repo_name}')
+        if not has_commit(repo, commit):
+            raise CommitNotFoundError(f'Commit {commit} was not found in {feedstock_url}.')
+
+    return mirror_path
@@ -3,15 +3,26 @@ Interactions for and within a lesson.
 '''
 import os
 import pandas as pd
+import requests
 import shutil
 import sys
+from collections import namedtuple
+from functools import partial
 from colorama import Fore, Back, Style
-from dojo import ROOT_DIR, LESSONS_DIR, TRAINING_FEEDSTOCKS_DIR
-from dojo.utils import add_lesson_yaml, download_package, get_latest, \
+from dojo import ROOT_DIR, LESSONS_DIR, TRAINING_FEEDSTOCKS_DIR, PKGS_CACHE_DIR
+from dojo import coordinator, metrics
+from dojo.background import clear_status, cancel_background_setup, get_setup_lock_path, is_running, \
+    load_status, start_background_setup, wait_for_setup
+from dojo.cache import can_transcode, get_transcoded_fn, seed_pkgs_cache, strip_archive_extension, \
+    transcode_packages
+from dojo.manifest import load_manifest, save_manifest
+from dojo.utils import CommitNotFoundError, add_lesson_yaml, download_package, fetch_upstream_checksums, get_latest, \
+    get_upstream_checksums, hash_file, parse_package_url, \
     update_history, create_lesson_progress, get_all_lesson_progress, \
     get_lesson_progress, get_timestamp_for_file, \
-    load_lesson_specs, update_lesson_progress
-from git import Repo
+    load_lesson_specs, timed_phase, update_lesson_progress
+from git import GitCommandError, Repo
+from pathlib import Path
 
 
 def clean_dojo_channels(lesson_name):
@@ -25,7 +36,7 @@ def clean_dojo_channels(lesson_name):
 
 def clean_history_and_progress():
     '''
-    Deletes history.csv and progress.csv files.
+    Deletes history.csv and progress.csv files (and the notes search index).
     '''
     while True:
         user_response = str(input(Fore.RED + f'CONFIRM: Are you sure you want to delete ALL of your history and progress files? (y/n) '))
@@ -46,16 +57,24 @@ def clean_history_and_progress():
             progress_path = os.path.join(lesson_dir, 'progress.csv')
             if os.path.exists(progress_path):
                 os.remove(progress_path)
+
+        # The notes search index only holds notes from the progress files.
+        from dojo.notes import NOTES_INDEX_PATH
+        if os.path.exists(NOTES_INDEX_PATH):
+            os.remove(NOTES_INDEX_PATH)
         
         print('Done. All history and progress files have been deleted.')
 
     elif user_response.lower() == 'n':
         sys.exit(0)
 
-def clone_checkout_feedstock(feedstock_url, commit):
+def clone_checkout_feedstock(feedstock_url, commit, clone_options=None):
     '''
     Clones the lesson's feedstock and checks
     out the specified commmit.
+    If the lesson's clone_options ask for it, only fetches the minimum:
+    just that commit (shallow), without blobs until they're checked out
+    (partial), and/or only checks out some paths (sparse).
     '''
     print('\nSetting up feedstock snapshot...')
     repo_name = get_repo_name(feedstock_url)
@@ -67,10 +86,30 @@ def clone_checkout_feedstock(feedstock_url, commit):
     # Clone feedstock
     if os.path.isdir(clone_target_path):
         shutil.rmtree(clone_target_path)
-    repo = Repo.clone_from(feedstock_url, clone_target_path)
+    if coordinator.is_enabled():
+        # Clone from the host's shared mirror, which fetches from the feedstock
+        # just once for everyone on the host.
+        mirror_path = coordinator.get_feedstock_mirror(feedstock_url, commit,
+                                                       shallow=bool(clone_options and clone_options['shallow']))
+        if clone_options:
+            # (Over file://, so that --depth and --filter apply.)
+            repo = fetch_feedstock_commit(Path(mirror_path).as_uri(), commit, clone_target_path, clone_options,
+                                          upload_pack=coordinator.MIRROR_UPLOAD_PACK)
+        else:
+            repo = Repo.clone_from(mirror_path, clone_target_path, env=coordinator.get_git_env(),
+                                   upload_pack=coordinator.MIRROR_UPLOAD_PACK, allow_unsafe_options=True)
+    elif clone_options:
+        repo = fetch_feedstock_commit(feedstock_url, commit, clone_target_path, clone_options)
+    else:
+        repo = Repo.clone_from(feedstock_url, clone_target_path)
 
-    # Checkout commit
+    # Checkout commit (with a partial clone, this fetches the blobs it needs
+    # from the mirror, if any, before origin is pointed at the feedstock).
     repo.git.checkout(commit)
+    if coordinator.is_enabled():
+        repo.remotes.origin.set_url(feedstock_url)
+        if clone_options:
+            repo.git.config('--unset', 'remote.origin.uploadpack')
 
     os.chdir(ROOT_DIR)
     print('...successfully set up feedstock snapshot!')
@@ -78,6 +117,57 @@ def clone_checkout_feedstock(feedstock_url, commit):
     return clone_target_path
 
 
+def get_clone_options(lesson_specs):
+    '''
+    Returns the lesson's (optional) "feedstock_clone" options, e.g.
+    {'shallow': True, 'partial': True, 'sparse_paths': ['recipe']}
+    '''
+    clone_options = lesson_specs.get('feedstock_clone') or {}
+    return {
+        'shallow': bool(clone_options.get('shallow', False)),
+        'partial': bool(clone_options.get('partial', False)),
+        'sparse_paths': [str(path) for path in clone_options.get('sparse_paths') or []],
+    } if clone_options else {}
+
+
+def fetch_feedstock_commit(feedstock_url, commit, clone_target_path, clone_options, upload_pack=None):
+    '''
+    Creates a repo at clone_target_path and fetches just what the lesson needs
+    from the feedstock. Falls back to fetching all branches (with their full
+    history, since the commit may not be a branch tip) if the remote doesn't
+    allow fetching a commit by its SHA.
+    If given, upload_pack is the command that serves the remote's side of the
+    fetches (for a remote on the same host).
+    '''
+    repo = Repo.init(clone_target_path)
+    repo.create_remote('origin', feedstock_url)
+    if upload_pack:
+        repo.git.config('remote.origin.uploadpack', upload_pack)
+
+    fetch_args = []
+    if clone_options.get('shallow'):
+        fetch_args.append('--depth=1')
+    if clone_options.get('partial'):
+        # Blobs are fetched lazily (at checkout) from the "promisor" remote.
+        repo.git.config('remote.origin.promisor', 'true')
+        repo.git.config('remote.origin.partialclonefilter', 'blob:none')
+        fetch_args.append('--filter=blob:none')
+    if clone_options.get('sparse_paths'):
+        repo.git.sparse_checkout('set', *clone_options['sparse_paths'])
+
+    try:
+        repo.git.fetch('origin', commit, *fetch_args)
+    except GitCommandError:
+        print('  The remote does not allow fetching a single commit. Fetching all branches instead.')
+        repo.git.fetch('origin', *[arg for arg in fetch_args if arg != '--depth=1'])
+        try:
+            repo.git.cat_file('-e', f'{commit}^{{commit}}')
+        except GitCommandError:
+            raise CommitNotFoundError(f'Commit {commit} was not found in {feedstock_url}.')
+
+    return repo
+
+
 def create_lesson(new_lesson_name, target_platform):
     '''
     Creates a lesson directory and a lesson.yaml.
@@ -100,11 +190,12 @@ def create_lesson(new_lesson_name, target_platform):
     print('In this directory, you will find the "lesson.yaml". Please add your lesson content in this file.')
 
 
-def display_prompt(lesson_name, lesson_specs, step_index, verbose=False):
+def display_prompt(lesson_name, lesson_specs, step_index, verbose=False, show_notes=True):
     '''
     Displays the lesson name and step info, and (if specified) additional
     details about the lesson.
-    Also shows any notes entered for the step.
+    Also shows any notes entered for the step (unless show_notes is False,
+    e.g. when previewing a lesson that hasn't been started).
     '''
     if verbose:
         details = '  Objectives:'
@@ -122,9 +213,11 @@ def display_prompt(lesson_name, lesson_specs, step_index, verbose=False):
     prompt = lesson_specs['prompts'][step_index]
 
     # Get any notes that exist for current step_index.
-    df_progress = get_all_lesson_progress(lesson_name)
-    df_rows_with_notes = df_progress[(df_progress['lesson_index']==step_index) & (df_progress.note.notnull())]
-    rows_with_notes = df_rows_with_notes.values.tolist()
+    rows_with_notes = []
+    if show_notes:
+        df_progress = get_all_lesson_progress(lesson_name)
+        df_rows_with_notes = df_progress[(df_progress['lesson_index']==step_index) & (df_progress.note.notnull())]
+        rows_with_notes = df_rows_with_notes.values.tolist()
     
     if rows_with_notes:
         notes = '\n  My notes:'
@@ -167,85 +260,409 @@ def get_repo_name(feedstock_url):
     return feedstock_url.split('/')[-1].split('.git')[0]
 
 
-def setup_feedstock_and_condarc(lesson_name):
+CONDARC_HEADER = '# Generated by conda-build dojo for lesson: '
+
+SetupStep = namedtuple('SetupStep', ['name', 'description', 'details', 'cost', 'run'])
+
+
+def get_condarc_path():
+    return os.path.join(os.environ['HOME'], '.condarc')
+
+
+def get_desired_packages(lesson_name):
+    '''
+    Parses each URL in the lesson's "dojo_channels_pkgs.txt" to get its channel,
+    subdir, and filename. For example:
+    {
+     'main/linux-64/python-3.9.2-hdb3f193_0.conda':
+        {
+         'url': 'https://repo.anaconda.com/pkgs/main/linux-64/python-3.9.2-hdb3f193_0.conda',
+         'channel': 'main',
+         'subdir' : 'linux-64',
+         'fn' : 'python-3.9.2-hdb3f193_0.conda',
+         'sha256': None,
+         'md5': None,
+         'path': 'main/linux-64/python-3.9.2-hdb3f193_0.conda',
+        }
+    }
+    A line may also carry the package's checksum after a "#" (as in the
+    output of `conda list --explicit --md5`).
+    "path" is where the package is kept in dojo_channels: the same as the
+    key, unless .tar.bz2 packages are transcoded to .conda.
+    Returns an empty dict if the file doesn't exist or is empty.
+    '''
+    dojo_channels_pkgs = os.path.join(LESSONS_DIR, lesson_name, 'dojo_channels_pkgs.txt')
+    desired = {}
+    if not (os.path.exists(dojo_channels_pkgs) and os.stat(dojo_channels_pkgs).st_size > 0):
+        return desired
+
+    transcode = can_transcode()
+    with open(dojo_channels_pkgs, 'r') as url_list:
+        for line in url_list.read().splitlines():
+            if not line.strip():
+                continue
+            url, sha256, md5 = parse_package_url(line)
+            channel = url.split('/')[-3]
+            subdir = url.split('/')[-2]
+            fn = url.split('/')[-1]
+            path = f'{channel}/{subdir}/{fn}'
+            if transcode and fn.endswith('.tar.bz2'):
+                path = f'{channel}/{subdir}/{get_transcoded_fn(fn)}'
+            desired[f'{channel}/{subdir}/{fn}'] = {'url': url, 'channel': channel, 'subdir': subdir, 'fn': fn,
+                                                   'sha256': sha256, 'md5': md5, 'path': path}
+    return desired
+
+
+def get_desired_condarc(lesson_name, dojo_channels):
+    '''
+    Contents of a .condarc that points to the lesson's dojo_channels
+    and to the shared package cache.
+    '''
+    condarc = f'{CONDARC_HEADER}{lesson_name}\n'
+    condarc += 'channels: \n'  # Must have a space after the colon. See: https://stackoverflow.com/a/9055411
+    for channel in dojo_channels:
+        condarc += f'  - {channel}\n'
+    condarc += 'pkgs_dirs: \n'
+    condarc += f'  - {PKGS_CACHE_DIR}\n'
+    return condarc
+
+
+def feedstock_is_current(clone_path, feedstock_url, commit, clone_options, manifest):
+    '''
+    The feedstock snapshot is current if it was cloned from the same URL
+    (with the same clone options), is still checked out at the lesson's
+    commit, and has no local changes.
+    '''
+    recorded = manifest['feedstock']
+    if recorded.get('url') != feedstock_url or recorded.get('commit') != commit:
+        return False
+    if recorded.get('clone_options', {}) != clone_options:
+        return False
+    if not os.path.isdir(clone_path):
+        return False
+    try:
+        repo = Repo(clone_path)
+        return repo.head.commit.hexsha == commit and not repo.is_dirty(untracked_files=True)
+    except Exception:
+        return False
+
+
+def lookup_checksums(pkg):
+    '''
+    Looks up the checksums of a package that the lesson's package list doesn't
+    pin, in its upstream channel's repodata (fetched once per host, if the
+    host's learners share downloads). Returns (sha256, md5).
+    '''
+    fetch_checksums = coordinator.fetch_upstream_checksums_once if coordinator.is_enabled() \
+        else fetch_upstream_checksums
+    sha256, md5 = get_upstream_checksums(pkg['url'], fetch_checksums)
+    if not (sha256 or md5):
+        print(f'  WARNING: No checksum found for {pkg["fn"]}; it will not be verified.')
+    return sha256, md5
+
+
+def package_is_current(dojo_channels_dir, relpath, pkg, recorded):
+    '''
+    Cheap staleness check (like make): the file must exist and match the
+    size and mtime recorded when it was downloaded and verified.
+    '''
+    path = os.path.join(dojo_channels_dir, pkg['path'])
+    if not recorded or recorded.get('url') != pkg['url'] or not os.path.exists(path):
+        return False
+    if recorded.get('path', relpath) != pkg['path']:
+        return False
+    if pkg['sha256'] and recorded.get('sha256') != pkg['sha256']:
+        return False
+    st = os.stat(path)
+    return st.st_size == recorded.get('size') and st.st_mtime == recorded.get('mtime')
+
+
+def estimate_download_size(urls, manifest_packages):
+    '''
+    Estimates the number of bytes to download, from the manifest if the
+    package was downloaded before, or from a HEAD request otherwise.
+    Returns (num_bytes, num_unknown).
+    '''
+    num_bytes = 0
+    num_unknown = 0
+    for relpath, url in urls:
+        size = manifest_packages.get(relpath, {}).get('size')
+        if size is None:
+            try:
+                r = requests.head(url, allow_redirects=True, timeout=10)
+                size = int(r.headers['Content-Length']) if r.ok else None
+            except (requests.RequestException, KeyError, ValueError):
+                size = None
+        if size is None:
+            num_unknown += 1
+        else:
+            num_bytes += size
+    return num_bytes, num_unknown
+
+
+def plan_setup(lesson_name, manifest, estimate_cost=False):
+    '''
+    Diffs the lesson's setup manifest against its desired state and returns
+    the list of SetupSteps needed to reconcile them (in order).
+    '''
     lesson_specs = load_lesson_specs(lesson_name)
     feedstock_url = lesson_specs['feedstock_url']
     commit = lesson_specs['commit']
+    steps = []
 
-    # Clone feedstock and checkout to specifiec commit.
-    clone_checkout_feedstock(feedstock_url, commit)
-
-    # Set up dojo_channels (only if "dojo_channels_pkgs.txt" file exists and it's not empty):
-    dojo_channels_pkgs = os.path.join(LESSONS_DIR, lesson_name, 'dojo_channels_pkgs.txt')
-    if os.path.exists(dojo_channels_pkgs) and os.stat(dojo_channels_pkgs).st_size > 0:
-        print('\nSetting up dojo_channels...')
-
-        # Parse each URL to get its channel, subdir, and filename. For example: 
-        # {
-        #  'https://repo.anaconda.com/pkgs/main/linux-64/python-3.9.2-hdb3f193_0.conda': 
-        #     {
-        #      'channel': 'main', 
-        #      'subdir' : 'linux-64',
-        #      'fn' : 'python-3.9.2-hdb3f193_0.conda'
-        #     }
-        # }
-        url_parsed_dict = {}
-        
-        with open(dojo_channels_pkgs, 'r') as url_list:
-            urls = url_list.read().splitlines()
-            for url in urls:
-                
-                channel = url.split('/')[-3]
-                subdir = url.split('/')[-2]
-                fn = url.split('/')[-1]
-                url_parsed_dict[url] = {'channel': channel, 'subdir': subdir, 'fn': fn}
-
-        # Download each URL to the appropriate destination path.
-        for pkg_url, url_parts in url_parsed_dict.items():
-            destination_path = os.path.join(LESSONS_DIR, 
-                                            lesson_name, 
-                                            'dojo_channels', 
-                                            url_parts['channel'], 
-                                            url_parts['subdir'], 
-                                            url_parts['fn'])
-            download_package(pkg_url, destination_path)
-
-        # Run `conda index` on each dojo channel.
-        from glob import glob
-        dojo_channels = glob(os.path.join(LESSONS_DIR,lesson_name, 'dojo_channels', '*'))
-        for dojo_channel_path in dojo_channels:
+    # Feedstock snapshot.
+    repo_name = get_repo_name(feedstock_url)
+    clone_path = os.path.join(TRAINING_FEEDSTOCKS_DIR, repo_name)
+    clone_options = get_clone_options(lesson_specs)
+    if not feedstock_is_current(clone_path, feedstock_url, commit, clone_options, manifest):
+        def run_feedstock():
+            manifest['feedstock'] = {}
+            save_manifest(lesson_name, manifest)
+            clone_checkout_feedstock(feedstock_url, commit, clone_options)
+            manifest['feedstock'] = {'url': feedstock_url, 'commit': commit, 'path': clone_path,
+                                     'clone_options': clone_options}
+        details = [f'{option}: {value}' for option, value in clone_options.items() if value]
+        cost = 'git fetch of a single commit' if clone_options.get('shallow') else 'git clone over the network'
+        steps.append(SetupStep('feedstock', f'Clone {repo_name} and check out {commit}',
+                               details, cost, run_feedstock))
+
+    # dojo_channels (empty if there's no "dojo_channels_pkgs.txt" file, or it's empty,
+    # in which case anything left over from an older package list is removed).
+    desired_packages = get_desired_packages(lesson_name)
+    dojo_channels_dir = os.path.join(LESSONS_DIR, lesson_name, 'dojo_channels')
+    desired_channels = sorted({pkg['channel'] for pkg in desired_packages.values()})
+    dojo_channels = [os.path.join(dojo_channels_dir, channel) for channel in desired_channels]
+
+    stale_packages = [relpath for relpath, pkg in desired_packages.items()
+                      if not package_is_current(dojo_channels_dir, relpath, pkg,
+                                                manifest['packages'].get(relpath))]
+    desired_paths = {pkg['path'] for pkg in desired_packages.values()}
+    # Anything else in the channels (e.g. left over from an older package list) gets removed.
+    extra_files = []
+    from glob import glob
+    for path in glob(os.path.join(dojo_channels_dir, '*', '*', '*')):
+        relpath = os.path.relpath(path, dojo_channels_dir)
+        if path.endswith(('.conda', '.tar.bz2', '.partial')) and relpath not in desired_paths:
+            extra_files.append(relpath)
+    extra_channels = sorted(os.path.basename(path) for path in glob(os.path.join(dojo_channels_dir, '*'))
+                            if os.path.isdir(path) and os.path.basename(path) not in desired_channels)
+
+    if stale_packages or extra_files or extra_channels:
+        def run_packages():
+            print('\nSetting up dojo_channels...')
+            for relpath in extra_files:
+                os.remove(os.path.join(dojo_channels_dir, relpath))
+                manifest['packages'].pop(relpath, None)
+            for channel in extra_channels:
+                shutil.rmtree(os.path.join(dojo_channels_dir, channel))
+                for subdir in [subdir for subdir in manifest['repodata'] if subdir.split('/')[0] == channel]:
+                    manifest['repodata'].pop(subdir)
+
+            save_manifest(lesson_name, manifest)
+
+            # Download each URL to the appropriate destination path,
+            # verifying its checksum along the way (if the package list doesn't
+            # pin one, it's looked up in the upstream channel's repodata). Each download is
+            # recorded as soon as it's done, so a failed download doesn't
+            # make the next setup fetch the others again.
+            downloaded = []
+            for relpath in stale_packages:
+                pkg = desired_packages[relpath]
+                destination_path = os.path.join(dojo_channels_dir, relpath)
+                sha256, md5 = pkg['sha256'], pkg['md5']
+                if coordinator.is_enabled():
+                    # The upstream checksums are only looked up if the package isn't in the shared directory yet.
+                    sha256 = coordinator.download_package_once(pkg['url'], destination_path,
+                                                               expected_sha256=sha256, expected_md5=md5,
+                                                               lookup_checksums=partial(lookup_checksums, pkg))
+                else:
+                    if not (sha256 or md5):
+                        sha256, md5 = lookup_checksums(pkg)
+                    sha256 = download_package(pkg['url'], destination_path, expected_sha256=sha256, expected_md5=md5)
+                st = os.stat(destination_path)
+                manifest['packages'][relpath] = {'url': pkg['url'], 'sha256': sha256, 'path': relpath,
+                                                 'size': st.st_size, 'mtime': st.st_mtime}
+                save_manifest(lesson_name, manifest)
+                downloaded.append(relpath)
+
+            # (Opt-in) Transcode .tar.bz2 packages to .conda, which is much
+            # faster to index and to extract during the learner's builds.
+            transcoded = transcode_packages([os.path.join(dojo_channels_dir, relpath) for relpath in downloaded
+                                             if desired_packages[relpath]['path'] != relpath])
+            for archive_path, conda_path in transcoded.items():
+                relpath = os.path.relpath(archive_path, dojo_channels_dir)
+                st = os.stat(conda_path)
+                manifest['packages'][relpath].update(path=desired_packages[relpath]['path'],
+                                                     transcoded_sha256=hash_file(conda_path),
+                                                     size=st.st_size, mtime=st.st_mtime)
+            if transcoded:
+                save_manifest(lesson_name, manifest)
+
+        details = [f'download {desired_packages[relpath]["fn"]}' for relpath in stale_packages]
+        details += [f'transcode {desired_packages[relpath]["fn"]} to .conda' for relpath in stale_packages
+                    if desired_packages[relpath]['path'] != relpath]
+        details += [f'remove {relpath}' for relpath in extra_files]
+        details += [f'remove channel {channel}' for channel in extra_channels]
+        cost = f'{len(stale_packages)} download(s)'
+        if estimate_cost and stale_packages:
+            num_bytes, num_unknown = estimate_download_size(
+                [(relpath, desired_packages[relpath]['url']) for relpath in stale_packages], manifest['packages'])
+            cost += f', ~{num_bytes / (1024 * 1024):.1f} MB'
+            if num_unknown:
+                cost += f' (+{num_unknown} of unknown size)'
+        steps.append(SetupStep('packages', 'Download dojo_channels packages', details, cost, run_packages))
+
+    # Run `conda index` on each dojo channel whose packages or repodata changed.
+    changed_subdirs = {os.path.dirname(relpath) for relpath in stale_packages + extra_files}
+    stale_channels = {subdir.split('/')[0] for subdir in changed_subdirs}
+    for subdir in {os.path.dirname(relpath) for relpath in desired_packages}:
+        repodata_path = os.path.join(dojo_channels_dir, subdir, 'repodata.json')
+        if not os.path.exists(repodata_path) or hash_file(repodata_path) != manifest['repodata'].get(subdir):
+            stale_channels.add(subdir.split('/')[0])
+    stale_channels = sorted(channel for channel in stale_channels if channel in desired_channels)
+
+    if stale_channels:
+        def run_index():
             import subprocess
-            print(f'Running "conda index" on {dojo_channel_path}')
-            subprocess.run(['conda', 'index', dojo_channel_path])
-
-        # If a .condarc exists, back it up.
-        home_path = os.environ['HOME']
-        condarc_path = os.path.join(home_path, '.condarc')
-        if os.path.exists(condarc_path):
-            ts = get_timestamp_for_file()
-            renamed_condarc_path = os.path.join(home_path, f'.condarc_bak_{ts}')
-            os.rename(condarc_path, renamed_condarc_path)
-            print('Found an existing .condarc file.')
-            print(f'Backing it up to: {renamed_condarc_path}')
-
-        # Create a .condarc that points to the lesson's dojo_channels.
-        with open(condarc_path, 'w') as new_condarc:
-            new_condarc.write('channels: \n')  # Must have a space after the colon. See: https://stackoverflow.com/a/9055411
-            for channel in dojo_channels:
-                new_condarc.write(f'  - {channel}\n')
-
+            for channel in stale_channels:
+                dojo_channel_path = os.path.join(dojo_channels_dir, channel)
+                print(f'Running "conda index" on {dojo_channel_path}')
+                subprocess.run(['conda', 'index', dojo_channel_path])
+            manifest['repodata'] = {}
+            for repodata_path in glob(os.path.join(dojo_channels_dir, '*', '*', 'repodata.json')):
+                subdir = os.path.relpath(os.path.dirname(repodata_path), dojo_channels_dir)
+                manifest['repodata'][subdir] = hash_file(repodata_path)
+        steps.append(SetupStep('index', 'Index dojo_channels', [f'conda index {channel}' for channel in stale_channels],
+                               f'{len(stale_channels)} conda index run(s)', run_index))
+
+    # Pre-seed the shared package cache so lesson builds can hardlink
+    # packages instead of extracting them again.
+    missing_dists = [pkg['fn'] for pkg in desired_packages.values()
+                     if not os.path.isdir(os.path.join(PKGS_CACHE_DIR, strip_archive_extension(pkg['fn'])))
+                     and not os.path.exists(os.path.join(PKGS_CACHE_DIR, os.path.basename(pkg['path'])))]
+    if stale_channels or missing_dists:
+        steps.append(SetupStep('cache', 'Seed the shared package cache', [],
+                               f'{len(missing_dists)} package(s) to extract',
+                               lambda: seed_pkgs_cache(dojo_channels)))
+
+    # Point the .condarc at the lesson's dojo_channels.
+    condarc_path = get_condarc_path()
+    current_condarc = None
+    if os.path.exists(condarc_path):
+        with open(condarc_path) as f:
+            current_condarc = f.read()
+    if not desired_packages:
+        # No dojo_channels: remove the .condarc if dojo wrote it for this lesson's old channels.
+        if current_condarc is not None and current_condarc.startswith(f'{CONDARC_HEADER}{lesson_name}\n'):
+            def remove_condarc():
+                os.remove(condarc_path)
+                manifest['condarc'] = None
+            steps.append(SetupStep('condarc', f'Remove {condarc_path}', ['the lesson no longer has dojo_channels'],
+                                   'local file write', remove_condarc))
+        return steps
+
+    desired_condarc = get_desired_condarc(lesson_name, dojo_channels)
+    if current_condarc != desired_condarc:
+        def run_condarc():
+            # If a .condarc exists (and it's not one that dojo wrote), back it up.
+            if current_condarc is not None and not current_condarc.startswith(CONDARC_HEADER):
+                ts = get_timestamp_for_file()
+                renamed_condarc_path = os.path.join(os.path.dirname(condarc_path), f'.condarc_bak_{ts}')
+                os.rename(condarc_path, renamed_condarc_path)
+                print('Found an existing .condarc file.')
+                print(f'Backing it up to: {renamed_condarc_path}')
+            with open(condarc_path, 'w') as new_condarc:
+                new_condarc.write(desired_condarc)
+            manifest['condarc'] = desired_condarc
+        steps.append(SetupStep('condarc', f'Write {condarc_path}', desired_condarc.splitlines(),
+                               'local file write', run_condarc))
+
+    return steps
+
+
+def print_setup_plan(lesson_name, steps):
+    if not steps:
+        print(f'"{lesson_name}" is already set up. Nothing to do.')
+        return
+    print(f'Setup plan for "{lesson_name}":')
+    for i, step in enumerate(steps, 1):
+        print(f'\n  {i}. {step.description}  [{step.cost}]')
+        for detail in step.details:
+            print(f'       {detail}')
+    print()
+
+
+def setup_feedstock_and_condarc(lesson_name, plan_only=False, on_progress=None):
+    '''
+    Sets up (or reconciles) the lesson's feedstock snapshot, dojo_channels
+    and .condarc, running only the steps that are missing or stale
+    according to the lesson's setup manifest.
+    If plan_only, just shows the steps (and their estimated cost).
+    If given, on_progress(steps, step, state) is called once the steps are
+    planned (with step None), and as each step is "running" and "done".
+    '''
+    manifest = load_manifest(lesson_name)
+    with timed_phase(lesson_name, 'plan'):
+        steps = plan_setup(lesson_name, manifest, estimate_cost=plan_only)
+
+    if plan_only:
+        print_setup_plan(lesson_name, steps)
+        return steps
+
+    if on_progress:
+        on_progress(steps, None, 'planned')
+    if not steps:
+        print('\nFeedstock snapshot and dojo_channels are already set up.')
+        return steps
+
+    for step in steps:
+        if on_progress:
+            on_progress(steps, step, 'running')
+        with timed_phase(lesson_name, step.name):
+            step.run()
+        save_manifest(lesson_name, manifest)
+        if on_progress:
+            on_progress(steps, step, 'done')
+
+    if any(step.name in ('packages', 'index', 'condarc') for step in steps):
         print('...successfully set up dojo_channels!')
+    return steps
+
+
+def run_setup(lesson_name, background=False):
+    '''
+    Sets up the lesson, either right away or in a background worker.
+    '''
+    status = load_status(lesson_name)
+    if background:
+        if status and is_running(status):
+            print(f'"{lesson_name}" is already being set up in the background. Run `dojo status` to see its progress.')
+        else:
+            start_background_setup(lesson_name)
+        return
+
+    # Don't race a background setup of the same lesson; wait for it, then reconcile.
+    if status and is_running(status):
+        print('Waiting for the background setup to finish...')
+    with coordinator.file_lock(get_setup_lock_path(lesson_name)):
+        setup_feedstock_and_condarc(lesson_name)
+    clear_status(lesson_name)
 
 
-def start(lesson_name):
+def start(lesson_name, plan_only=False, background=False):
     '''
     Starts a new lesson by setting up the feedstock and condarc.
     Also checks if a user already started the specified lesson 
     and handles accordingly.
+    If plan_only, just shows what setup would do (dry run).
+    If background, the setup runs in a background worker, and the lesson's
+    steps only wait for it once they need it.
     '''
     lesson_specs = load_lesson_specs(lesson_name)
-    feedstock_url = lesson_specs['feedstock_url']
-    commit = lesson_specs['commit']
+
+    if plan_only:
+        setup_feedstock_and_condarc(lesson_name, plan_only=True)
+        return
 
     # Check whether a progress.csv already exists (which would mean
     # they've started this lesson before). 
@@ -253,16 +670,16 @@ def start(lesson_name):
     if os.path.exists(os.path.join(LESSONS_DIR, lesson_name, 'progress.csv')):
         while True:
             user_response = str(input(f'You previously started "{lesson_name}". \nDo you wish to (r)esume, (s)tart over, or (c)ancel? '))
-            if user_response.lower() not in ['c', 's']:
+            if user_response.lower() not in ['r', 's', 'c']:
                 print('Sorry, I did not understand.')
             else:
                 break
         if user_response.lower() == 'r':  # Resume
-            setup_feedstock_and_condarc(lesson_name)
+            run_setup(lesson_name, background)
             update_history(lesson_name, 'resume')
             step_current(verbose=True)
         elif user_response.lower() == 's':  # Start over
-            setup_feedstock_and_condarc(lesson_name)
+            run_setup(lesson_name, background)
             update_history(lesson_name, 'start over')
             update_lesson_progress(lesson_name, 0)
             step_current(verbose=True)
@@ -270,12 +687,14 @@ def start(lesson_name):
             sys.exit(0)
 
     else:
-        setup_feedstock_and_condarc(lesson_name)
+        run_setup(lesson_name, background)
         update_history(lesson_name, 'start')
         create_lesson_progress(lesson_name)
+        wait_for_setup(lesson_name, lesson_specs, 0)
         display_prompt(lesson_name, lesson_specs, 0, verbose=True)
 
 
+@metrics.timed('dojo_step_navigation', command='previous')
 def step_previous(verbose=False):
     '''
     Show the previous step.
@@ -288,18 +707,22 @@ def step_previous(verbose=False):
     lesson_specs = load_lesson_specs(lesson_name)
 
     update_lesson_progress(lesson_name, new_step_index)
+    wait_for_setup(lesson_name, lesson_specs, new_step_index)
     display_prompt(lesson_name, lesson_specs, new_step_index, verbose=verbose)
 
 
+@metrics.timed('dojo_step_navigation', command='current')
 def step_current(verbose=False):
     '''
     Show the current step.
     '''
     lesson_name, current_step_index = get_latest()
     lesson_specs = load_lesson_specs(lesson_name)
+    wait_for_setup(lesson_name, lesson_specs, current_step_index)
     display_prompt(lesson_name, lesson_specs, current_step_index, verbose=verbose)
 
 
+@metrics.timed('dojo_step_navigation', command='next')
 def step_next(verbose=False):
     '''
     Show the next step.
@@ -328,9 +751,11 @@ def step_next(verbose=False):
 
     new_step_index = current_step_index + 1
     update_lesson_progress(lesson_name, new_step_index)
+    wait_for_setup(lesson_name, lesson_specs, new_step_index)
     display_prompt(lesson_name, lesson_specs, new_step_index, verbose=verbose)
 
 
+@metrics.timed('dojo_step_navigation', command='jump')
 def step_jump(step_number, verbose=False):
     '''
     Jump to a specified step number.
@@ -345,6 +770,7 @@ def step_jump(step_number, verbose=False):
 
     new_step_index = int(step_number) - 1
     update_lesson_progress(lesson_name, new_step_index)
+    wait_for_setup(lesson_name, lesson_specs, new_step_index)
     display_prompt(lesson_name, lesson_specs, new_step_index, verbose=verbose)
 
 
@@ -358,8 +784,10 @@ def step_add_note():
     # Get note from the user.
     note = str(input('Please enter your note: '))
 
-    # Record note in progress.csv.
+    # Record note in progress.csv (and in the notes search index).
     update_lesson_progress(lesson_name, current_step_index, note=note)
+    from dojo.notes import update_notes_index
+    update_notes_index(lesson_name)
 
     # Display the current step with the new note.
     display_prompt(lesson_name, lesson_specs, current_step_index)
@@ -373,11 +801,15 @@ def stop(completed_lesson_name=None):
     Stop the lesson and clean up its dojo_channels dir (if it exists).
     '''
     if completed_lesson_name:
-        clean_dojo_channels(completed_lesson_name)
+        cancel_background_setup(completed_lesson_name)
+        with timed_phase(completed_lesson_name, 'clean'):
+            clean_dojo_channels(completed_lesson_name)
 
     else:  # User is stopping the lesson before finishing it.
         lesson_name, _ = get_latest()
         update_history(lesson_name, 'stop')
-        clean_dojo_channels(lesson_name)
+        cancel_background_setup(lesson_name)
+        with timed_phase(lesson_name, 'clean'):
+            clean_dojo_channels(lesson_name)
         print(f'Stopped lesson: {lesson_name}')
 
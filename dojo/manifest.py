@@ -0,0 +1,59 @@
+'''
+On-disk manifest of what a lesson's setup has materialized
+(feedstock snapshot, dojo_channels packages, repodata, .condarc).
+Setup compares it against the lesson's desired state and only redoes
+the steps that are missing or stale.
+'''
+import json
+import os
+from dojo import LESSONS_DIR
+
+
+MANIFEST_FILENAME = 'setup_manifest.json'
+
+
+def get_manifest_path(lesson_name):
+    return os.path.join(LESSONS_DIR, lesson_name, MANIFEST_FILENAME)
+
+
+def new_manifest(lesson_name):
+    return {
+        'lesson_name': lesson_name,
+        # {'url': ..., 'commit': ..., 'path': ...}
+        'feedstock': {},
+        # '<channel>/<subdir>/<fn>' -> {'url': ..., 'sha256': ..., 'path': ..., 'size': ..., 'mtime': ...}
+        # (plus 'transcoded_sha256', if it was transcoded to the .conda at 'path')
+        'packages': {},
+        # '<channel>/<subdir>' -> sha256 of its repodata.json
+        'repodata': {},
+        # Contents of the .condarc that was written.
+        'condarc': None,
+    }
+
+
+def load_manifest(lesson_name):
+    '''
+    Returns the lesson's setup manifest (an empty one if setup never ran,
+    or if the manifest can't be read).
+    '''
+    manifest_path = get_manifest_path(lesson_name)
+    manifest = new_manifest(lesson_name)
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest.update(json.load(f))
+        except ValueError:
+            print(f'WARNING: Ignoring unreadable setup manifest: {manifest_path}')
+    return manifest
+
+
+def save_manifest(lesson_name, manifest):
+    '''
+    Writes the manifest atomically, so an interrupted setup never leaves
+    a half-written manifest behind.
+    '''
+    manifest_path = get_manifest_path(lesson_name)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
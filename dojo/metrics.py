@@ -0,0 +1,202 @@
+'''
+Cumulative metrics of dojo's operations, for monitoring many dojo hosts.
+
+If DOJO_METRICS_FILE is set, dojo keeps counters and latency histograms for
+its operations (setup phases such as the feedstock clone and `conda index`,
+each package download, step navigation, etc.) across runs, and writes them
+to that file in the Prometheus text exposition format (e.g. for the node
+exporter's textfile collector).
+
+Updates are only kept in memory while a command runs, then merged into the
+file once at exit, so they don't slow down commands like `dojo n`.
+If DOJO_METRICS_FILE isn't set, none of this does anything.
+'''
+import atexit
+import fcntl
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from dojo import METRICS_PATH
+
+
+# Upper bounds (seconds) of the latency histograms' buckets.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRICS_HELP = {
+    'dojo_setup_phase_seconds': 'Time taken by each phase of lesson setup (e.g. feedstock clone, conda index).',
+    'dojo_setup_phase_total': 'Lesson setup phases run, by result.',
+    'dojo_package_download_seconds': 'Time taken by each package download.',
+    'dojo_package_download_total': 'Package downloads, by result.',
+    'dojo_package_download_bytes_total': 'Bytes of packages downloaded.',
+    'dojo_shared_download_lookups_total': 'Lookups of packages in the host\'s shared downloads, by result (hit or miss).',
+    'dojo_pkgs_cache_lookups_total': 'Lookups of lesson packages in the shared package cache, by result (hit or miss).',
+    'dojo_step_navigation_seconds': 'Time taken by step navigation commands (dojo p/c/n/j).',
+    'dojo_step_navigation_total': 'Step navigation commands, by result.',
+}
+
+# Updates made by this process (not yet written to the metrics file).
+# Series are keyed by (metric name, sorted label items).
+COUNTERS = {}
+HISTOGRAMS = {}
+FLUSH_AT_EXIT = []
+
+
+def is_enabled():
+    return bool(METRICS_PATH)
+
+
+def get_series_key(name, labels):
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+
+def register_flush():
+    if not FLUSH_AT_EXIT:
+        atexit.register(flush)
+        FLUSH_AT_EXIT.append(flush)
+
+
+def inc(name, value=1, **labels):
+    '''
+    Adds value to a counter.
+    '''
+    if not METRICS_PATH:
+        return
+    register_flush()
+    key = get_series_key(name, labels)
+    COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    '''
+    Records a value (e.g. a latency in seconds) in a histogram.
+    '''
+    if not METRICS_PATH:
+        return
+    register_flush()
+    key = get_series_key(name, labels)
+    histogram = HISTOGRAMS.setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if value <= bound:
+            histogram['buckets'][i] += 1
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+
+@contextmanager
+def timed(name, **labels):
+    '''
+    Records how long the block takes in the "<name>_seconds" histogram, and
+    counts it in "<name>_total" by result ("ok", or "error" if it raised or
+    exited with an error). Can also be used as a decorator.
+    '''
+    if not METRICS_PATH:
+        yield
+        return
+
+    start_time = time.monotonic()
+    result = 'error'
+    try:
+        yield
+        result = 'ok'
+    except SystemExit as e:
+        if not e.code:
+            result = 'ok'
+        raise
+    finally:
+        observe(f'{name}_seconds', time.monotonic() - start_time, **labels)
+        inc(f'{name}_total', result=result, **labels)
+
+
+def merge_state(state):
+    '''
+    Adds this process's updates to the cumulative state (as loaded from the state file).
+    '''
+    counters = state.setdefault('counters', {})
+    for key, value in COUNTERS.items():
+        series = json.dumps(key)
+        counters[series] = counters.get(series, 0) + value
+
+    histograms = state.setdefault('histograms', {})
+    for key, histogram in HISTOGRAMS.items():
+        series = json.dumps(key)
+        total = histograms.setdefault(series, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+        total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+        total['sum'] += histogram['sum']
+        total['count'] += histogram['count']
+    return state
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def render_state(state):
+    '''
+    Renders the cumulative state in the Prometheus text exposition format.
+    '''
+    # name -> (type, [lines])
+    metrics = {}
+    for series, value in state.get('counters', {}).items():
+        name, labels = json.loads(series)
+        metrics.setdefault(name, ('counter', []))[1].append(f'{name}{format_labels(labels)} {value}')
+
+    for series, histogram in state.get('histograms', {}).items():
+        name, labels = json.loads(series)
+        lines = metrics.setdefault(name, ('histogram', []))[1]
+        for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+            lines.append(f'{name}_bucket{format_labels(labels + [["le", str(bound)]])} {count}')
+        lines.append(f'{name}_bucket{format_labels(labels + [["le", "+Inf"]])} {histogram["count"]}')
+        lines.append(f'{name}_sum{format_labels(labels)} {histogram["sum"]}')
+        lines.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+
+    text = []
+    for name in sorted(metrics):
+        metric_type, lines = metrics[name]
+        text.append(f'# HELP {name} {METRICS_HELP.get(name, name)}')
+        text.append(f'# TYPE {name} {metric_type}')
+        text.extend(lines)
+    return '\n'.join(text) + '\n'
+
+
+def write_atomically(path, text):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def flush():
+    '''
+    Merges this process's updates into the metrics file (and the state file
+    next to it, which keeps the cumulative values). Concurrent dojo commands
+    take turns with a lock, and the files are replaced atomically, so the
+    exporter never reads a partially written file.
+    '''
+    if not (COUNTERS or HISTOGRAMS):
+        return
+    state_path = METRICS_PATH + '.json'
+    try:
+        with open(METRICS_PATH + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = {}
+                if os.path.exists(state_path):
+                    try:
+                        with open(state_path) as f:
+                            state = json.load(f)
+                    except ValueError:
+                        print(f'WARNING: Resetting unreadable metrics state: {state_path}', file=sys.stderr)
+                state = merge_state(state)
+                write_atomically(state_path, json.dumps(state))
+                write_atomically(METRICS_PATH, render_state(state))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    except OSError as e:
+        # Metrics should never get in the way of a lesson.
+        print(f'WARNING: Could not write metrics to {METRICS_PATH}: {e}', file=sys.stderr)
+    COUNTERS.clear()
+    HISTOGRAMS.clear()
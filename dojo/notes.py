@@ -0,0 +1,166 @@
+'''
+Full-text search over the notes learners add with `dojo a`.
+
+Notes live in each lesson's progress.csv. They're indexed into an SQLite
+FTS5 table (notes_index.sqlite in the dojo root), which is kept up to date
+incrementally: a lesson's notes are only re-read when its progress.csv
+has changed (by size or mtime) since it was last indexed.
+'''
+import csv
+import os
+import sqlite3
+import sys
+from colorama import Fore, Style
+from dojo import ROOT_DIR, LESSONS_DIR
+from dojo.utils import print_no_results, render_table
+
+
+NOTES_INDEX_PATH = os.path.join(ROOT_DIR, 'notes_index.sqlite')
+NOTES_COLUMNS = ['Lesson name', 'Step', 'Date', 'Note']
+SNIPPET_TOKENS = 16
+
+
+def open_index(index_path=NOTES_INDEX_PATH):
+    '''
+    Opens (or creates) the notes index.
+    '''
+    conn = sqlite3.connect(index_path)
+    conn.executescript('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes USING fts5(
+            note,
+            lesson_name UNINDEXED,
+            step UNINDEXED,
+            timestamp UNINDEXED,
+            tokenize = 'porter unicode61'
+        );
+        CREATE TABLE IF NOT EXISTS indexed_files (
+            lesson_name TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER
+        );
+    ''')
+    return conn
+
+
+def read_notes(progress_path):
+    '''
+    Yields (step_index, timestamp, note) for each row of a progress.csv that has a note.
+    '''
+    with open(progress_path, newline='') as f:
+        for row in csv.DictReader(f):
+            note = (row.get('note') or '').strip()
+            if note:
+                yield int(float(row['lesson_index'])), row['start_timestamp'], note
+
+
+def index_lesson(conn, lesson_name, lessons_dir=LESSONS_DIR):
+    '''
+    Re-indexes the lesson's notes if its progress.csv changed since it was
+    last indexed (or removes them, if it no longer exists).
+    Returns whether anything changed.
+    '''
+    progress_path = os.path.join(lessons_dir, lesson_name, 'progress.csv')
+    try:
+        st = os.stat(progress_path)
+        stat = (st.st_size, st.st_mtime_ns)
+    except FileNotFoundError:
+        stat = None
+
+    row = conn.execute('SELECT size, mtime_ns FROM indexed_files WHERE lesson_name = ?', (lesson_name,)).fetchone()
+    if row == stat or (row is None and stat is None):
+        return False
+
+    with conn:
+        conn.execute('DELETE FROM notes WHERE lesson_name = ?', (lesson_name,))
+        conn.execute('DELETE FROM indexed_files WHERE lesson_name = ?', (lesson_name,))
+        if stat is not None:
+            conn.executemany('INSERT INTO notes (note, lesson_name, step, timestamp) VALUES (?, ?, ?, ?)',
+                             ((note, lesson_name, step_index, ts) for step_index, ts, note in read_notes(progress_path)))
+            conn.execute('INSERT INTO indexed_files (lesson_name, size, mtime_ns) VALUES (?, ?, ?)',
+                         (lesson_name, stat[0], stat[1]))
+    return True
+
+
+def sync_index(conn, lessons_dir=LESSONS_DIR):
+    '''
+    Brings the whole index up to date (only re-reading the progress.csv
+    files that changed). Returns the number of lessons re-indexed.
+    '''
+    lesson_names = {entry.name for entry in os.scandir(lessons_dir) if entry.is_dir()}
+    lesson_names |= {name for (name,) in conn.execute('SELECT lesson_name FROM indexed_files')}
+    return sum(index_lesson(conn, lesson_name, lessons_dir) for lesson_name in sorted(lesson_names))
+
+
+def update_notes_index(lesson_name):
+    '''
+    Called after a note is added: re-indexes just that lesson, if the index exists
+    (otherwise, it's built on the first search).
+    '''
+    if not os.path.exists(NOTES_INDEX_PATH):
+        return
+    try:
+        conn = open_index()
+        try:
+            index_lesson(conn, lesson_name)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        # The note itself is safe in progress.csv; the next search will catch up.
+        print(f'WARNING: Could not update the notes index: {e}')
+
+
+def quote_query(query):
+    '''
+    Turns free text (e.g. "libstdc++ -> 0") into an FTS5 query that matches all of its words.
+    '''
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def iter_search_results(conn, query, limit=None, highlight=False):
+    '''
+    Yields [lesson_name, step, date, snippet] for the notes matching query,
+    best match (by bm25) first. The query can use FTS5 syntax (e.g. "pip OR wheel",
+    "libstd*"); if it isn't valid FTS5, its words are searched for as-is.
+    With highlight, the matching words in the snippet are colored.
+    '''
+    sql = f'''
+        SELECT lesson_name, step, timestamp, snippet(notes, 0, ?, ?, '...', {SNIPPET_TOKENS})
+        FROM notes WHERE notes MATCH ? ORDER BY rank
+    '''
+    if limit is not None:
+        sql += f' LIMIT {int(limit)}'
+    markers = (Fore.YELLOW, Fore.RESET) if highlight else ('', '')
+    try:
+        rows = conn.execute(sql, (*markers, query)).fetchall()
+    except sqlite3.OperationalError:
+        rows = conn.execute(sql, (*markers, quote_query(query))).fetchall()
+    for lesson_name, step_index, ts, snippet in rows:
+        yield [lesson_name, int(step_index) + 1, ts.split(' ')[0], snippet]
+
+
+def search_notes(query, fmt='grid', limit=None, offset=0, columns=None):
+    '''
+    Searches the notes in every lesson's progress.csv (updating the index first, if needed).
+    '''
+    # e.g. a query that isn't valid even once quoted, or an SQLite without FTS5.
+    try:
+        conn = open_index()
+        try:
+            sync_index(conn)
+            # Fetch one more row than the page, so render_table knows whether there's another page.
+            fetch_limit = None if limit is None else offset + limit + 1
+            if fmt == 'grid':
+                print(Fore.CYAN + f'\nNotes matching: "{query}"' + Style.RESET_ALL)
+            # Only the table (on a terminal) is colored; "tsv" and "json" are meant for scripts.
+            highlight = fmt == 'grid' and sys.stdout.isatty()
+            num_rows = render_table(iter_search_results(conn, query, fetch_limit, highlight), NOTES_COLUMNS,
+                                    fmt=fmt, limit=limit, offset=offset, columns=columns)
+        finally:
+            conn.close()
+    except sqlite3.OperationalError as e:
+        print(f'ERROR: Could not search notes: {e}', file=sys.stdout if fmt == 'grid' else sys.stderr)
+        sys.exit(1)
+
+    if num_rows == 0 and offset == 0:
+        print_no_results(f'No notes match: "{query}"', fmt)
+        sys.exit()
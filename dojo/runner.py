@@ -0,0 +1,324 @@
+'''
+Headless lesson runner (`dojo run-lessons`).
+
+Checks that lessons still reproduce: for each lesson, it sets up the lesson in
+an isolated workspace (its own lessons dir, training_feedstocks, HOME/.condarc
+and package cache), runs the commands listed under `checks` in its
+lesson.yaml, and compares their exit status and output with what the lesson
+expects. Lessons run in parallel, each with a timeout, and the results can be
+written as a JUnit XML and/or JSON report.
+'''
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dojo import LESSONS_DIR
+from dojo.utils import load_lesson_specs
+from pathlib import Path
+
+
+# Lines of output kept in the report for each command.
+OUTPUT_TAIL_LINES = 50
+# Files in a lesson directory that belong to a learner's run, not to the lesson.
+LEARNER_FILES = ('progress.csv', 'dojo_channels', 'setup_manifest.json', 'setup_status.json', 'setup.log',
+                 'setup.lock')
+
+
+def get_check_problems(check):
+    '''
+    Returns what's wrong with a check from a lesson.yaml (nothing, if it's valid).
+    '''
+    if not isinstance(check, dict) or not check.get('command'):
+        return ['should have a "command"']
+    problems = []
+    expect_exit = check.get('expect_exit', 0)
+    if expect_exit != 'nonzero' and (not isinstance(expect_exit, int) or isinstance(expect_exit, bool)):
+        problems.append('"expect_exit" should be an exit status or "nonzero"')
+    if check.get('expect_output') is not None:
+        try:
+            re.compile(check['expect_output'])
+        except (re.error, TypeError) as e:
+            problems.append(f'"expect_output" is not a valid regular expression: {e}')
+    return problems
+
+
+def get_checks(lesson_specs):
+    '''
+    Returns the lesson's checks, with defaults filled in:
+    [{'command': ..., 'expect_exit': 0, 'expect_output': None, 'problems': []}, ...]
+    A malformed check lists its problems (and is never run).
+    '''
+    lesson_checks = lesson_specs.get('checks') or []
+    if not isinstance(lesson_checks, list):
+        return [{'command': None, 'expect_exit': 0, 'expect_output': None, 'problems': ['"checks" should be a list']}]
+    checks = []
+    for check in lesson_checks:
+        problems = get_check_problems(check)
+        if not isinstance(check, dict):
+            check = {}
+        checks.append({
+            'command': check.get('command'),
+            'expect_exit': check.get('expect_exit', 0),
+            'expect_output': check.get('expect_output'),
+            'problems': problems,
+        })
+    return checks
+
+
+def get_lessons_with_checks():
+    return sorted(lesson_name for lesson_name in os.listdir(LESSONS_DIR)
+                  if os.path.exists(os.path.join(LESSONS_DIR, lesson_name, 'lesson.yaml'))
+                  and get_checks(load_lesson_specs(lesson_name)))
+
+
+def make_lesson_workspace(workspace_path, lesson_name):
+    '''
+    Lays out a dojo root directory holding only a copy of the lesson (without
+    any learner's progress), with its own HOME, package cache and conda-bld
+    directory. The dojo settings of the environment (DOJO_*, e.g. a shared
+    directory or metrics file) aren't passed on.
+    Returns the workspace's environment variables.
+    '''
+    shutil.copytree(os.path.join(LESSONS_DIR, lesson_name), os.path.join(workspace_path, 'lessons', lesson_name),
+                    ignore=shutil.ignore_patterns(*LEARNER_FILES))
+    Path(os.path.join(workspace_path, 'training_feedstocks')).mkdir()
+    Path(os.path.join(workspace_path, 'home')).mkdir()
+    with open(os.path.join(workspace_path, 'curriculum.yaml'), 'w') as f:
+        f.write(f'topics:\n    run_lessons:\n        - {lesson_name}\n')
+
+    env = {name: value for name, value in os.environ.items() if not name.startswith('DOJO_')}
+    env['HOME'] = os.path.join(workspace_path, 'home')
+    env['CONDARC'] = os.path.join(workspace_path, 'home', '.condarc')
+    env['DOJO_PKGS_DIR'] = os.path.join(workspace_path, 'pkgs')
+    env['CONDA_BLD_PATH'] = os.path.join(workspace_path, 'conda-bld')
+    # Make `python -m dojo` work from the workspace, even if dojo isn't installed.
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+    return env
+
+
+def run_command(command, cwd, env, timeout):
+    '''
+    Runs a shell command, killing it (and anything it started) if it takes
+    longer than timeout seconds.
+    Returns (exit code, combined stdout and stderr, timed out?).
+    '''
+    process = subprocess.Popen(command, shell=True, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                               start_new_session=True)
+    try:
+        output, _ = process.communicate(timeout=max(timeout, 0))
+        return process.returncode, output, False
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        output, _ = process.communicate()
+        return process.returncode, output, True
+
+
+def get_tail(output):
+    return '\n'.join(output.splitlines()[-OUTPUT_TAIL_LINES:])
+
+
+def evaluate_check(check, exit_code, output):
+    '''
+    Returns a list of the ways the command's result differs from what the check expects.
+    '''
+    problems = []
+    expect_exit = check['expect_exit']
+    if expect_exit == 'nonzero':
+        if exit_code == 0:
+            problems.append('expected a non-zero exit status, got 0')
+    elif exit_code != int(expect_exit):
+        problems.append(f'expected exit status {expect_exit}, got {exit_code}')
+    if check['expect_output'] and not re.search(check['expect_output'], output, re.MULTILINE):
+        problems.append(f'output did not match: {check["expect_output"]}')
+    return problems
+
+
+def new_result(lesson_name, status='passed', message=''):
+    return {'lesson_name': lesson_name, 'status': status, 'message': message, 'seconds': 0.0,
+            'workspace': None, 'setup': None, 'checks': []}
+
+
+def run_lesson(lesson_name, timeout, workdir=None, keep=False):
+    '''
+    Sets up the lesson in a fresh workspace and runs its checks, all within
+    timeout seconds. Returns the lesson's result (see the JSON report).
+    '''
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+    result = new_result(lesson_name)
+
+    checks = get_checks(load_lesson_specs(lesson_name))
+    if not checks:
+        result['status'] = 'skipped'
+        result['message'] = 'The lesson has no checks in its lesson.yaml.'
+        return result
+
+    invalid = [(i, check) for i, check in enumerate(checks, 1) if check['problems']]
+    if invalid:
+        result['status'] = 'error'
+        result['message'] = 'Invalid check(s) in lesson.yaml: ' + '; '.join(
+            f'check {i}: {", ".join(check["problems"])}' for i, check in invalid)
+        result['checks'] = [dict(check, exit_code=None, seconds=0.0, output='',
+                                 status='invalid' if check['problems'] else 'skipped') for check in checks]
+        return result
+
+    workspace_path = tempfile.mkdtemp(prefix=f'dojo_run_{lesson_name}_', dir=workdir)
+    result['workspace'] = workspace_path
+    try:
+        env = make_lesson_workspace(workspace_path, lesson_name)
+
+        setup_start = time.monotonic()
+        exit_code, output, timed_out = run_command(f'"{sys.executable}" -m dojo start {lesson_name}',
+                                                   workspace_path, env, deadline - time.monotonic())
+        result['setup'] = {'exit_code': exit_code, 'seconds': time.monotonic() - setup_start,
+                           'output': get_tail(output)}
+        if timed_out:
+            result['status'] = 'timeout'
+            result['message'] = f'Timed out after {timeout} s while setting up the lesson.'
+            return result
+        if exit_code != 0:
+            result['status'] = 'error'
+            result['message'] = f'Setting up the lesson failed (exit status {exit_code}).'
+            return result
+
+        for check in checks:
+            check_start = time.monotonic()
+            exit_code, output, timed_out = run_command(check['command'], workspace_path, env,
+                                                       deadline - time.monotonic())
+            check_result = dict(check, exit_code=exit_code, seconds=time.monotonic() - check_start,
+                                status='passed', problems=[], output=get_tail(output))
+            result['checks'].append(check_result)
+            if timed_out:
+                check_result['status'] = 'timeout'
+                result['status'] = 'timeout'
+                result['message'] = f'Timed out after {timeout} s running: {check["command"]}'
+                break
+            check_result['problems'] = evaluate_check(check, exit_code, output)
+            if check_result['problems']:
+                check_result['status'] = 'failed'
+                result['status'] = 'failed'
+                result['message'] = f'{check["command"]}: ' + '; '.join(check_result['problems'])
+        return result
+    finally:
+        result['seconds'] = time.monotonic() - start_time
+        if not keep:
+            shutil.rmtree(workspace_path, ignore_errors=True)
+            result['workspace'] = None
+
+
+#################
+#    REPORTS    #
+#################
+
+def write_json_report(results, report_path):
+    with open(report_path, 'w') as f:
+        json.dump({'lessons': results}, f, indent=2)
+
+
+# Characters that XML 1.0 doesn't allow (e.g. the escape codes of colored output).
+XML_ILLEGAL_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def write_junit_report(results, report_path):
+    '''
+    One test suite per lesson, and one test case per check (plus one for
+    the lesson's setup).
+    '''
+    testsuites = ET.Element('testsuites', name='dojo run-lessons')
+    for result in results:
+        testcases = []
+        if result['setup'] is not None:
+            setup_passed = result['setup']['exit_code'] == 0
+            testcases.append(('setup', result['setup']['seconds'], result['setup']['output'],
+                              'passed' if setup_passed else result['status'],
+                              '' if setup_passed else result['message']))
+        for i, check in enumerate(result['checks'], 1):
+            testcases.append((f'check {i}: {check["command"] or "(no command)"}', check['seconds'], check['output'],
+                              check['status'], '; '.join(check['problems']) or result['message']))
+        if result['status'] == 'skipped':
+            testcases.append(('checks', 0.0, '', 'skipped', result['message']))
+        elif not testcases:
+            # The lesson failed before anything ran (e.g. its lesson.yaml couldn't be read).
+            testcases.append(('lesson', result['seconds'], '', result['status'], result['message']))
+
+        testsuite = ET.SubElement(testsuites, 'testsuite', name=result['lesson_name'],
+                                  tests=str(len(testcases)), time=f'{result["seconds"]:.3f}',
+                                  failures=str(sum(status == 'failed' for _, _, _, status, _ in testcases)),
+                                  errors=str(sum(status in ('error', 'timeout', 'invalid')
+                                                 for _, _, _, status, _ in testcases)),
+                                  skipped=str(sum(status == 'skipped' for _, _, _, status, _ in testcases)))
+        for name, seconds, output, status, message in testcases:
+            output = XML_ILLEGAL_CHARS.sub('', output)
+            message = XML_ILLEGAL_CHARS.sub('', message)
+            testcase = ET.SubElement(testsuite, 'testcase', classname=f'lessons.{result["lesson_name"]}',
+                                     name=name, time=f'{seconds:.3f}')
+            if status == 'failed':
+                ET.SubElement(testcase, 'failure', message=message).text = output
+            elif status in ('error', 'timeout', 'invalid'):
+                ET.SubElement(testcase, 'error', message=message).text = output
+            elif status == 'skipped':
+                ET.SubElement(testcase, 'skipped', message=message)
+            if output and status == 'passed':
+                ET.SubElement(testcase, 'system-out').text = output
+
+    ET.ElementTree(testsuites).write(report_path, encoding='utf-8', xml_declaration=True)
+
+
+def run_lessons(lesson_names=None, jobs=None, timeout=1800, junit_path=None, json_path=None,
+                workdir=None, keep=False):
+    '''
+    Runs the checks of the given lessons (by default, every lesson that has
+    checks) in parallel, and reports the results.
+    '''
+    if not lesson_names:
+        lesson_names = get_lessons_with_checks()
+        if not lesson_names:
+            print('No lessons have checks in their lesson.yaml.')
+            sys.exit(1)
+    for lesson_name in lesson_names:
+        if not os.path.exists(os.path.join(LESSONS_DIR, lesson_name, 'lesson.yaml')):
+            print(f'ERROR: Lesson not found: {lesson_name}')
+            sys.exit(1)
+
+    print(f'Running {len(lesson_names)} lesson(s), timeout {timeout} s each...')
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = {executor.submit(run_lesson, lesson_name, timeout, workdir, keep): lesson_name
+                   for lesson_name in lesson_names}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except SystemExit as e:
+                result = new_result(futures[future], 'error', f'The runner exited with status {e.code}.')
+            except Exception as e:
+                # e.g. an unreadable lesson.yaml, or a worker that died. The other lessons still run.
+                result = new_result(futures[future], 'error', f'The runner failed: {type(e).__name__}: {e}')
+            results.append(result)
+            line = f'{result["status"].upper():<8} {result["lesson_name"]} ({result["seconds"]:.1f} s)'
+            if result['message']:
+                line += f': {result["message"]}'
+            if result['workspace']:
+                line += f'\n         workspace: {result["workspace"]}'
+            print(line)
+
+    results.sort(key=lambda result: result['lesson_name'])
+    if junit_path:
+        write_junit_report(results, junit_path)
+        print(f'Wrote JUnit report: {junit_path}')
+    if json_path:
+        write_json_report(results, json_path)
+        print(f'Wrote JSON report: {json_path}')
+
+    num_bad = sum(result['status'] in ('failed', 'error', 'timeout') for result in results)
+    print(f'\n{len(results) - num_bad} of {len(results)} lesson(s) passed or were skipped.')
+    if num_bad:
+        sys.exit(1)
@@ -0,0 +1,290 @@
+'''
+Batch import and merge of learner state (`dojo state merge`).
+
+Training coordinators collect history.csv and progress.csv files from many
+learners' containers, e.g.:
+
+    collected/
+      |---- alice/
+      |       |---- 2021-04-01/history.csv
+      |       |---- 2021-04-01/lessons/001_version_bump/progress.csv
+      |       |---- 2021-04-08/...
+      |---- bob/...
+
+This merges them into one deduplicated dojo root per learner:
+
+    merged/
+      |---- alice/history.csv
+      |---- alice/lessons/001_version_bump/progress.csv
+      |---- bob/...
+
+Every row of every file is an event. Events are read in a streaming fashion,
+sorted in bounded-size runs that are spilled to disk, and then combined with
+an external k-way merge (by learner, then timestamp). Duplicate events (e.g.
+from overlapping exports of the same container) are dropped as the merged
+stream is written out in a single pass.
+'''
+import csv
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+from itertools import islice
+from pathlib import Path
+
+
+HISTORY_COLUMNS = ['timestamp', 'lesson_name', 'action', 'active', 'completed']
+PROGRESS_COLUMNS = ['lesson_name', 'start_timestamp', 'lesson_index', 'note']
+# Events sorted in memory at a time (before being spilled to disk as a sorted run).
+MAX_EVENTS_IN_MEMORY = 500000
+# Runs merged at a time (to stay well under the limit of open files).
+MAX_MERGE_FAN_IN = 128
+
+# An event is a tuple:
+#   (learner, timestamp, kind, row_number, source, lesson_name, field_1, field_2, field_3)
+# kind is "history" or "progress". For history, the fields are action, active
+# and completed; for progress, they're lesson_index, note and "". row_number
+# (the row's position in its file) keeps events with the same timestamp in
+# the order they happened. source numbers the file the event was read from.
+ROW_NUMBER = 3
+SOURCE = 4
+
+
+#################
+#    READING    #
+#################
+
+def get_learner(input_path, file_path):
+    '''
+    The learner is the first directory under the input path, e.g.
+    "collected/alice/2021-04-01/history.csv" -> "alice" (or the input
+    directory's own name, if the state files are right in it).
+    '''
+    relpath = os.path.relpath(file_path, input_path)
+    parts = Path(relpath).parts
+    if parts[0] in ('history.csv', 'lessons'):
+        return os.path.basename(os.path.abspath(input_path))
+    return parts[0]
+
+
+def find_state_files(input_paths):
+    '''
+    Yields (learner, kind, path) for every history.csv and
+    lessons/<lesson>/progress.csv under the input directories.
+    '''
+    for input_path in input_paths:
+        if not os.path.isdir(input_path):
+            print(f'ERROR: Not a directory: {input_path}')
+            sys.exit(1)
+        for root, dirs, fns in os.walk(input_path):
+            dirs.sort()
+            for fn in sorted(fns):
+                path = os.path.join(root, fn)
+                if fn == 'history.csv':
+                    yield get_learner(input_path, path), 'history', path
+                elif fn == 'progress.csv' and os.path.basename(os.path.dirname(root)) == 'lessons':
+                    yield get_learner(input_path, path), 'progress', path
+
+
+def normalize_step(value):
+    # pandas may have written the step index as a float (e.g. "3.0").
+    try:
+        return str(int(float(value)))
+    except ValueError:
+        return value
+
+
+def read_events(input_paths):
+    '''
+    Streams the events of every state file under the input directories.
+    '''
+    for source, (learner, kind, path) in enumerate(find_state_files(input_paths)):
+        with open(path, newline='') as f:
+            for row_number, row in enumerate(csv.DictReader(f)):
+                if kind == 'history':
+                    yield (learner, row['timestamp'], kind, row_number, source, row['lesson_name'],
+                           row['action'], row['active'], row['completed'])
+                else:
+                    yield (learner, row['start_timestamp'], kind, row_number, source, row['lesson_name'],
+                           normalize_step(row['lesson_index']), row.get('note') or '', '')
+
+
+#############################
+#    EXTERNAL MERGE SORT    #
+#############################
+
+def write_run(events, run_path):
+    with open(run_path, 'w', newline='') as f:
+        csv.writer(f).writerows(events)
+
+
+def read_run(run_path):
+    with open(run_path, newline='') as f:
+        for event in csv.reader(f):
+            event[ROW_NUMBER] = int(event[ROW_NUMBER])
+            event[SOURCE] = int(event[SOURCE])
+            yield tuple(event)
+
+
+def spill_sorted_runs(events, tmp_dir, max_events_in_memory):
+    '''
+    Sorts the events in chunks of at most max_events_in_memory, writing
+    each sorted chunk to its own run file. Returns the run paths.
+    '''
+    run_paths = []
+    events = iter(events)
+    while True:
+        chunk = list(islice(events, max_events_in_memory))
+        if not chunk:
+            break
+        chunk.sort()
+        run_path = os.path.join(tmp_dir, f'run_{len(run_paths):06d}.csv')
+        write_run(chunk, run_path)
+        run_paths.append(run_path)
+    return run_paths
+
+
+def merge_runs(run_paths, tmp_dir):
+    '''
+    k-way merges sorted runs into one sorted stream of events. If there are
+    more runs than can be open at once, they're merged in rounds first.
+    '''
+    generation = 0
+    while len(run_paths) > MAX_MERGE_FAN_IN:
+        merged_paths = []
+        for i in range(0, len(run_paths), MAX_MERGE_FAN_IN):
+            batch = run_paths[i:i + MAX_MERGE_FAN_IN]
+            merged_path = os.path.join(tmp_dir, f'merged_{generation}_{len(merged_paths):06d}.csv')
+            write_run(heapq.merge(*(read_run(path) for path in batch)), merged_path)
+            for path in batch:
+                os.remove(path)
+            merged_paths.append(merged_path)
+        run_paths = merged_paths
+        generation += 1
+    return heapq.merge(*(read_run(path) for path in run_paths))
+
+
+def dedup_events(events):
+    '''
+    Drops repeated events (the same event seen in several exports). Events
+    are identical if everything but their row number and source matches.
+    An event can legitimately happen more than once in the same second
+    (e.g. `dojo p` twice), so each one is kept as many times as it appears
+    in any single source file (the most of any source), not just once.
+    Since the stream is sorted, only the events sharing the current learner
+    and timestamp need to be counted.
+    '''
+    current = None
+    counts = {}
+    kept = {}
+    for event in events:
+        if event[:2] != current:
+            current = event[:2]
+            counts.clear()
+            kept.clear()
+        key = event[:ROW_NUMBER] + event[SOURCE + 1:]
+        source_key = (key, event[SOURCE])
+        counts[source_key] = counts.get(source_key, 0) + 1
+        if counts[source_key] > kept.get(key, 0):
+            kept[key] = counts[source_key]
+            yield event
+
+
+#################
+#    WRITING    #
+#################
+
+class LearnerWriter:
+    '''
+    Writes one learner's merged dojo root (history.csv, and a progress.csv
+    per lesson), keeping only that learner's files open.
+    '''
+    def __init__(self, output_path, learner):
+        self.learner_path = os.path.join(output_path, learner)
+        Path(self.learner_path).mkdir(parents=True, exist_ok=True)
+        self.files = []
+        self.history = self.open_writer(os.path.join(self.learner_path, 'history.csv'), HISTORY_COLUMNS)
+        self.progress = {}
+
+    def open_writer(self, path, columns):
+        f = open(path, 'w', newline='')
+        self.files.append(f)
+        # Same line endings as the files dojo writes with pandas.
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(columns)
+        return writer
+
+    def write(self, event):
+        _, timestamp, kind, _, _, lesson_name, field_1, field_2, field_3 = event
+        if kind == 'history':
+            self.history.writerow([timestamp, lesson_name, field_1, field_2, field_3])
+        else:
+            if lesson_name not in self.progress:
+                lesson_path = os.path.join(self.learner_path, 'lessons', lesson_name)
+                Path(lesson_path).mkdir(parents=True, exist_ok=True)
+                self.progress[lesson_name] = self.open_writer(os.path.join(lesson_path, 'progress.csv'),
+                                                              PROGRESS_COLUMNS)
+            self.progress[lesson_name].writerow([lesson_name, timestamp, field_1, field_2])
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+def write_merged(events, output_path):
+    '''
+    Writes the sorted, deduplicated events out in a single pass.
+    Returns (number of learners, number of events written).
+    '''
+    writer = None
+    learner = None
+    num_learners = 0
+    num_events = 0
+    try:
+        for event in events:
+            if event[0] != learner:
+                if writer:
+                    writer.close()
+                learner = event[0]
+                writer = LearnerWriter(output_path, learner)
+                num_learners += 1
+            writer.write(event)
+            num_events += 1
+    finally:
+        if writer:
+            writer.close()
+    return num_learners, num_events
+
+
+def merge_state(input_paths, output_path, max_events_in_memory=MAX_EVENTS_IN_MEMORY, tmp_dir=None, quiet=False):
+    '''
+    Merges the state files under the input directories into one
+    deduplicated dojo root per learner, under output_path.
+    Returns (number of events read, number of learners, number of events written).
+    '''
+    if os.path.exists(output_path) and os.listdir(output_path):
+        print(f'ERROR: The output directory is not empty: {output_path}')
+        sys.exit(1)
+
+    work_dir = tempfile.mkdtemp(prefix='dojo_state_merge_', dir=tmp_dir)
+    try:
+        num_read = 0
+
+        def count(events):
+            nonlocal num_read
+            for event in events:
+                num_read += 1
+                yield event
+
+        run_paths = spill_sorted_runs(count(read_events(input_paths)), work_dir, max_events_in_memory)
+        Path(output_path).mkdir(parents=True, exist_ok=True)
+        num_learners, num_written = write_merged(dedup_events(merge_runs(run_paths, work_dir)), output_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not quiet:
+        print(f'Read {num_read} events ({len(run_paths)} sorted run(s)); wrote {num_written} events '
+              f'for {num_learners} learner(s) to: {output_path}')
+        print(f'  Dropped {num_read - num_written} duplicate event(s).')
+    return num_read, num_learners, num_written
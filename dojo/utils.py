@@ -1,17 +1,24 @@
 '''
 Utilities for dojo commands.
 '''
+import csv
+import hashlib
 import io
 import json
+import mmap
 import os
 import pandas as pd
 import requests
 import sys
+import time
 import yaml
 from collections import Counter
 from colorama import Fore, Back, Style
+from contextlib import contextmanager
 from datetime import datetime
-from dojo import ROOT_DIR, LESSONS_DIR
+from itertools import islice
+from dojo import ROOT_DIR, LESSONS_DIR, PHASE_TIMINGS_PATH
+from dojo import metrics
 from pathlib import Path
 from tabulate import tabulate
 
@@ -25,6 +32,24 @@ except ImportError:
 
 
 PROGRESS_COLUMNS = ['lesson_name', 'start_timestamp', 'lesson_index', 'note']
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Seconds to wait for an upstream channel to respond.
+UPSTREAM_TIMEOUT = 60
+
+# Upstream checksums ({fn: [sha256, md5]}, keyed by "<channel URL>/<subdir>"), fetched as needed.
+UPSTREAM_REPODATA = {}
+
+
+class ChecksumMismatchError(Exception):
+    '''
+    A downloaded package didn't match its expected checksum(s).
+    '''
+
+
+class CommitNotFoundError(Exception):
+    '''
+    A lesson's commit couldn't be fetched from its feedstock.
+    '''
 
 
 def add_lesson_yaml(new_lesson_path):
@@ -35,9 +60,19 @@ def add_lesson_yaml(new_lesson_path):
     print('Created new lesson.yaml template.')
 
 
-def download_package(url, destination_path):
+@metrics.timed('dojo_package_download')
+def download_package(url, destination_path, expected_sha256=None, expected_md5=None, throttle=None,
+                     chunk_size=DOWNLOAD_CHUNK_SIZE):
     '''
     Adapted from jpmds/workflow/download.py
+
+    The data is hashed as it streams in, and checked against the expected
+    checksum(s) before the file is moved into place. On a mismatch (e.g. a
+    corrupt or truncated download), nothing is kept and ChecksumMismatchError
+    is raised.
+    If given, throttle(num_bytes) is called after each chunk (e.g. to wait
+    for the host's bandwidth budget).
+    Returns the sha256 of the downloaded file.
     '''
     # Make sure the directory path exists for each channel and subdir.
     pkg_path_parent_dir_parts = destination_path.split('/')[:-1]
@@ -50,19 +85,103 @@ def download_package(url, destination_path):
 
     print(f'  Downloading: {basename} from: {channel}')
 
-    r = requests.get(url, stream=True)
+    r = requests.get(url, stream=True, timeout=UPSTREAM_TIMEOUT)
 
     # The easiest way to notify the user that something went wrong is to 
     # terminate, loudly. this will raise an HTTPError if 
     # 400 <= status_code < 600, otherwise, no-op.
     r.raise_for_status()
 
-    with open(destination_path, 'wb') as f:
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5() if expected_md5 else None
+    partial_path = destination_path + '.partial'
+    num_bytes = 0
+    with open(partial_path, 'wb') as f:
         # Updated to follow: 
         # https://requests.readthedocs.io/en/master/user/quickstart/#raw-response-content
         # shutil.copyfileobj(r.raw, f)
-        for chunk in r.iter_content(chunk_size=128):
+        for chunk in r.iter_content(chunk_size=chunk_size):
             f.write(chunk)
+            sha256.update(chunk)
+            if md5:
+                md5.update(chunk)
+            num_bytes += len(chunk)
+            if throttle:
+                throttle(len(chunk))
+
+    mismatches = []
+    if expected_sha256 and sha256.hexdigest() != expected_sha256.lower():
+        mismatches.append(f'sha256 {sha256.hexdigest()} (expected {expected_sha256})')
+    if md5 and md5.hexdigest() != expected_md5.lower():
+        mismatches.append(f'md5 {md5.hexdigest()} (expected {expected_md5})')
+    if mismatches:
+        os.remove(partial_path)
+        raise ChecksumMismatchError(f'Checksum mismatch for {url}: ' + ', '.join(mismatches))
+
+    os.replace(partial_path, destination_path)
+    metrics.inc('dojo_package_download_bytes_total', num_bytes)
+    return sha256.hexdigest()
+
+
+def fetch_upstream_checksums(subdir_url):
+    '''
+    Fetches the checksums of every package in an upstream channel subdir's
+    repodata.json, as {fn: [sha256, md5]}. Returns None if it can't be fetched.
+    '''
+    try:
+        r = requests.get(f'{subdir_url}/repodata.json', timeout=UPSTREAM_TIMEOUT)
+        r.raise_for_status()
+        repodata = r.json()
+    except (requests.RequestException, ValueError):
+        print(f'  WARNING: Could not fetch repodata from: {subdir_url}')
+        return None
+    checksums = {}
+    for key in ('packages', 'packages.conda'):
+        for fn, record in (repodata.get(key) or {}).items():
+            checksums[fn] = [record.get('sha256'), record.get('md5')]
+    return checksums
+
+
+def get_upstream_checksums(url, fetch_checksums=fetch_upstream_checksums):
+    '''
+    Looks up a package's checksums in its upstream channel's repodata.json.
+    Each channel/subdir's checksums are fetched (with fetch_checksums) only
+    once per process.
+    Returns (sha256, md5), either of which may be None.
+    '''
+    subdir_url, fn = url.rsplit('/', 1)
+    if subdir_url not in UPSTREAM_REPODATA:
+        UPSTREAM_REPODATA[subdir_url] = fetch_checksums(subdir_url) or {}
+    sha256, md5 = UPSTREAM_REPODATA[subdir_url].get(fn) or (None, None)
+    return sha256, md5
+
+
+def parse_package_url(line):
+    '''
+    Splits a line from dojo_channels_pkgs.txt into the package URL and its
+    checksums. A checksum may be appended after a "#", like the output of
+    `conda list --explicit --md5` (or a 64-character sha256 instead).
+    Returns (url, sha256, md5).
+    '''
+    url, _, checksum = line.strip().partition('#')
+    checksum = checksum.strip().lower()
+    if len(checksum) == 64:
+        return url, checksum, None
+    elif len(checksum) == 32:
+        return url, None, checksum
+    return url, None, None
+
+
+def hash_file(path, algorithm='sha256'):
+    '''
+    Hashes a file using a memory-mapped read (no copying through Python buffers).
+    '''
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+    return h.hexdigest()
 
 
 def get_latest():
@@ -113,39 +232,38 @@ def get_timestamp_for_action():
 #    TAGS    #
 ##############
 
-def search_tag(search_tag):
+def search_tag(search_tag, fmt='grid', limit=None, offset=0, columns=None):
     '''
     Searches each lesson's lesson.yaml to see if they match
     for the given tag.
     '''
-    # Final list of lists that looks like:
-    # Title   LessonName    Objectives    MatchingTag    
-    results = []
+    def iter_matches():
+        # Rows look like:
+        # Title   LessonName    Objectives    MatchingTag
+        from glob import glob
+        all_lesson_paths = sorted(glob(os.path.join(LESSONS_DIR,'*')))
+        for lesson_path in all_lesson_paths:
+            lesson_name = lesson_path.split('/')[-1]
+            lesson_specs = load_lesson_specs(lesson_name)
+            tags = lesson_specs['tags']
+
+            # Search for tag.
+            for tag in tags:
+                if search_tag.lower() in tag.lower():
+                    title = lesson_specs['title']
+                    objectives = ' * '.join(str(obj) for obj in lesson_specs['objectives'])
+                    yield [title, lesson_name, objectives, tag]
+
+    if fmt == 'grid':
+        print(Fore.CYAN + f'\nSearch results for: "{search_tag}"')
+    num_rows = render_table(iter_matches(), SEARCH_COLUMNS, fmt=fmt, limit=limit, offset=offset, columns=columns)
+    if fmt == 'grid':
+        print(Style.RESET_ALL)
 
-    # Load every lesson.yaml
-    from glob import glob
-    all_lesson_paths = glob(os.path.join(LESSONS_DIR,'*'))
-    for lesson_path in all_lesson_paths:
-        lesson_name = lesson_path.split('/')[-1]
-        lesson_specs = load_lesson_specs(lesson_name)
-        tags = lesson_specs['tags']
-
-        # Search for tag.
-        for tag in tags:
-            if search_tag.lower() in tag.lower():
-                title = lesson_specs['title']
-                objectives = ' * '.join(str(obj) for obj in lesson_specs['objectives'])
-                match = [title, lesson_name, objectives, tag]
-                results.append(match)
-
-    if not results:
-        print(f'No results for: "{search_tag}"')
+    if num_rows == 0 and offset == 0:
+        print_no_results(f'No results for: "{search_tag}"', fmt)
         sys.exit()
 
-    print(Fore.CYAN + f'\nSearch results for: "{search_tag}"')
-    print(tabulate(sorted(results), headers=['Title', 'Lesson Name', 'Objectives', 'Matching Tag'], maxcolwidths=[30, 30, 30, 30], tablefmt="grid"))
-    print(Style.RESET_ALL)    
-
 
 #################
 #    HISTORY    #
@@ -225,38 +343,38 @@ def load_lesson_specs(lesson_name):
         sys.exit(1)
 
 
-def show_lessons(status=None):
-    # Columns:
-    # topic, title, lesson_name, objectives, author(s), tags
-    curriculum_specs = load_curriculum_specs()
+def get_completed_lessons():
+    '''
+    Returns the set of lesson names that have been completed,
+    read straight from history.csv.
+    '''
+    history_path = os.path.join(ROOT_DIR, 'history.csv')
+    if not os.path.exists(history_path):
+        return set()
+    with open(history_path, newline='') as f:
+        return {row['lesson_name'] for row in csv.DictReader(f) if row['completed'] == 'True'}
 
-    results = []
-    for topic, lessons in curriculum_specs['topics'].items():
-        for lesson_name in lessons:
-            lesson_specs = load_lesson_specs(lesson_name)
-            title = lesson_specs['title']
-            objectives = ' * '.join(str(obj) for obj in lesson_specs['objectives'])
-            authors = ', '.join(str(author) for author in lesson_specs['authors'])
-            tags = '; '.join(str(tag) for tag in lesson_specs['tags'])
-
-            df_history = load_history()
-            df_completed = df_history[(df_history.lesson_name == lesson_name) & (df_history.completed == True)]
-            if df_completed.empty:
-                completed = False
-            else:
-                completed = True
 
-            result_row = [topic, title, lesson_name, objectives, authors, tags, completed]
-            results.append(result_row)
+def iter_curriculum_lessons():
+    '''
+    Yields (topic, lesson_name) for every lesson in the curriculum,
+    sorted by topic and lesson name.
+    '''
+    curriculum_specs = load_curriculum_specs()
+    for topic in sorted(curriculum_specs['topics']):
+        for lesson_name in sorted(curriculum_specs['topics'][topic] or []):
+            yield topic, lesson_name
 
-    columns = ['Topic', 'Title', 'Lesson name', 'Objectives', 'Author(s)', 'Tags', 'Completed']
-    df_results = pd.DataFrame(results, columns=columns)
+
+def show_lessons(status=None, fmt='grid', limit=None, offset=0, columns=None):
+    # Columns:
+    # topic, title, lesson_name, objectives, author(s), tags
+    completed_lessons = get_completed_lessons()
 
     if status == 'authors':
-        authors_column = df_results['Author(s)'].tolist()
-        authors_for_lesson = [i.split(', ') for i in authors_column]
-        author_instances = [name for lesson in authors_for_lesson for name in lesson]
-        author_count = Counter(author_instances).most_common()
+        author_count = Counter(str(author)
+                               for _, lesson_name in iter_curriculum_lessons()
+                               for author in load_lesson_specs(lesson_name)['authors']).most_common()
         print(Fore.YELLOW + '\nAuthors and the number of lessons they\'ve written')
         print('=================================================')
         for tally in author_count:
@@ -264,28 +382,42 @@ def show_lessons(status=None):
         print(Style.RESET_ALL)
         sys.exit(0)
 
-    elif status == 'done':
-        df_results_done = df_results[df_results['Completed'] == True]
-        final = df_results_done.values.tolist()
-
+    # Filter on completion first, since it doesn't require loading the lesson.yaml.
+    lessons = ((topic, lesson_name, lesson_name in completed_lessons)
+               for topic, lesson_name in iter_curriculum_lessons())
+    if status == 'done':
+        lessons = (lesson for lesson in lessons if lesson[2])
     elif status == 'not_done':
-        df_results_not_done = df_results[df_results['Completed'] == False]
-        final = df_results_not_done.values.tolist()
-
-    else:
-        final = df_results.values.tolist()
+        lessons = (lesson for lesson in lessons if not lesson[2])
 
-    if len(final) == 0:
+    def build_row(lesson):
+        topic, lesson_name, completed = lesson
+        lesson_specs = load_lesson_specs(lesson_name)
+        title = lesson_specs['title']
+        objectives = ' * '.join(str(obj) for obj in lesson_specs['objectives'])
+        authors = ', '.join(str(author) for author in lesson_specs['authors'])
+        tags = '; '.join(str(tag) for tag in lesson_specs['tags'])
+        return [topic, title, lesson_name, objectives, authors, tags, completed]
+
+    # Only the lessons on the requested page have their lesson.yaml loaded.
+    if fmt == 'grid':
+        print(Fore.CYAN, end='')
+    num_rows = render_table(lessons, LESSON_COLUMNS, fmt=fmt, limit=limit, offset=offset,
+                            columns=columns, build_row=build_row)
+
+    if num_rows == 0 and offset == 0:
+        print(Style.RESET_ALL, end='')
         if status == 'done':
-            print('You have not completed any lessons. Begin your journey today!')
+            print_no_results('You have not completed any lessons. Begin your journey today!', fmt)
             sys.exit(0)
         elif status == 'not_done':
-            print('You have completed all of the available lesssons. How about you create one of your own now? ;D')
+            print_no_results('You have completed all of the available lesssons. '
+                             'How about you create one of your own now? ;D', fmt)
             sys.exit(0)
 
-    print(Fore.CYAN + tabulate(sorted(final), headers=columns, maxcolwidths=[30, 30, 30, 30, 30, 30, 30], tablefmt="grid"))
-    print('  Start a lesson by running: dojo start <Lesson name>')
-    print(Style.RESET_ALL)
+    if fmt == 'grid':
+        print('  Start a lesson by running: dojo start <Lesson name>')
+        print(Style.RESET_ALL)
 
 def create_lesson_progress(lesson_name):
     ts = get_timestamp_for_action()
@@ -320,6 +452,125 @@ def update_lesson_progress(lesson_name, step_index, note=''):
     df.to_csv(f'{LESSONS_DIR}/{lesson_name}/progress.csv', index=False)    
 
 
+################
+#    TABLES    #
+################
+
+LESSON_COLUMNS = ['Topic', 'Title', 'Lesson name', 'Objectives', 'Author(s)', 'Tags', 'Completed']
+SEARCH_COLUMNS = ['Title', 'Lesson Name', 'Objectives', 'Matching Tag']
+TABLE_FORMATS = ['grid', 'tsv', 'json']
+
+
+def normalize_column_name(name):
+    '''
+    Lets columns be selected loosely, e.g. "lesson_name" or "Lesson name".
+    '''
+    return ''.join(c for c in name.lower() if c.isalnum())
+
+
+def select_columns(all_columns, columns=None):
+    '''
+    Returns the indices of the selected columns (all of them by default).
+    '''
+    if not columns:
+        return list(range(len(all_columns)))
+    lookup = {normalize_column_name(col): i for i, col in enumerate(all_columns)}
+    indices = []
+    for col in columns:
+        key = normalize_column_name(col)
+        if key not in lookup:
+            print(f'ERROR: Unknown column "{col}". Choose from: {", ".join(all_columns)}')
+            sys.exit(1)
+        indices.append(lookup[key])
+    return indices
+
+
+def print_no_results(message, fmt):
+    '''
+    Tells the user there was nothing to show. For "tsv" and "json", the
+    message goes to stderr, so the output stays parseable.
+    '''
+    print(message, file=sys.stdout if fmt == 'grid' else sys.stderr)
+
+
+def render_table(rows, all_columns, fmt='grid', limit=None, offset=0, columns=None, build_row=None):
+    '''
+    Renders an iterable of rows without materializing more of it than needed.
+    Only the requested page (offset/limit) and one more row (to tell whether
+    there's another page) are consumed, and if given, build_row is only called
+    on the items of that page. "tsv" and "json" (one object per
+    line) are written row by row; "grid" buffers just the page.
+    Returns the number of rows rendered.
+    '''
+    indices = select_columns(all_columns, columns)
+    headers = [all_columns[i] for i in indices]
+
+    # Only the page's rows are built. Afterwards, peek at the next raw row
+    # to know whether there's another page.
+    rows = iter(rows)
+    page = islice(rows, offset, None if limit is None else offset + limit)
+    if build_row:
+        page = map(build_row, page)
+    num_rows = 0
+
+    if fmt == 'grid':
+        table = [[row[i] for i in indices] for row in page]
+        num_rows = len(table)
+        if table:
+            print(tabulate(table, headers=headers, maxcolwidths=[30] * len(headers), tablefmt="grid"))
+
+    else:
+        for row in page:
+            values = [row[i] for i in indices]
+            if fmt == 'json':
+                line = json.dumps(dict(zip(headers, values)))
+            else:
+                if num_rows == 0:
+                    sys.stdout.write('\t'.join(headers) + '\n')
+                line = '\t'.join(' '.join(str(v).split()) for v in values)
+            sys.stdout.write(line + '\n')
+            num_rows += 1
+        if fmt == 'tsv' and num_rows == 0:
+            sys.stdout.write('\t'.join(headers) + '\n')
+
+    has_more = limit is not None and num_rows == limit and next(rows, None) is not None
+    if has_more and fmt == 'grid':
+        print(f'  Showing {offset + 1}-{offset + num_rows}. For more, add: --offset {offset + num_rows}')
+
+    return num_rows
+
+
+#################
+#    TIMINGS    #
+#################
+
+@contextmanager
+def timed_phase(lesson_name, phase):
+    '''
+    Times a phase of a dojo command (e.g. the "packages" step of lesson setup)
+    for the metrics file (if DOJO_METRICS_FILE is set). If DOJO_PHASE_TIMINGS
+    is set, the timing is also appended to that file as a line of JSON.
+    '''
+    if not PHASE_TIMINGS_PATH:
+        with metrics.timed('dojo_setup_phase', phase=phase):
+            yield
+        return
+
+    start_time = time.monotonic()
+    try:
+        with metrics.timed('dojo_setup_phase', phase=phase):
+            yield
+    finally:
+        record = {
+            'lesson_name': lesson_name,
+            'phase': phase,
+            'seconds': time.monotonic() - start_time,
+            'pid': os.getpid(),
+        }
+        with open(PHASE_TIMINGS_PATH, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
 ###################
 #    TEMPLATES    #
 ###################
@@ -372,6 +623,42 @@ feedstock_url:
 # in time from which they will complete their lesson objectives.
 commit: 
 
+# (OPTIONAL) Only fetch what the lesson needs from the feedstock. Useful for
+# large feedstocks with long histories or vendored sources.
+#   shallow: only fetch the commit above (no history).
+#   partial: only fetch file contents when they are checked out.
+#   sparse_paths: only check out these paths.
+# Example:
+#   feedstock_clone:
+#     shallow: true
+#     partial: true
+#     sparse_paths:
+#       - recipe
+feedstock_clone: {}
+
+# (OPTIONAL) Commands that show the lesson still reproduces, e.g. the build
+# failing with the error the lesson is about. `dojo run-lessons` sets up the
+# lesson in a fresh workspace and runs them there (from the dojo root).
+#   command: the shell command to run.
+#   expect_exit: the expected exit status (default: 0), or "nonzero".
+#   expect_output: a regular expression the output should contain.
+# Example:
+#   checks:
+#     - command: conda build training_feedstocks/tqdm-feedstock/recipe
+#       expect_exit: nonzero
+#       expect_output: UnsatisfiableError
+checks: []
+
+# (OPTIONAL) The first step (counting from 1) that needs the feedstock snapshot,
+# and the first step that needs dojo_channels (and the .condarc). With
+# `dojo start --background`, the learner can go through the steps before
+# these while the lesson is still being set up. Both default to 1.
+# Example:
+#   feedstock_needed_from_step: 1
+#   channels_needed_from_step: 7
+feedstock_needed_from_step: 1
+channels_needed_from_step: 1
+
 # Lesson prompts (or steps).
 # List the propmpts/steps the learner should go through.
 # You can also pose questions and answers (for example, one prompt is 
@@ -0,0 +1,98 @@
+'''
+Verification of cached package archives (`dojo verify`).
+'''
+import os
+import sys
+from colorama import Fore, Style
+from concurrent.futures import ThreadPoolExecutor
+from dojo import LESSONS_DIR, PKGS_CACHE_DIR
+from dojo.cache import ARCHIVE_EXTENSIONS
+from dojo.manifest import MANIFEST_FILENAME, load_manifest
+from dojo.utils import hash_file
+from glob import glob
+
+
+def load_downloaded_checksums():
+    '''
+    Returns {archive_path: sha256} for every package in every lesson's setup
+    manifest, as hashed while it was downloaded (and checked against the
+    lesson's or the upstream channel's checksum).
+    '''
+    checksums = {}
+    for manifest_path in sorted(glob(os.path.join(LESSONS_DIR, '*', MANIFEST_FILENAME))):
+        lesson_name = os.path.basename(os.path.dirname(manifest_path))
+        dojo_channels_dir = os.path.join(LESSONS_DIR, lesson_name, 'dojo_channels')
+        for relpath, entry in load_manifest(lesson_name)['packages'].items():
+            path = entry.get('path', relpath)
+            # Transcoded packages are checked against the hash of the .conda written on ingest.
+            sha256 = entry.get('sha256') if path == relpath else entry.get('transcoded_sha256')
+            if sha256:
+                checksums[os.path.join(dojo_channels_dir, path)] = sha256
+    return checksums
+
+
+def collect_dojo_channels_archives(checksums):
+    '''
+    Yields (archive_path, expected_sha256) for every archive in every lesson's dojo_channels.
+    '''
+    for archive_path in sorted(glob(os.path.join(LESSONS_DIR, '*', 'dojo_channels', '*', '*', '*'))):
+        if archive_path.endswith(ARCHIVE_EXTENSIONS):
+            yield archive_path, checksums.get(archive_path)
+
+
+def collect_pkgs_cache_archives(checksums):
+    '''
+    Yields (archive_path, expected_sha256) for every archive in the shared
+    package cache. Those archives were seeded from dojo_channels, so they're
+    checked against the checksums of the downloads with the same filename.
+    '''
+    if not os.path.isdir(PKGS_CACHE_DIR):
+        return
+    checksums_by_fn = {os.path.basename(path): sha256 for path, sha256 in checksums.items()}
+    for fn in sorted(os.listdir(PKGS_CACHE_DIR)):
+        if fn.endswith(ARCHIVE_EXTENSIONS):
+            yield os.path.join(PKGS_CACHE_DIR, fn), checksums_by_fn.get(fn)
+
+
+def verify_archive(archive):
+    archive_path, expected_sha256 = archive
+    try:
+        return archive_path, expected_sha256, hash_file(archive_path)
+    except OSError as e:
+        return archive_path, expected_sha256, e
+
+
+def verify_packages(jobs=None):
+    '''
+    Re-hashes all cached archives in parallel and compares them against
+    the sha256 recorded when they were downloaded (not the local repodata,
+    which `conda index` computed from the very same files). Exits non-zero if any archive is corrupt.
+    '''
+    checksums = load_downloaded_checksums()
+    archives = list(collect_dojo_channels_archives(checksums)) + list(collect_pkgs_cache_archives(checksums))
+    if not archives:
+        print('No cached packages to verify.')
+        return
+
+    # hashlib releases the GIL while hashing, so threads hash in parallel.
+    num_ok = num_unknown = 0
+    failures = []
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        for archive_path, expected_sha256, result in executor.map(verify_archive, archives):
+            if isinstance(result, OSError):
+                failures.append((archive_path, str(result)))
+            elif not expected_sha256:
+                num_unknown += 1
+            elif result != expected_sha256:
+                failures.append((archive_path, f'sha256 {result} (expected {expected_sha256})'))
+            else:
+                num_ok += 1
+
+    print(f'Verified {len(archives)} package archive(s): {num_ok} OK, '
+          f'{len(failures)} corrupt, {num_unknown} without a recorded checksum.')
+    if failures:
+        print(Fore.RED + '\nCorrupt archives (delete them and restart the lesson to re-download):')
+        for archive_path, reason in failures:
+            print(f'  - {archive_path}: {reason}')
+        print(Style.RESET_ALL)
+        sys.exit(1)
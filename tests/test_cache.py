@@ -0,0 +1,114 @@
+'''
+Tests of the shared package cache (dojo/cache.py): LRU eviction, urls.txt
+pruning, concurrent updates, and transcoding packages to .conda.
+
+Run with: python -m pytest tests
+'''
+import json
+import os
+import shutil
+import threading
+import pytest
+from benchmarks.fixtures import make_fixture_channel
+from dojo import cache
+
+
+@pytest.fixture
+def pkgs_cache_dir(tmp_path, monkeypatch):
+    path = str(tmp_path / 'pkgs')
+    os.makedirs(path)
+    monkeypatch.setattr(cache, 'PKGS_CACHE_DIR', path)
+    return path
+
+
+def add_cached_package(pkgs_cache_dir, dist, size):
+    with open(os.path.join(pkgs_cache_dir, f'{dist}.conda'), 'wb') as f:
+        f.write(b'\0' * size)
+    info_dir = os.path.join(pkgs_cache_dir, dist, 'info')
+    os.makedirs(info_dir)
+    with open(os.path.join(info_dir, 'index.json'), 'w') as f:
+        json.dump({'name': dist}, f)
+
+
+def read_urls_txt(pkgs_cache_dir):
+    with open(os.path.join(pkgs_cache_dir, 'urls.txt')) as f:
+        return f.read().splitlines()
+
+
+def test_evicts_least_recently_used_and_prunes_urls_txt(pkgs_cache_dir):
+    dists = ['a-1.0-0', 'b-1.0-0', 'c-1.0-0', 'd-1.0-0']
+    for dist in dists:
+        add_cached_package(pkgs_cache_dir, dist, 1000)
+    # Not a package (e.g. conda's own cache): never evicted.
+    os.makedirs(os.path.join(pkgs_cache_dir, 'cache'))
+    with cache.cache_lock():
+        cache.save_last_used({'a-1.0-0': 1, 'b-1.0-0': 4, 'c-1.0-0': 2, 'd-1.0-0': 3})
+    cache.mark_used([], [f'file:///channel/linux-64/{dist}.conda' for dist in dists])
+
+    # c is older than d, but the current lesson needs it.
+    cache.evict_pkgs_cache(keep={'c-1.0-0'}, max_bytes=2500)
+
+    remaining = sorted(os.listdir(pkgs_cache_dir))
+    assert 'a-1.0-0' not in remaining and 'a-1.0-0.conda' not in remaining
+    assert 'd-1.0-0' not in remaining and 'd-1.0-0.conda' not in remaining
+    assert {'b-1.0-0', 'b-1.0-0.conda', 'c-1.0-0', 'c-1.0-0.conda', 'cache'} <= set(remaining)
+    assert set(cache.load_last_used()) == {'b-1.0-0', 'c-1.0-0'}
+    assert read_urls_txt(pkgs_cache_dir) == ['file:///channel/linux-64/b-1.0-0.conda',
+                                             'file:///channel/linux-64/c-1.0-0.conda']
+    assert not [fn for fn in remaining if fn.endswith('.tmp')]
+
+
+def test_nothing_is_evicted_under_the_cap(pkgs_cache_dir):
+    add_cached_package(pkgs_cache_dir, 'a-1.0-0', 1000)
+    cache.mark_used(['a-1.0-0'], ['file:///channel/linux-64/a-1.0-0.conda'])
+    cache.evict_pkgs_cache(max_bytes=10 * 1000)
+    assert os.path.isdir(os.path.join(pkgs_cache_dir, 'a-1.0-0'))
+    assert read_urls_txt(pkgs_cache_dir) == ['file:///channel/linux-64/a-1.0-0.conda']
+
+
+def test_concurrent_lessons_dont_lose_updates(pkgs_cache_dir):
+    def use(i):
+        for j in range(20):
+            cache.mark_used([f'pkg{i}-{j}-0'], [f'file:///channel/linux-64/pkg{i}-{j}-0.conda'])
+
+    threads = [threading.Thread(target=use, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    expected = {f'pkg{i}-{j}-0' for i in range(8) for j in range(20)}
+    assert set(cache.load_last_used()) == expected
+    urls = read_urls_txt(pkgs_cache_dir)
+    assert len(urls) == len(set(urls)) == len(expected)
+
+
+def read_tree(path):
+    tree = {}
+    for dir_path, _, fns in os.walk(path):
+        for fn in fns:
+            with open(os.path.join(dir_path, fn), 'rb') as f:
+                tree[os.path.relpath(os.path.join(dir_path, fn), path)] = f.read()
+    return tree
+
+
+@pytest.mark.skipif(not cache.has_package_handling(), reason='needs conda-package-handling')
+def test_transcoded_packages_have_the_same_contents(tmp_path):
+    from conda_package_handling import api as cph_api
+
+    bz2_channel = str(tmp_path / 'tar_bz2')
+    conda_channel = str(tmp_path / 'conda')
+    make_fixture_channel(bz2_channel, 3, 16 * 1024)
+    shutil.copytree(bz2_channel, conda_channel)
+    subdir_path = os.path.join(conda_channel, 'noarch')
+    conda_paths = cache.transcode_packages([os.path.join(subdir_path, fn) for fn in os.listdir(subdir_path)])
+
+    assert len(conda_paths) == 3
+    for bz2_path, conda_path in conda_paths.items():
+        assert not os.path.exists(bz2_path)
+        dist = cache.strip_archive_extension(os.path.basename(conda_path))
+        cph_api.extract(os.path.join(bz2_channel, 'noarch', os.path.basename(bz2_path)),
+                        dest_dir=str(tmp_path / 'extracted_bz2' / dist))
+        cph_api.extract(conda_path, dest_dir=str(tmp_path / 'extracted_conda' / dist))
+        bz2_tree = read_tree(str(tmp_path / 'extracted_bz2' / dist))
+        assert bz2_tree and read_tree(str(tmp_path / 'extracted_conda' / dist)) == bz2_tree
@@ -0,0 +1,174 @@
+'''
+Tests of host-level coordination (dojo/coordinator.py) and of the lesson.yaml
+"feedstock_clone" modes, against a local HTTP server and bare git repo.
+
+Run with: python -m pytest tests
+'''
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from benchmarks.fixtures import (BENCHMARK_LESSON_NAME, FixtureServer, make_feedstock_remote, make_fixture_channel,
+                                 make_workspace)
+from dojo import coordinator, lesson, utils
+from dojo.utils import ChecksumMismatchError, get_upstream_checksums, hash_file
+from git import Repo
+
+
+CLONE_MODES = {
+    'full': {},
+    'shallow': {'shallow': True, 'partial': False, 'sparse_paths': []},
+    'partial': {'shallow': False, 'partial': True, 'sparse_paths': []},
+    'sparse': {'shallow': False, 'partial': False, 'sparse_paths': ['recipe']},
+    'shallow+partial+sparse': {'shallow': True, 'partial': True, 'sparse_paths': ['recipe']},
+}
+
+
+@pytest.fixture
+def shared_dir(tmp_path, monkeypatch):
+    path = str(tmp_path / 'shared')
+    monkeypatch.setattr(coordinator, 'SHARED_DIR', path)
+    return path
+
+
+@pytest.fixture
+def feedstock(tmp_path):
+    return make_feedstock_remote(str(tmp_path / 'remote'), num_commits=3, vendored_size=1024)
+
+
+def clone_feedstock(tmp_path, monkeypatch, learner, feedstock_url, commit, clone_options):
+    feedstocks_dir = tmp_path / learner / 'training_feedstocks'
+    feedstocks_dir.mkdir(parents=True)
+    monkeypatch.setattr(lesson, 'TRAINING_FEEDSTOCKS_DIR', str(feedstocks_dir))
+    monkeypatch.setattr(lesson, 'ROOT_DIR', str(tmp_path))
+    return lesson.clone_checkout_feedstock(feedstock_url, commit, clone_options)
+
+
+def test_download_package_once(tmp_path, shared_dir):
+    server_path = str(tmp_path / 'server')
+    relpath = make_fixture_channel(os.path.join(server_path, 'main'), 1, 64 * 1024)[0]
+    with FixtureServer(server_path) as server:
+        url = f'{server.url}/{relpath}'
+        destinations = [str(tmp_path / f'learner_{i}' / relpath) for i in range(8)]
+        results = {}
+
+        def download(destination_path):
+            results[destination_path] = coordinator.download_package_once(url, destination_path)
+
+        threads = [threading.Thread(target=download, args=(path,)) for path in destinations]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert server.request_counts[f'/{relpath}'] == 1
+    assert len(set(results.values())) == 1
+    assert all(os.path.exists(path) for path in destinations)
+
+
+def test_upstream_checksums_are_fetched_once_and_only_on_a_miss(tmp_path, shared_dir, monkeypatch):
+    server_path = str(tmp_path / 'server')
+    relpath = make_fixture_channel(os.path.join(server_path, 'main'), 1, 1024)[0]
+    package_path = os.path.join(server_path, relpath)
+    repodata_path = os.path.join(os.path.dirname(package_path), 'repodata.json')
+    with open(repodata_path, 'w') as f:
+        json.dump({'packages.conda': {os.path.basename(relpath): {'sha256': hash_file(package_path)}}}, f)
+
+    with FixtureServer(server_path) as server:
+        url = f'{server.url}/{relpath}'
+        repodata_request = '/' + os.path.relpath(repodata_path, server_path)
+
+        def lookup_checksums():
+            return get_upstream_checksums(url, coordinator.fetch_upstream_checksums_once)
+
+        # Each learner's process has its own in-memory cache.
+        for i in range(3):
+            monkeypatch.setattr(utils, 'UPSTREAM_REPODATA', {})
+            coordinator.download_package_once(url, str(tmp_path / f'learner_{i}' / relpath),
+                                              lookup_checksums=lookup_checksums)
+        assert server.request_counts[f'/{relpath}'] == 1
+        assert server.request_counts[repodata_request] == 1
+
+        # On the next miss, the checksums come from the shared directory.
+        shutil.rmtree(os.path.join(shared_dir, 'blobs'))
+        monkeypatch.setattr(utils, 'UPSTREAM_REPODATA', {})
+        coordinator.download_package_once(url, str(tmp_path / 'learner_3' / relpath), lookup_checksums=lookup_checksums)
+        assert server.request_counts[f'/{relpath}'] == 2
+        assert server.request_counts[repodata_request] == 1
+
+        # A pinned checksum that doesn't match is an error, and nothing is linked.
+        destination_path = str(tmp_path / 'learner_pinned' / relpath)
+        with pytest.raises(ChecksumMismatchError):
+            coordinator.download_package_once(url, destination_path, expected_sha256='0' * 64)
+        assert not os.path.exists(destination_path)
+
+
+def test_concurrent_starts_fetch_each_package_once(tmp_path, feedstock):
+    feedstock_url, commit = feedstock
+    server_path = str(tmp_path / 'server')
+    relpaths = make_fixture_channel(os.path.join(server_path, 'main'), 4, 16 * 1024)
+    with FixtureServer(server_path) as server:
+        pkg_urls = [f'{server.url}/{relpath}' for relpath in relpaths]
+        processes = []
+        for i in range(6):
+            workspace_path = str(tmp_path / 'learners' / f'learner_{i}')
+            env = make_workspace(workspace_path, feedstock_url, commit, pkg_urls)
+            env['DOJO_SHARED_DIR'] = str(tmp_path / 'shared')
+            processes.append(subprocess.Popen([sys.executable, '-m', 'dojo', 'start', BENCHMARK_LESSON_NAME],
+                                              cwd=workspace_path, env=env, stdin=subprocess.DEVNULL,
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True))
+        for process in processes:
+            _, stderr = process.communicate()
+            assert process.returncode == 0, stderr
+
+        assert {relpath: server.request_counts[f'/{relpath}'] for relpath in relpaths} == \
+            {relpath: 1 for relpath in relpaths}
+
+
+def test_throttle_lets_one_download_use_the_whole_cap(shared_dir, monkeypatch):
+    monkeypatch.setattr(coordinator, 'SHARED_MAX_BYTES_PER_SEC', 1024 * 1024)
+    start_time = time.monotonic()
+    for _ in range(20):
+        coordinator.throttle(100 * 1024)
+    elapsed = time.monotonic() - start_time
+    # 2 MB at 1 MB/s, with the bucket starting full (1 MB): about 1 s.
+    assert 0.8 < elapsed < 1.6
+
+
+@pytest.mark.parametrize('use_coordinator', [False, True])
+@pytest.mark.parametrize('mode', list(CLONE_MODES))
+def test_clone_modes(tmp_path, monkeypatch, feedstock, mode, use_coordinator):
+    feedstock_url, commit = feedstock
+    clone_options = CLONE_MODES[mode]
+    monkeypatch.setattr(coordinator, 'SHARED_DIR', str(tmp_path / 'shared') if use_coordinator else None)
+
+    clone_path = clone_feedstock(tmp_path, monkeypatch, 'learner_0', feedstock_url, commit, clone_options)
+
+    repo = Repo(clone_path)
+    assert repo.head.commit.hexsha == commit
+    assert os.path.exists(os.path.join(clone_path, 'recipe', 'meta.yaml'))
+    assert repo.remotes.origin.url == feedstock_url
+    assert (repo.git.rev_parse('--is-shallow-repository') == 'true') == clone_options.get('shallow', False)
+    if clone_options.get('partial'):
+        assert repo.git.config('remote.origin.promisor') == 'true'
+    assert os.path.exists(os.path.join(clone_path, 'vendor')) == (not clone_options.get('sparse_paths'))
+
+
+@pytest.mark.parametrize('mode', list(CLONE_MODES))
+def test_clone_modes_use_the_shared_mirror(tmp_path, monkeypatch, shared_dir, feedstock, mode):
+    feedstock_url, commit = feedstock
+    clone_feedstock(tmp_path, monkeypatch, 'learner_0', feedstock_url, commit, CLONE_MODES[mode])
+
+    # Every other learner on the host clones from the mirror, without going
+    # back to the feedstock.
+    remote_path = feedstock_url[len('file://'):]
+    os.rename(remote_path, remote_path + '.gone')
+    clone_path = clone_feedstock(tmp_path, monkeypatch, 'learner_1', feedstock_url, commit, CLONE_MODES[mode])
+
+    repo = Repo(clone_path)
+    assert repo.head.commit.hexsha == commit
+    assert os.path.exists(os.path.join(clone_path, 'recipe', 'meta.yaml'))
@@ -0,0 +1,49 @@
+'''
+Tests of merging learners' state (dojo/state.py).
+
+Run with: python -m pytest tests
+'''
+import csv
+import os
+import pytest
+from dojo.state import HISTORY_COLUMNS, PROGRESS_COLUMNS, merge_state
+
+
+def write_csv(path, columns, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def read_rows(path):
+    with open(path, newline='') as f:
+        return [list(row.values()) for row in csv.DictReader(f)]
+
+
+@pytest.mark.parametrize('max_events_in_memory', [1, 1000])
+def test_same_second_repeats_are_kept_once_across_overlapping_exports(tmp_path, max_events_in_memory):
+    start = ['2021-04-01 10:00:00', '001_version_bump', 'start', 'True', 'False']
+    # The learner ran `dojo n` twice within the same second: both are real events.
+    step = ['2021-04-01 10:05:00', '001_version_bump', 'next', 'True', 'False']
+    later = ['2021-04-08 09:00:00', '001_version_bump', 'next', 'True', 'False']
+    progress = ['001_version_bump', '2021-04-01 10:05:00', '1', '']
+
+    collected = tmp_path / 'collected' / 'alice'
+    write_csv(str(collected / '2021-04-01' / 'history.csv'), HISTORY_COLUMNS, [start, step, step])
+    write_csv(str(collected / '2021-04-01' / 'lessons' / '001_version_bump' / 'progress.csv'), PROGRESS_COLUMNS,
+              [progress, progress])
+    # The second export overlaps the first (it has one of the repeats), then goes on.
+    write_csv(str(collected / '2021-04-08' / 'history.csv'), HISTORY_COLUMNS, [start, step, later])
+    write_csv(str(collected / '2021-04-08' / 'lessons' / '001_version_bump' / 'progress.csv'), PROGRESS_COLUMNS,
+              [progress])
+
+    output = tmp_path / 'merged'
+    num_read, num_learners, num_written = merge_state([str(tmp_path / 'collected')], str(output),
+                                                      max_events_in_memory=max_events_in_memory, quiet=True)
+
+    assert read_rows(str(output / 'alice' / 'history.csv')) == [start, step, step, later]
+    assert read_rows(str(output / 'alice' / 'lessons' / '001_version_bump' / 'progress.csv')) == \
+        [progress, progress]
+    assert (num_read, num_learners, num_written) == (9, 1, 6)